@@ -1,49 +1,225 @@
-from pyresample import load_area
+from pyresample import create_area_def, load_area
+from pyresample.area_config import load_area_from_string
 from pyresample.bucket import BucketResampler
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import contextlib
+import copy
+import csv
+import functools
+import glob
 import h5py
+import hashlib
+import json
+import logging
 import os
+import resource
+import time
+import dask
 import dask.array as da
+from dask.callbacks import Callback
+from dask.utils import key_split, parse_bytes
 import xarray as xr
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 from atrain_match.utils import validate_cph_util as vcu
 from atrain_match.utils.get_flag_info import get_calipso_clouds_of_type_i_feature_classification_flags_one_layer as get_cal_flag
-from scores import (hitrate, pod_clr, pod_cld, far_clr, far_cld, pofd_clr,
-                    pofd_cld, heidke, kuiper, bias, mean)
+from scores import get_batch_scores, get_bootstrap_ci
 
 
 matplotlib.use('Agg')
 
+# --------------------------- instrumentation --------------------------------
+# JSON log lines of every stage, see log_stage() and stage_logging()
+STAGE_LOGGER = logging.getLogger('atrain_plot.stages')
+
+
+def _get_bytes_read():
+    """ Bytes read by this process so far (None if not available). """
+    try:
+        with open('/proc/self/io') as fh:
+            for line in fh:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def get_graph_stats(collections):
+    """
+    Get number of tasks and layers of the dask graph of (nested lists/dicts
+    of) dask collections.
+    """
+    collections = dask.base.unpack_collections(collections)[0]
+    keys = set()
+    nlayers = 0
+    for collection in collections:
+        graph = collection.__dask_graph__()
+        keys.update(graph.keys())
+        nlayers += len(getattr(graph, 'layers', [None]))
+    return {'ntasks': len(keys), 'nlayers': nlayers}
+
+
+class _TaskTimer(Callback):
+    """
+    Sum up the time spent in the tasks of a dask computation per task name
+    (e.g. h5py reads, flag decoding, bincount) with the local schedulers.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.start = dict()
+        self.times = dict()
+
+    def _pretask(self, key, dsk, state):
+        self.start[key] = time.perf_counter()
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        name = key_split(key)
+        self.times[name] = (self.times.get(name, 0) + time.perf_counter()
+                            - self.start.pop(key, time.perf_counter()))
+
+
+@contextlib.contextmanager
+def log_stage(stage, collections=None, **context):
+    """
+    Record wall and CPU time, bytes read, peak RSS and dask graph size of a
+    stage and emit them as a JSON log line to STAGE_LOGGER.
+
+    collections: dask collections computed in the stage (for graph stats and
+                 the time spent per task name)
+    context:     additional fields of the log line (file, scenario, ...)
+
+    Costs nothing if STAGE_LOGGER is not enabled for INFO.
+    """
+    if not STAGE_LOGGER.isEnabledFor(logging.INFO):
+        yield
+        return
+
+    record = {'stage': stage}
+    record.update(context)
+    if collections is not None:
+        record.update(get_graph_stats(collections))
+    bytes_read = _get_bytes_read()
+    timer = _TaskTimer()
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    try:
+        if collections is None:
+            yield
+        else:
+            with timer:
+                yield
+    finally:
+        record['wall_s'] = round(time.perf_counter() - wall, 4)
+        record['cpu_s'] = round(time.process_time() - cpu, 4)
+        if bytes_read is not None:
+            record['bytes_read'] = _get_bytes_read() - bytes_read
+        # peak resident set size of the process so far (kB on linux)
+        record['max_rss_mb'] = round(resource.getrusage(
+                                   resource.RUSAGE_SELF).ru_maxrss / 2**10, 1)
+        if timer.times:
+            record['task_s'] = {name: round(t, 4) for name, t in sorted(
+                timer.times.items(), key=lambda item: -item[1])}
+        record['pid'] = os.getpid()
+        STAGE_LOGGER.info(json.dumps(record, default=str))
+
+
+@contextlib.contextmanager
+def stage_logging(stage_log=None, perf_report=None):
+    """
+    Append the stage log lines to the file stage_log and write a dask
+    performance report (needs dask.distributed and a running Client) to
+    the html file perf_report, if given.
+    """
+    with contextlib.ExitStack() as stack:
+        if stage_log is not None:
+            handler = logging.FileHandler(stage_log)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            level = STAGE_LOGGER.level
+            STAGE_LOGGER.addHandler(handler)
+            STAGE_LOGGER.setLevel(logging.INFO)
+            stack.callback(handler.close)
+            stack.callback(STAGE_LOGGER.removeHandler, handler)
+            stack.callback(STAGE_LOGGER.setLevel, level)
+        if perf_report is not None:
+            try:
+                from dask.distributed import performance_report
+            except ImportError:
+                raise Exception('perf_report needs dask.distributed')
+            stack.enter_context(performance_report(filename=perf_report))
+        yield
+
+
+@functools.lru_cache(maxsize=32)
+def _open_h5(filename, mtime_ns):
+    """ Open a HDF5 file read-only once per process (and modification). """
+    return h5py.File(filename, 'r')
+
+
+class H5Source:
+    """
+    Picklable reference to a h5py dataset, so that the dask graphs reading
+    it can also run on the processes and distributed schedulers. Every
+    process opens the file once on first access.
+    """
+
+    def __init__(self, var):
+        self.filename = var.file.filename
+        self.mtime_ns = os.stat(self.filename).st_mtime_ns
+        self.name = var.name
+        self.shape = var.shape
+        self.dtype = var.dtype
+        self.ndim = var.ndim
+
+    def __getitem__(self, key):
+        return _open_h5(self.filename, self.mtime_ns)[self.name][key]
+
+    def __dask_tokenize__(self):
+        return (self.filename, self.mtime_ns, self.name, self.shape)
+
+
+def read_lazy(var, chunks, column=None):
+    """
+    Wrap a h5py dataset in a dask array without reading it.
+
+    column: read only this column of a 2D (pixel, layer) dataset
+    """
+    if column is None:
+        return da.from_array(H5Source(var), chunks=chunks)
+    return da.from_array(H5Source(var), chunks=(chunks, 1))[:, column]
+
+
 # --------------------------- CTTH ------------------------------------------
-def get_caliop_cth(ds):
-    cth = np.array(ds['layer_top_altitude'])[:, 0]
-    elev = np.array(ds['elevation'])
+def get_caliop_cth(ds, chunks=100000):
+    cth = read_lazy(ds['layer_top_altitude'], chunks, column=0)
+    elev = read_lazy(ds['elevation'], chunks)
     # set FillValue to NaN, convert to m
-    cth = np.where(cth == -9999, np.nan, cth * 1000.)
+    cth = da.where(cth == -9999, np.nan, cth * 1000.)
     # compute height above surface
     cth_surf = cth - elev
     return cth_surf
 
 
-def get_caliop_ctt(ds):
-    ctt = np.array(ds['midlayer_temperature'])[:, 0]
-    ctt = np.where(ctt == -9999, np.nan, ctt + 273.15)
-    ctt = np.where(ctt < 0, np.nan, ctt)
+def get_caliop_ctt(ds, chunks=100000):
+    ctt = read_lazy(ds['midlayer_temperature'], chunks, column=0)
+    ctt = da.where(ctt == -9999, np.nan, ctt + 273.15)
+    ctt = da.where(ctt < 0, np.nan, ctt)
     return ctt
 
 
-def get_imager_cth(ds):
-    alti = np.array(ds['ctth_height'])
+def get_imager_cth(ds, chunks=100000):
+    alti = read_lazy(ds['ctth_height'], chunks)
     # set FillValue to NaN
-    alti = np.where(alti < 0, np.nan, alti)
+    alti = da.where(alti < 0, np.nan, alti)
     # alti = np.where(alti>45000, np.nan, alti)
     return alti
 
 
-def get_imager_ctt(ds):
-    tempe = np.array(ds['ctth_temperature'])
-    tempe = np.where(tempe < 0, np.nan, tempe)
+def get_imager_ctt(ds, chunks=100000):
+    tempe = read_lazy(ds['ctth_temperature'], chunks)
+    tempe = da.where(tempe < 0, np.nan, tempe)
     return tempe
 
 
@@ -53,143 +229,434 @@ def get_calipso_clouds_of_type_i(cflag, calipso_cloudtype=0):
     return get_cal_flag(cflag, calipso_cloudtype=calipso_cloudtype)
 
 
+def _decode_cloud_type(cflag):
+    ctype = np.full(np.shape(cflag), 255, dtype=np.uint8)
+    for calipso_cloudtype in range(8):
+        ctype[get_calipso_clouds_of_type_i(cflag, calipso_cloudtype)] = \
+            calipso_cloudtype
+    return ctype
+
+
+@functools.lru_cache(maxsize=None)
+def _get_flag_lut():
+    """ Cloud type of every possible 16 bit flag value, decoded once. """
+    return _decode_cloud_type(np.arange(2**16, dtype=np.uint16))
+
+
+def get_calipso_cloud_type(cflag):
+    """Get CALIPSO cloud type 0-7 of top layer, 255 if no cloud."""
+    cflag = np.asarray(cflag)
+    if cflag.size == 0:
+        return np.full(cflag.shape, 255, dtype=np.uint8)
+    if cflag.dtype.kind in 'ui' and cflag.min() >= 0 and cflag.max() < 2**16:
+        return _get_flag_lut()[cflag]
+    # decode every distinct flag value only once
+    uflags, inverse = np.unique(cflag, return_inverse=True)
+    return _decode_cloud_type(uflags)[inverse].reshape(cflag.shape)
+
+
+def _get_cloud_type_lut(types):
+    lut = np.zeros(256, dtype=bool)
+    lut[list(types)] = True
+    return lut
+
+
+# lookup tables of cloud type (see get_calipso_cloud_type) to cloud class
+CLOUD_TYPE_LUT = {'low': _get_cloud_type_lut([0, 1, 2, 3]),
+                  'mid': _get_cloud_type_lut([4, 5]),
+                  'high': _get_cloud_type_lut([6, 7]),
+                  'op': _get_cloud_type_lut([1, 2, 5, 7]),
+                  'tp': _get_cloud_type_lut([0, 3, 4, 6]),
+                  'low_op': _get_cloud_type_lut([1, 2]),
+                  'mid_high_tp': _get_cloud_type_lut([4, 6])}
+
+
+def get_cloud_class(ctype, cls):
+    """Get mask of cloud class cls (key of CLOUD_TYPE_LUT) from cloud type."""
+    return CLOUD_TYPE_LUT[cls][ctype]
+
+
 def get_calipso_low_clouds(cfalg):
     """Get CALIPSO low clouds."""
     # type 0, 1, 2, 3 are low cloudtypes
-    calipso_low = np.logical_or(
-        np.logical_or(
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=0),
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=1)),
-        np.logical_or(
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=2),
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=3)))
-    return calipso_low
+    return CLOUD_TYPE_LUT['low'][get_calipso_cloud_type(cfalg)]
 
 
 def get_calipso_medium_clouds(cfalg):
     """Get CALIPSO medium clouds."""
     # type 4,5 are mid-level cloudtypes (Ac, As)
-    calipso_high = np.logical_or(
-        get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=4),
-        get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=5))
-    return calipso_high
+    return CLOUD_TYPE_LUT['mid'][get_calipso_cloud_type(cfalg)]
 
 
 def get_calipso_high_clouds(cfalg):
     """Get CALIPSO high clouds."""
     # type 6, 7 are high cloudtypes
-    calipso_high = np.logical_or(
-        get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=6),
-        get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=7))
-    return calipso_high
+    return CLOUD_TYPE_LUT['high'][get_calipso_cloud_type(cfalg)]
 
 
 def get_calipso_op(cfalg):
     """Get CALIPSO opaque clouds."""
     # type 1, 2, 5, 7 are opaque cloudtypes
-    calipso_low = np.logical_or(
-        np.logical_or(
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=1),
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=2)),
-        np.logical_or(
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=5),
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=7)))
-    return calipso_low
+    return CLOUD_TYPE_LUT['op'][get_calipso_cloud_type(cfalg)]
 
 
 def get_calipso_tp(cfalg):
     """Get CALIPSO semi-transparent clouds."""
     # type 0,3,4,6 transparent/broken
-    calipso_low = np.logical_or(
-        np.logical_or(
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=0),
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=3)),
-        np.logical_or(
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=4),
-            get_calipso_clouds_of_type_i(cfalg, calipso_cloudtype=6)))
-    return calipso_low
+    return CLOUD_TYPE_LUT['tp'][get_calipso_cloud_type(cfalg)]
 
 
 def get_calipso_low_clouds_op(match_calipso):
     """Get CALIPSO low and opaque clouds."""
-    # type 0, 1, 2, 3 are low cloudtypes
-    calipso_low = np.logical_or(
-        get_calipso_clouds_of_type_i(match_calipso, calipso_cloudtype=1),
-        get_calipso_clouds_of_type_i(match_calipso, calipso_cloudtype=2))
-    return calipso_low
+    # type 1, 2 are low opaque cloudtypes
+    return CLOUD_TYPE_LUT['low_op'][get_calipso_cloud_type(match_calipso)]
 
 
 def get_calipso_medium_and_high_clouds_tp(match_calipso):
     """Get CALIPSO medium transparent and high transparent clouds."""
-    # type 0, 1, 2, 3 are low cloudtypes
-    calipso_transp = np.logical_or(
-        get_calipso_clouds_of_type_i(match_calipso, calipso_cloudtype=4),
-        get_calipso_clouds_of_type_i(match_calipso, calipso_cloudtype=6))
-    return calipso_transp
+    # type 4, 6 are mid/high transparent cloudtypes
+    return CLOUD_TYPE_LUT['mid_high_tp'][
+                                    get_calipso_cloud_type(match_calipso)]
+
 
+# categorical fields (CMA, CPH) are int8 with this value for invalid pixels
+INVALID = -1
 
-def get_caliop_cph(ds):
+
+def _decode_caliop_cph(cflags):
     """
     CALIPSO_PHASE_VALUES:   unknown=0,
                             ice=1,
                             water=2,
+
+    Returns int8 phase: 0 liquid, 1 ice, INVALID otherwise.
     """
-    phase = vcu.get_calipso_phase_inner(ds['feature_classification_flags'],
+    phase = vcu.get_calipso_phase_inner(cflags,
                                         max_layers=10,
                                         same_phase_in_top_three_lay=True)
-    mask = phase.mask
-    phase = np.array(phase)
-    phase = np.where(phase == 0, np.nan, phase)
-    phase = np.where(phase == 2, 0, phase)
-    phase = np.where(np.logical_or(phase == 1, phase == 3), 1, phase)
+    mask = np.ma.getmaskarray(phase)
+    phase = np.ma.getdata(phase)
+    cph = np.full(phase.shape, INVALID, dtype=np.int8)
+    cph[phase == 2] = 0
+    cph[np.logical_or(phase == 1, phase == 3)] = 1
+    cph[mask] = INVALID
+    return cph
+
+
+def get_caliop_cph(ds, chunks=100000):
+    cflags = da.from_array(H5Source(ds['feature_classification_flags']),
+                           chunks=(chunks, -1))
+    # phase decoding runs chunk by chunk, pixels are independent
+    return cflags.map_blocks(_decode_caliop_cph, drop_axis=1,
+                             dtype=np.int8)
 
-    phase = np.where(mask, np.nan, phase)
-    return phase
 
+def _decode_imager_cph(phase):
+    """ int8 phase: 0 liquid, 1 ice, 3-10 other, INVALID for <= 0, > 10 """
+    valid = np.logical_and(phase > 0, phase <= 10)
+    cph = np.full(phase.shape, INVALID, dtype=np.int8)
+    cph[valid] = phase[valid]
+    cph[phase == 1] = 0
+    cph[phase == 2] = 1
+    return cph
 
-def get_imager_cph(ds):
-    phase = np.array(ds['cpp_phase'])
-    phase = np.where(phase < 0, np.nan, phase)
-    phase = np.where(phase > 10, np.nan, phase)
-    phase = np.where(phase == 0, np.nan, phase)
-    phase = np.where(phase == 1, 0, phase)
-    phase = np.where(phase == 2, 1, phase)
 
-    return phase
+def get_imager_cph(ds, chunks=100000):
+    phase = read_lazy(ds['cpp_phase'], chunks)
+    return phase.map_blocks(_decode_imager_cph, dtype=np.int8)
 
 
-def get_caliop_cma(ds):
+def get_caliop_cma(ds, chunks=100000):
     cfrac_limit = 0.5
-    caliop_cma = np.array(ds['cloud_fraction']) > cfrac_limit
-    return caliop_cma.astype(bool)
+    caliop_cma = read_lazy(ds['cloud_fraction'], chunks) > cfrac_limit
+    return caliop_cma.astype(np.int8)
 
 
-def get_imager_cma(ds):
-    data = np.array(ds['cloudmask'])
-    binary = np.where(data == 0, 0, 1)
-    binary = np.where(data < 0, np.nan, binary)
+def _decode_imager_cma(data):
+    """ int8 cloud mask: 0 clear, 1 cloudy, INVALID for negative values """
+    cma = np.where(data == 0, 0, 1).astype(np.int8)
+    cma[data < 0] = INVALID
+    return cma
 
-    return binary.astype(bool)
 
+def get_imager_cma(ds, chunks=100000):
+    data = read_lazy(ds['cloudmask'], chunks)
+    return data.map_blocks(_decode_imager_cma, dtype=np.int8)
 
-def get_collocated_file_info(ipath, chunksize, dnt='ALL',
-                             satz_lim=None, dataset='CCI'):
-    file = h5py.File(ipath, 'r')
-    caliop = file['calipso']
 
+def get_imager_group(file, dataset):
     if dataset == 'CCI':
-        imager = file['cci']
-    elif dataset == 'CLAAS':
-        imager = file['pps']
+        return file['cci']
+    elif dataset in ['CLAAS', 'CLAAS3']:
+        return file['pps']
     else:
         raise Exception('Dataset {} not known!'.format(dataset))
 
+
+# --------------------------- scheduler and chunks ---------------------------
+SCHEDULERS = ['synchronous', 'threads', 'processes', 'distributed']
+# chunk size of the 1D matchup arrays if no memory budget is given
+DEFAULT_CHUNKSIZE = 100000
+MIN_CHUNKSIZE = 10000
+# decoded float64 variables per pixel and factor for temporaries of the
+# decoding and reduction, used to derive chunk sizes from a memory budget
+DECODED_VARS = 14
+CHUNK_OVERHEAD = 4
+
+
+@contextlib.contextmanager
+def use_scheduler(scheduler=None, nworkers=None):
+    """
+    Run the dask computations inside the context on the given scheduler.
+
+    scheduler: synchronous, threads, processes or distributed (a local
+               cluster of nworkers single threaded processes, needs
+               dask.distributed); None keeps the current scheduler
+    nworkers:  number of threads/processes, None for the number of cores
+    """
+    if scheduler is None:
+        yield
+    elif scheduler not in SCHEDULERS:
+        raise Exception('Scheduler {} not known!'.format(scheduler))
+    elif scheduler == 'distributed':
+        try:
+            from dask.distributed import Client, LocalCluster
+        except ImportError:
+            raise Exception('scheduler distributed needs dask.distributed')
+        with LocalCluster(n_workers=nworkers, threads_per_worker=1) as cl:
+            with Client(cl):
+                yield
+    else:
+        with dask.config.set(scheduler=scheduler, num_workers=nworkers):
+            yield
+
+
+def get_nworkers(scheduler=None, nworkers=None):
+    """ Number of chunks processed at the same time by a scheduler. """
+    if scheduler == 'synchronous':
+        return 1
+    return nworkers or os.cpu_count() or 1
+
+
+def get_memory_budget(memory_budget):
+    """
+    Get a memory budget in bytes from a number of bytes, a string like
+    '4GB' or 'auto' for half of the physical memory.
+    """
+    if memory_budget == 'auto':
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    if isinstance(memory_budget, str):
+        return parse_bytes(memory_budget)
+    return int(memory_budget)
+
+
+def get_partial_bytes(chunksize, out_size, nscenarios=1):
+    """
+    Upper bound of the bytes of the sparse statistics (see get_sparse_parts)
+    of one chunk of nscenarios reductions on out_size grid boxes: every part
+    has at most one code per pixel and per (grid box, label), each with its
+    statistics rows.
+    """
+    rows = {'cma': 1, 'cph': 1, 'ctth': 1 + 3 * len(_get_ctth_pixel_vars())}
+    return nscenarios * sum(8 * (1 + rows[key])
+                            * min(chunksize, out_size * nlabels)
+                            for key, nlabels in SPARSE_NLABELS.items())
+
+
+def get_chunksize(ipath, dataset, memory_budget=None, nworkers=None,
+                  out_size=None, nscenarios=1):
+    """
+    Derive the chunk size of the 1D matchup arrays of a file.
+
+    Every worker processes one chunk at a time, which needs the raw bytes
+    per pixel of the matchup variables (dtype size times columns) plus the
+    decoded float64 variables times CHUNK_OVERHEAD. Given the grid size
+    out_size of the reduction (including bins or strata) the budget also
+    covers the sparse statistics of nscenarios reductions (see
+    get_partial_bytes) of the nworkers chunks in flight and their merge.
+    The chunk size is the largest one that fits into the memory budget
+    with at least as many chunks as workers, aligned to the HDF5 chunks of
+    the file. The merged aggregates of the file (at most one code per
+    pixel or per grid box and label) are not part of the budget.
+
+    Returns DEFAULT_CHUNKSIZE if memory_budget is None.
+    """
+    if memory_budget is None:
+        return DEFAULT_CHUNKSIZE
+    budget = get_memory_budget(memory_budget)
+    nworkers = get_nworkers(None, nworkers)
+
+    with h5py.File(ipath, 'r') as file:
+        groups = [file['calipso'], get_imager_group(file, dataset)]
+        variables = [group[name] for group in groups for name in group
+                     if isinstance(group[name], h5py.Dataset)]
+        npix = file['calipso']['cloud_fraction'].shape[0]
+        h5_chunks = file['calipso']['cloud_fraction'].chunks
+        raw = sum(var.dtype.itemsize * int(np.prod(var.shape[1:]))
+                  for var in variables if var.shape[:1] == (npix,))
+    pixel_bytes = CHUNK_OVERHEAD * (raw + DECODED_VARS * 8)
+
+    def _get_bytes(chunksize):
+        nbytes = nworkers * chunksize * pixel_bytes
+        if out_size is not None:
+            nbytes += 2 * nworkers * get_partial_bytes(chunksize, out_size,
+                                                       nscenarios)
+        return nbytes
+
+    # largest chunk size within the budget, the bytes grow with it
+    low, high = 0, -(-npix // nworkers)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if _get_bytes(mid) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    chunksize = low
+    if h5_chunks is not None and chunksize > h5_chunks[0]:
+        chunksize -= chunksize % h5_chunks[0]
+    return int(max(chunksize, MIN_CHUNKSIZE))
+
+
+# storage dtype of decoded matchup variables in the sidecar cache
+# (None: keep dtype), heights and temperatures are stored as float32
+SIDECAR_DTYPES = {'caliop_cma': np.int8,
+                  'imager_cma': np.int8,
+                  'caliop_cph': np.int8,
+                  'imager_cph': np.int8,
+                  'satz': None,
+                  'sunz': None,
+                  'caliop_cth': np.float32,
+                  'imager_cth': np.float32,
+                  'caliop_ctt': np.float32,
+                  'imager_ctt': np.float32,
+                  'caliop_cflag': None,
+                  'caliop_ctype': np.uint8,
+                  'lat': None,
+                  'lon': None}
+SIDECAR_VERSION = 2
+
+
+def get_sidecar_dir(ipath, dataset):
+    return '{}.{}_cache'.format(ipath, dataset.lower())
+
+
+def get_file_hash(ipath, blocksize=2**24):
+    """ Get sha1 of file content. """
+    sha1 = hashlib.sha1()
+    with open(ipath, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _read_sidecar_meta(ipath, dataset):
+    """
+    Get sidecar cache metadata if the cache is valid for the matchup file.
+
+    The cache is valid if size and mtime of the file are unchanged, or if
+    its content hash is unchanged (e.g. after copying or touching it).
+    """
+    mfile = os.path.join(get_sidecar_dir(ipath, dataset), 'meta.json')
+    if not os.path.isfile(mfile):
+        return None
+    with open(mfile) as fh:
+        meta = json.load(fh)
+    if meta.get('version') != SIDECAR_VERSION:
+        return None
+    stat = os.stat(ipath)
+    if meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns:
+        return meta
+    if meta['size'] == stat.st_size and meta['sha1'] == get_file_hash(ipath):
+        meta['mtime_ns'] = stat.st_mtime_ns
+        _write_json(mfile, meta)
+        return meta
+    return None
+
+
+def _write_json(ofile, content):
+    tmp = ofile + '.tmp{}'.format(os.getpid())
+    with open(tmp, 'w') as fh:
+        json.dump(content, fh)
+    os.replace(tmp, ofile)
+
+
+def read_sidecar(ipath, dataset, chunksize):
+    """
+    Memory-map decoded matchup variables from the sidecar cache.
+
+    Returns (data, latlon) as load_collocated_file() or None if there is no
+    valid cache.
+    """
+    if _read_sidecar_meta(ipath, dataset) is None:
+        return None
+    cdir = get_sidecar_dir(ipath, dataset)
+    arrays = dict()
+    for var, dtype in SIDECAR_DTYPES.items():
+        values = np.load(os.path.join(cdir, var + '.npy'), mmap_mode='r')
+        arrays[var] = da.from_array(values, chunks=chunksize)
+    latlon = {'lat': arrays.pop('lat'),
+              'lon': arrays.pop('lon')}
+    return arrays, latlon
+
+
+def write_sidecar(ipath, dataset, data, latlon):
+    """
+    Decode matchup variables and store them as .npy files next to the
+    matchup file. Variables are streamed chunk by chunk into the files.
+    """
+    cdir = get_sidecar_dir(ipath, dataset)
+    os.makedirs(cdir, exist_ok=True)
+    arrays = dict(data, **latlon)
+    sources, targets = [], []
+    for var, dtype in SIDECAR_DTYPES.items():
+        values = arrays[var]
+        values = values.astype(dtype if dtype is not None else values.dtype)
+        sources.append(values)
+        targets.append(np.lib.format.open_memmap(
+                            os.path.join(cdir, var + '.npy'), mode='w+',
+                            dtype=values.dtype, shape=values.shape))
+    da.store(sources, targets, lock=True)
+    for target in targets:
+        target.flush()
+
+    stat = os.stat(ipath)
+    meta = {'version': SIDECAR_VERSION,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha1': get_file_hash(ipath),
+            'dataset': dataset}
+    _write_json(os.path.join(cdir, 'meta.json'), meta)
+
+
+def load_collocated_file(ipath, chunksize, dataset='CCI', cache=False):
+    """
+    Set up lazy, chunked reading and decoding of a matchup file.
+
+    Returns the unfiltered base arrays (including satz/sunz) from which every
+    DNT/SATZ scenario is derived with apply_scenario(). Nothing is read until
+    the arrays are computed, the file stays open as long as they are in use.
+
+    cache: use (and create if missing or outdated) a sidecar cache of the
+           decoded variables next to the matchup file
+    """
+    if cache:
+        cached = read_sidecar(ipath, dataset, chunksize)
+        if cached is not None:
+            return cached
+
+    file = h5py.File(ipath, 'r')
+    caliop = file['calipso']
+    imager = get_imager_group(file, dataset)
+
     # get CTH and CTT
-    sev_cth = da.from_array(get_imager_cth(imager), chunks=chunksize)
-    cal_cth = da.from_array(get_caliop_cth(caliop), chunks=chunksize)
-    sev_ctt = da.from_array(get_imager_ctt(imager), chunks=chunksize)
-    cal_ctt = da.from_array(get_caliop_ctt(caliop), chunks=chunksize)
-    cal_cflag = np.array(caliop['feature_classification_flags'][::, 0])
+    sev_cth = get_imager_cth(imager, chunksize)
+    cal_cth = get_caliop_cth(caliop, chunksize)
+    sev_ctt = get_imager_ctt(imager, chunksize)
+    cal_ctt = get_caliop_ctt(caliop, chunksize)
+    cal_cflag = read_lazy(caliop['feature_classification_flags'], chunksize,
+                          column=0)
+    # decode flags once into CALIPSO cloud type of top layer
+    cal_ctype = cal_cflag.map_blocks(get_calipso_cloud_type, dtype=np.uint8)
 
     # ctp_c = np.array(caliop['layer_top_pressure'])[:,0]
     # ctp_c = np.where(ctp_c == -9999, np.nan,ctp_c)
@@ -199,63 +666,14 @@ def get_collocated_file_info(ipath, chunksize, dnt='ALL',
     # cal_ctp = da.from_array(ctp_c, chunks=(chunksize))
 
     # get CMA, CPH, VZA, SZA, LAT and LON
-    sev_cph = da.from_array(get_imager_cph(imager), chunks=chunksize)
-    cal_cph = da.from_array(get_caliop_cph(caliop), chunks=chunksize)
-    cal_cma = da.from_array(get_caliop_cma(caliop), chunks=chunksize)
-    sev_cma = da.from_array(get_imager_cma(imager), chunks=chunksize)
-    satz = da.from_array(imager['satz'], chunks=chunksize)
-    sunz = da.from_array(imager['sunz'], chunks=chunksize)
-    lat = da.from_array(imager['latitude'], chunks=chunksize)
-    lon = da.from_array(imager['longitude'], chunks=chunksize)
-
-    # mask satellize zenith angle
-    if satz_lim is not None:
-        mask = satz > satz_lim
-        cal_cma = da.where(mask, np.nan, cal_cma)
-        sev_cma = da.where(mask, np.nan, sev_cma)
-        cal_cph = da.where(mask, np.nan, cal_cph)
-        sev_cph = da.where(mask, np.nan, sev_cph)
-        cal_cth = da.where(mask, np.nan, cal_cth)
-        sev_cth = da.where(mask, np.nan, sev_cth)
-        # cal_ctp = da.where(mask, np.nan, cal_ctt)
-        # sev_ctp = da.where(mask, np.nan, sev_ctt)
-    # mask all pixels except daytime
-    if dnt == 'DAY':
-        mask = sunz >= 80
-        cal_cma = da.where(mask, np.nan, cal_cma)
-        sev_cma = da.where(mask, np.nan, sev_cma)
-        cal_cph = da.where(mask, np.nan, cal_cph)
-        sev_cph = da.where(mask, np.nan, sev_cph)
-        cal_cth = da.where(mask, np.nan, cal_cth)
-        sev_cth = da.where(mask, np.nan, sev_cth)
-        # cal_ctp = da.where(mask, np.nan, cal_ctt)
-        # sev_ctp = da.where(mask, np.nan, sev_ctt)
-    # mask all pixels except nighttime
-    elif dnt == 'NIGHT':
-        mask = sunz <= 95
-        cal_cma = da.where(mask, np.nan, cal_cma)
-        sev_cma = da.where(mask, np.nan, sev_cma)
-        cal_cph = da.where(mask, np.nan, cal_cph)
-        sev_cph = da.where(mask, np.nan, sev_cph)
-        cal_cth = da.where(mask, np.nan, cal_cth)
-        sev_cth = da.where(mask, np.nan, sev_cth)
-        # cal_ctp = da.where(mask, np.nan, cal_ctt)
-        # sev_ctp = da.where(mask, np.nan, sev_ctt)
-    # mask all pixels except twilight
-    elif dnt == 'TWILIGHT':
-        mask = ~da.logical_and(sunz > 80, sunz < 95)
-        cal_cma = da.where(mask, np.nan, cal_cma)
-        sev_cma = da.where(mask, np.nan, sev_cma)
-        cal_cph = da.where(mask, np.nan, cal_cph)
-        sev_cph = da.where(mask, np.nan, sev_cph)
-        cal_cth = da.where(mask, np.nan, cal_cth)
-        sev_cth = da.where(mask, np.nan, sev_cth)
-        # cal_ctp = da.where(mask, np.nan, cal_ctt)
-        # sev_ctp = da.where(mask, np.nan, sev_ctt)
-    elif dnt == 'ALL':
-        pass
-    else:
-        raise Exception('DNT option ', dnt, ' is invalid.')
+    sev_cph = get_imager_cph(imager, chunksize)
+    cal_cph = get_caliop_cph(caliop, chunksize)
+    cal_cma = get_caliop_cma(caliop, chunksize)
+    sev_cma = get_imager_cma(imager, chunksize)
+    satz = read_lazy(imager['satz'], chunksize)
+    sunz = read_lazy(imager['sunz'], chunksize)
+    lat = read_lazy(imager['latitude'], chunksize)
+    lon = read_lazy(imager['longitude'], chunksize)
 
     data = {'caliop_cma': cal_cma,
             'imager_cma': sev_cma,
@@ -267,66 +685,378 @@ def get_collocated_file_info(ipath, chunksize, dnt='ALL',
             'imager_cth': sev_cth,
             'caliop_ctt': cal_ctt,
             'imager_ctt': sev_ctt,
-            'caliop_cflag': cal_cflag}
+            'caliop_cflag': cal_cflag,
+            'caliop_ctype': cal_ctype}
 
     latlon = {'lat': lat,
               'lon': lon}
 
+    if cache:
+        write_sidecar(ipath, dataset, data, latlon)
+        return read_sidecar(ipath, dataset, chunksize)
     return data, latlon
 
 
-def do_cma_validation(data, adef, out_size, idxs):
-    cal_cma = data['caliop_cma']
-    img_cma = data['imager_cma']
+@functools.lru_cache(maxsize=None)
+def get_area_def(area_file='areas.yaml', area_id='pc_world'):
+    """ Load area definition, parsed only once per process. """
+    return load_area(area_file, area_id)
 
-    # pattern: CALIOP_SEVIRI
-    cld_cld_a = da.logical_and(cal_cma == 1, img_cma == 1)
-    clr_cld_b = da.logical_and(cal_cma == 0, img_cma == 1)
-    cld_clr_c = da.logical_and(cal_cma == 1, img_cma == 0)
-    clr_clr_d = da.logical_and(cal_cma == 0, img_cma == 0)
-
-    cld_cld_a = cld_cld_a.astype(np.int64)
-    clr_cld_b = clr_cld_b.astype(np.int64)
-    cld_clr_c = cld_clr_c.astype(np.int64)
-    clr_clr_d = clr_clr_d.astype(np.int64)
-
-    a, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=cld_cld_a, density=False)
-    b, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=clr_cld_b, density=False)
-    c, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=cld_clr_c, density=False)
-    d, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=clr_clr_d, density=False)
-
-    n = a + b + c + d
-    n2d = n.reshape(adef.shape)
+
+def get_idxs_cache_file(ipath, adef):
+    """
+    Get path of the target index cache for a matchup file and area.
+
+    The name contains a hash of the matchup file identity (path, size,
+    mtime) and of the area definition, so a modified file or a different
+    target grid never picks up stale indices.
+    """
+    stat = os.stat(ipath)
+    key = '{}|{}|{}|{}|{}|{}'.format(os.path.realpath(ipath), stat.st_size,
+                                     stat.st_mtime_ns, adef.proj_str,
+                                     tuple(adef.area_extent), adef.shape)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return '{}.{}_{}.idxs.npy'.format(ipath, adef.area_id, digest)
+
+
+def get_target_idxs(ipath, adef, latlon, chunksize, use_cache=True):
+    """
+    Get lazy target grid index of every matchup pixel.
+
+    If use_cache is set, the indices are streamed chunk by chunk into an
+    int32 .npy file next to the matchup file and memory-mapped on
+    subsequent runs instead of being recomputed by the BucketResampler.
+    Writing a cache removes the caches of the same file and area id with
+    another digest (changed file or grid).
+    """
+    cfile = get_idxs_cache_file(ipath, adef) if use_cache else None
+    if cfile is not None and os.path.isfile(cfile):
+        idxs = np.load(cfile, mmap_mode='r')
+        return da.from_array(idxs, chunks=chunksize)
+
+    resampler = BucketResampler(adef, latlon['lon'], latlon['lat'])
+    if cfile is None:
+        return resampler.idxs
+
+    idxs = resampler.idxs.astype(np.int32)
+    tmp = cfile + '.tmp{}'.format(os.getpid())
+    try:
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int32,
+                                        shape=idxs.shape)
+        da.store(idxs, out)
+        out.flush()
+        del out
+        os.replace(tmp, cfile)
+    except OSError as err:
+        print('Could not write index cache {}: {}'.format(cfile, err))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return idxs
+    stale = glob.glob('{}.{}_*.idxs.npy'.format(glob.escape(ipath),
+                                                glob.escape(adef.area_id)))
+    for sfile in stale:
+        if sfile != cfile:
+            with contextlib.suppress(OSError):
+                os.remove(sfile)
+    return da.from_array(np.load(cfile, mmap_mode='r'), chunks=chunksize)
+
+
+def get_scenario_mask(satz, sunz, dnt='ALL', satz_lim=None):
+    """
+    Get lazy mask of pixels excluded by a DNT/SATZ scenario.
+
+    Returns None if no pixel is excluded.
+    """
+    mask = None
+    # mask satellize zenith angle
+    if satz_lim is not None:
+        mask = satz > satz_lim
+
+    # mask all pixels except daytime
+    if dnt == 'DAY':
+        dnt_mask = sunz >= 80
+    # mask all pixels except nighttime
+    elif dnt == 'NIGHT':
+        dnt_mask = sunz <= 95
+    # mask all pixels except twilight
+    elif dnt == 'TWILIGHT':
+        dnt_mask = ~da.logical_and(sunz > 80, sunz < 95)
+    elif dnt == 'ALL':
+        dnt_mask = None
+    else:
+        raise Exception('DNT option ', dnt, ' is invalid.')
+
+    if dnt_mask is not None:
+        mask = dnt_mask if mask is None else da.logical_or(mask, dnt_mask)
+    return mask
+
+
+def apply_scenario(data, dnt='ALL', satz_lim=None):
+    """
+    Filter base arrays from load_collocated_file() for one DNT/SATZ scenario.
+
+    The base arrays are shared between scenarios and left unchanged, the
+    scenario is applied as a single boolean validity mask 'valid' (None if
+    all pixels are valid) which the validation kernels combine with their
+    own masks.
+    """
+    mask = get_scenario_mask(data['satz'], data['sunz'], dnt, satz_lim)
+    scenario = dict(data)
+    scenario['valid'] = None if mask is None else ~mask
+    return scenario
+
+
+def get_collocated_file_info(ipath, chunksize, dnt='ALL',
+                             satz_lim=None, dataset='CCI'):
+    data, latlon = load_collocated_file(ipath, chunksize, dataset)
+    return apply_scenario(data, dnt, satz_lim), latlon
+
+
+# extra grouping dimension of the aggregates: number of bins of the local
+# solar hour, UTC day of month and solar zenith angle (10 deg bins)
+BINNINGS = {'hour': 24, 'day': 31, 'sunz': 18}
+# binnings needing the pixel time (see read_pixel_time)
+TIME_BINNINGS = ['hour', 'day']
+
+
+def read_pixel_time(ipath, dataset, chunksize):
+    """ Set up lazy reading of the pixel time [seconds since 1970]. """
+    file = h5py.File(ipath, 'r')
+    groups = {'calipso': file['calipso'],
+              'imager': get_imager_group(file, dataset)}
+    for group, name in TIME_VARS:
+        if name in groups[group]:
+            return read_lazy(groups[group][name], chunksize)
+    raise Exception('No pixel time in {}'.format(ipath))
+
+
+def _pixel_bins(values, lon=None, binning='hour'):
+    """ Get bin of every pixel, -1 for invalid values. """
+    values = np.asarray(values, dtype=np.float64)
+    if binning == 'sunz':
+        valid = np.logical_and(values >= 0, values <= 180)
+        bins = np.minimum(values // 10, BINNINGS['sunz'] - 1)
+    else:
+        valid = np.logical_and(np.isfinite(values), values > 0)
+        seconds = np.where(valid, values, 0)
+        if binning == 'hour':
+            valid &= np.isfinite(lon)
+            hour = (seconds % 86400) / 3600 + np.where(valid, lon, 0) / 15
+            bins = np.floor(hour % 24)
+        elif binning == 'day':
+            days = seconds.astype('datetime64[s]').astype('datetime64[D]')
+            bins = (days - days.astype('datetime64[M]')).astype(np.int64)
+        else:
+            raise Exception('Binning {} not known!'.format(binning))
+    return np.where(valid, bins, -1).astype(np.int64)
+
+
+def _binned_idxs(bins, idxs, size=None):
+    valid = np.logical_and(idxs >= 0, idxs < size) & (bins >= 0)
+    return np.where(valid, bins * size + idxs, -1)
+
+
+def get_binned_idxs(data, latlon, idxs, size, binning):
+    """
+    Get lazy combined (bin, grid box) index bin * size + grid index of
+    every pixel, -1 for pixels without valid bin or outside of the grid.
+
+    Reducing with these indices and nbins * size grid boxes gives all
+    aggregates of every bin in a single pass (see select_bins).
+
+    binning: key of BINNINGS; 'hour' and 'day' need data['time']
+    """
+    if binning not in BINNINGS:
+        raise Exception('Binning {} not known!'.format(binning))
+    if binning == 'sunz':
+        bins = da.map_blocks(_pixel_bins, data['sunz'], binning=binning,
+                             dtype=np.int64)
+    else:
+        lon = da.asarray(latlon['lon']).rechunk(data['time'].chunks)
+        bins = da.map_blocks(_pixel_bins, data['time'], lon,
+                             binning=binning, dtype=np.int64)
+    return da.map_blocks(_binned_idxs, bins,
+                         da.asarray(idxs).rechunk(bins.chunks),
+                         size=size, dtype=np.int64)
+
+
+def get_bin_label(binning, bins):
+    """ Name of a selection of bins, e.g. HOUR-06, DAY-01+02, SUNZ-080. """
+    fmt = {'hour': '{:02d}', 'day': '{:02d}', 'sunz': '{:03d}'}[binning]
+    # days are counted from 1, sunz bins are named by their lower edge
+    offset, scale = {'hour': (0, 1), 'day': (1, 1), 'sunz': (0, 10)}[binning]
+    return '{}-{}'.format(binning.upper(), '+'.join(
+                              fmt.format(int(b) * scale + offset)
+                              for b in bins))
+
+
+# default satz limits [deg] resolved by the stratified accumulators, and
+# sunz edges [deg]: the DAY/NIGHT/TWILIGHT limits of get_scenario_mask
+STRATA_SATZ = (10, 20, 30, 40, 50, 60, 70, 80)
+STRATA_SUNZ = (80, 95)
+
+
+def get_nstrata(satz_edges):
+    """ Number of (satz, sunz) strata, see _strata_codes. """
+    return (len(satz_edges) + 2) * (2 * len(STRATA_SUNZ) + 2)
+
+
+def _strata_codes(satz, sunz, satz_edges=None):
+    """
+    Get the (satz, sunz) stratum of every pixel.
+
+    satz strata are (-inf, e0], (e0, e1], ..., (e_n, inf) and NaN, so
+    satz <= e_i is a sum over strata. sunz strata are (-inf, e0), e0,
+    (e0, e1), e1, ..., (e_n, inf) and NaN, so every strict or non-strict
+    sunz limit on an edge is exact.
+    """
+    satz_edges = np.asarray(satz_edges, dtype=np.float64)
+    sunz_edges = np.asarray(STRATA_SUNZ, dtype=np.float64)
+    isatz = np.searchsorted(satz_edges, satz, side='left')
+    isatz[np.isnan(satz)] = satz_edges.size + 1
+    isunz = np.searchsorted(sunz_edges, sunz, side='left')
+    on_edge = sunz_edges[np.minimum(isunz, sunz_edges.size - 1)] == sunz
+    isunz = 2 * isunz + on_edge
+    isunz[np.isnan(sunz)] = 2 * sunz_edges.size + 1
+    return isatz.astype(np.int64) * (2 * sunz_edges.size + 2) + isunz
+
+
+def get_strata_codes(data, satz_edges):
+    """ Get lazy (satz, sunz) stratum of every pixel. """
+    return da.map_blocks(_strata_codes, data['satz'], data['sunz'],
+                         satz_edges=tuple(satz_edges), dtype=np.int64)
+
+
+def get_stratified_idxs(data, idxs, size, satz_edges):
+    """
+    Get lazy combined (stratum, grid box) index stratum * size + grid
+    index of every pixel, -1 outside of the grid (see _strata_codes).
+
+    Reducing all pixels with these indices and get_nstrata() * size grid
+    boxes (see get_stratified_parts) gives the aggregates of every DNT/SATZ
+    scenario as sums over strata (see select_strata) in a single pass.
+    """
+    codes = get_strata_codes(data, satz_edges)
+    return da.map_blocks(_binned_idxs, codes,
+                         da.asarray(idxs).rechunk(codes.chunks),
+                         size=size, dtype=np.int64)
+
+
+def get_strata_selection(satz_edges, dnt='ALL', satz_lim=None):
+    """
+    Get mask of the (satz, sunz) strata of a DNT/SATZ scenario.
+
+    The scenario mask is evaluated on one representative value of every
+    stratum: the upper edge of the satz strata and the edge itself or the
+    middle of the sunz strata.
+    """
+    if satz_lim is not None and satz_lim not in satz_edges:
+        raise Exception('SATZ limit {} is not resolved by the strata '
+                        '{}'.format(satz_lim, tuple(satz_edges)))
+    edges = list(satz_edges)
+    satz = np.array(edges + [edges[-1] + 1, np.nan])
+    edges = [-np.inf] + list(STRATA_SUNZ) + [np.inf]
+    sunz = []
+    for lower, upper in zip(edges[:-1], edges[1:]):
+        sunz.append(lower + 1 if upper == np.inf else
+                    upper - 1 if lower == -np.inf else (lower + upper) / 2)
+        sunz.append(upper)
+    sunz[-1] = np.nan
+    satz, sunz = np.meshgrid(satz, np.array(sunz), indexing='ij')
+    mask = get_scenario_mask(satz, sunz, dnt, satz_lim)
+    selection = np.ones(satz.shape, dtype=bool) if mask is None else ~mask
+    return selection.ravel()
+
+
+def _contingency_codes(cal, img, idxs, valid=None, out_size=None):
+    """
+    Encode target grid index and contingency category of every pixel.
+
+    Categories (pattern CALIOP_IMAGER): 0=a (1_1), 1=b (0_1), 2=c (1_0),
+    3=d (0_0). Pixels with invalid values, outside of the target grid or
+    not valid (scenario mask) get the overflow code 4 * out_size.
+    """
+    labels = _contingency_labels(cal, img, valid)
+    valid = np.logical_and(idxs >= 0, idxs < out_size) & (labels < 4)
+    codes = idxs.astype(np.int64) * 4 + labels
+    return np.where(valid, codes, 4 * out_size)
+
+
+def _contingency_labels(cal, img, valid=None):
+    """ Get contingency category of every pixel (see above), 4 if invalid. """
+    cal_clr = cal == 0
+    img_clr = img == 0
+    valid = np.ones(cal.shape, dtype=bool) if valid is None else valid.copy()
+    valid &= np.logical_or(cal == 1, cal_clr)
+    valid &= np.logical_or(img == 1, img_clr)
+    return np.where(valid, 2 * img_clr + cal_clr, 4).astype(np.uint8)
+
+
+def get_contingency_table(cal, img, idxs, out_size, valid=None):
+    """
+    Get contingency table counts a, b, c, d for every target grid box.
+
+    The whole table is obtained with a single bincount over the encoded
+    (grid index, category) of each pixel instead of one histogram per
+    category.
+
+    valid: optional mask of pixels to include (see apply_scenario)
+    """
+    arrays = [da.asarray(cal), da.asarray(img), da.asarray(idxs)]
+    if valid is not None:
+        arrays.append(da.asarray(valid))
+    codes = da.map_blocks(_contingency_codes, *arrays,
+                          out_size=out_size, dtype=np.int64)
+    counts = da.bincount(codes, minlength=4 * out_size + 1)
+    table = counts[:4 * out_size].reshape(out_size, 4).T
+    return table[0], table[1], table[2], table[3]
+
+
+# contingency scores: (name of the score in scores.SCORES, plot label with
+# the category names filled in, vmin, vmax, colormap)
+CONTINGENCY_SCORES = [('hitrate', 'Hitrate', 0.5, 1, 'rainbow'),
+                      ('pod_clr', 'POD{0}', 0.5, 1, 'rainbow'),
+                      ('pod_cld', 'POD{1}', 0.5, 1, 'rainbow'),
+                      ('far_clr', 'FAR{0}', 0, 1, 'rainbow'),
+                      ('far_cld', 'FAR{1}', 0, 1, 'rainbow'),
+                      ('pofd_clr', 'POFD{0}', 0, 1, 'rainbow'),
+                      ('pofd_cld', 'POFD{1}', 0, 1, 'rainbow'),
+                      ('heidke', 'Heidke', 0, 1, 'rainbow'),
+                      ('kuiper', 'Kuiper', 0, 1, 'rainbow'),
+                      ('bias', 'Bias', 0, 1, 'bwr'),
+                      ('mean_cal', 'CALIOP mean', None, None, 'rainbow'),
+                      ('mean_img', 'SEVIRI mean', None, None, 'rainbow')]
+
+
+def get_contingency_scores(a, b, c, d, shape, lbl_0, lbl_1,
+                           dtype=np.float64):
+    """
+    Calculate scores from contingency table counts of every grid box.
+
+    All scores are calculated in one sweep over the stacked table (see
+    scores.get_batch_scores), block-wise for dask arrays.
+
+    lbl_0/lbl_1: names of the 0 and 1 category (e.g. clr/cld, liq/ice)
+    dtype:       float type of the scores
+    """
+    names = [score[0] for score in CONTINGENCY_SCORES]
+    if any(isinstance(x, da.Array) for x in (a, b, c, d)):
+        table = da.stack([da.asarray(x) for x in (a, b, c, d)])
+        table = table.reshape((4,) + tuple(shape)).rechunk({0: 4})
+        n2d = table.sum(axis=0)
+        # dtype is passed with partial, map_blocks would consume it
+        func = functools.partial(get_batch_scores, names=names, dtype=dtype)
+        stacked = table.map_blocks(func, dtype=dtype,
+                                   chunks=((len(names),),) + table.chunks[1:])
+    else:
+        table = np.stack([a, b, c, d]).reshape((4,) + tuple(shape))
+        n2d = table.sum(axis=0)
+        stacked = get_batch_scores(table, names, dtype)
 
     scores = dict()
-    scores['Hitrate'] = [hitrate(a, d, n).reshape(adef.shape),
-                         0.5, 1, 'rainbow']
-    scores['PODclr'] = [pod_clr(b, d).reshape(adef.shape),
-                        0.5, 1, 'rainbow']
-    scores['PODcld'] = [pod_cld(a, c).reshape(adef.shape),
-                        0.5, 1, 'rainbow']
-    scores['FARclr'] = [far_clr(c, d).reshape(adef.shape),
-                        0, 1, 'rainbow']
-    scores['FARcld'] = [far_cld(a, b).reshape(adef.shape),
-                        0, 1, 'rainbow']
-    scores['POFDclr'] = [pofd_clr(a, c).reshape(adef.shape),
-                         0, 1, 'rainbow']
-    scores['POFDcld'] = [pofd_cld(b, d).reshape(adef.shape),
-                         0, 1, 'rainbow']
-    scores['Heidke'] = [heidke(a, b, c, d).reshape(adef.shape),
-                        0, 1, 'rainbow']
-    scores['Kuiper'] = [kuiper(a, b, c, d).reshape(adef.shape),
-                        0, 1, 'rainbow']
-    scores['Bias'] = [bias(b, c, n).reshape(adef.shape),
-                      0, 1, 'bwr']
-    scores['CALIOP mean'] = [mean(a, c, n).reshape(adef.shape),
-                             None, None, 'rainbow']
-    scores['SEVIRI mean'] = [mean(a, b, n).reshape(adef.shape),
-                             None, None, 'rainbow']
+    for values, (_, label, vmin, vmax, cmap) in zip(stacked,
+                                                    CONTINGENCY_SCORES):
+        scores[label.format(lbl_0, lbl_1)] = [values, vmin, vmax, cmap]
     scores['Nobs'] = [n2d, None, None, 'rainbow']
 
     scores['Bias'][2] = np.nanmax(np.abs(scores['Bias'][0])) / 2
@@ -334,71 +1064,99 @@ def do_cma_validation(data, adef, out_size, idxs):
     return scores
 
 
-def do_cph_validation(data, adef, out_size, idxs):
-    cal_cph = data['caliop_cph']
-    img_cph = data['imager_cph']
+# contingency scores with bootstrap confidence intervals
+CI_SCORES = ['hitrate', 'kuiper', 'heidke', 'bias']
+CI_LEVEL = 0.95
 
-    # pattern: CALIOP_SEVIRI
-    # get counts for contigency table
-    ice_ice_a = da.logical_and(cal_cph == 1, img_cph == 1)
-    liq_ice_b = da.logical_and(cal_cph == 0, img_cph == 1)
-    ice_liq_c = da.logical_and(cal_cph == 1, img_cph == 0)
-    liq_liq_d = da.logical_and(cal_cph == 0, img_cph == 0)
-    ice_ice_a = ice_ice_a.astype(np.int64)
-    liq_ice_b = liq_ice_b.astype(np.int64)
-    ice_liq_c = ice_liq_c.astype(np.int64)
-    liq_liq_d = liq_liq_d.astype(np.int64)
-
-    # use histogram functionality to get contigency table summed up for every
-    # grid box in target grid
-    a, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=ice_ice_a, density=False)
-    b, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=liq_ice_b, density=False)
-    c, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=ice_liq_c, density=False)
-    d, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=liq_liq_d, density=False)
-
-    n = a + b + c + d
-    n2d = n.reshape(adef.shape)
 
-    # calculate scores
-    scores = dict()
-    scores['Hitrate'] = [hitrate(a, d, n).reshape(adef.shape),
-                         0.5, 1, 'rainbow']
-    scores['PODliq'] = [pod_clr(b, d).reshape(adef.shape),
-                        0.5, 1, 'rainbow']
-    scores['PODice'] = [pod_cld(a, c).reshape(adef.shape),
-                        0.5, 1, 'rainbow']
-    scores['FARliq'] = [far_clr(c, d).reshape(adef.shape),
-                        0, 1, 'rainbow']
-    scores['FARice'] = [far_cld(a, b).reshape(adef.shape),
-                        0, 1, 'rainbow']
-    scores['POFDliq'] = [pofd_clr(a, c).reshape(adef.shape),
-                         0, 1, 'rainbow']
-    scores['POFDice'] = [pofd_cld(b, d).reshape(adef.shape),
-                         0, 1, 'rainbow']
-    scores['Heidke'] = [heidke(a, b, c, d).reshape(adef.shape),
-                        0, 1, 'rainbow']
-    scores['Kuiper'] = [kuiper(a, b, c, d).reshape(adef.shape),
-                        0, 1, 'rainbow']
-    scores['Bias'] = [bias(b, c, n).reshape(adef.shape),
-                      0, 1, 'bwr']
-    scores['CALIOP mean'] = [mean(a, c, n).reshape(adef.shape),
-                             None, None, 'rainbow']
-    scores['SEVIRI mean'] = [mean(a, b, n).reshape(adef.shape),
-                             None, None, 'rainbow']
-    scores['Nobs'] = [n2d, None, None, 'rainbow']
+def _bootstrap_block(table, nboot, seed, block_info=None):
+    # every block of grid boxes gets its own random stream
+    loc = block_info[0]['chunk-location'] if block_info else ()
+    return get_bootstrap_ci(table, CI_SCORES, nboot, CI_LEVEL,
+                            [seed, *loc])
 
-    scores['Bias'][2] = np.nanmax(np.abs(scores['Bias'][0])) / 2
-    scores['Bias'][1] = scores['Bias'][2] * (-1)
 
-    return scores
+def get_contingency_ci(table, shape, nboot=200, seed=0):
+    """
+    Get lazy bootstrap confidence intervals (CI_LEVEL) of CI_SCORES of
+    every grid box from contingency table counts (4, size), see
+    scores.get_bootstrap_ci. Only the counts are resampled, not the pixels.
 
+    Returns array (len(CI_SCORES), 2, ny, nx) of lower/upper bounds.
+    """
+    table = da.asarray(table).reshape((4,) + tuple(shape)).rechunk({0: 4})
+    return table.map_blocks(_bootstrap_block, nboot=nboot, seed=seed,
+                            dtype=np.float32, new_axis=1,
+                            chunks=((len(CI_SCORES),), (2,)) +
+                            table.chunks[1:])
 
-def do_ctth_validation(data, resampler, thrs=10):
-    """ thrs: threshold value for filtering boxes with small number of obs """
+
+def do_cma_validation(data, adef, out_size, idxs):
+    cal_cma = data['caliop_cma']
+    img_cma = data['imager_cma']
+
+    # pattern: CALIOP_SEVIRI
+    a, b, c, d = get_contingency_table(cal_cma, img_cma, idxs, out_size,
+                                       data.get('valid'))
+    return get_contingency_scores(a, b, c, d, adef.shape, 'clr', 'cld')
+
+
+def do_cph_validation(data, adef, out_size, idxs):
+    cal_cph = data['caliop_cph']
+    img_cph = data['imager_cph']
+
+    # pattern: CALIOP_SEVIRI
+    # get contigency table summed up for every grid box in target grid
+    a, b, c, d = get_contingency_table(cal_cph, img_cph, idxs, out_size,
+                                       data.get('valid'))
+    return get_contingency_scores(a, b, c, d, adef.shape, 'liq', 'ice')
+
+
+# labels of the grouped CTTH reduction: CALIPSO cloud type 0-7 of pixels
+# with detected height, 8 detected height but no CALIPSO cloud type,
+# 9 no detected height
+CTTH_NLABELS = 10
+# cloud classes as sets of labels
+CTTH_CLASSES = {'all': tuple(range(9)),
+                'low': (0, 1, 2, 3),
+                'mid': (4, 5),
+                'high': (6, 7),
+                # low+opaque, mid/high+transparent
+                'mid_high_tp': (4, 6),
+                'low_op': (1, 2)}
+# CTTH variables averaged per grid box: (pixel variable, cloud class of the
+# included pixels, cloud class whose number of matched cases is used to
+# filter the average); None: all pixels / no filtering
+CTTH_VARS = {'imager_cth': ('imager_cth', None, None),
+             'caliop_cth': ('caliop_cth', None, None),
+             'height_bias': ('height_bias', None, 'all'),
+             'height_mae': ('height_mae', None, 'all'),
+             'temperature_bias': ('temperature_bias', None, 'all'),
+             'height_bias_low': ('height_bias', 'low', 'low'),
+             'temperature_bias_low': ('temperature_bias', 'low', 'low'),
+             'height_bias_mid': ('height_bias', 'mid', 'mid'),
+             'height_bias_high': ('height_bias', 'high', 'high'),
+             'height_bias_mid_high_tp': ('height_bias', 'mid_high_tp',
+                                         'mid_high_tp'),
+             'height_bias_low_op': ('height_bias', 'low_op', 'low_op')}
+
+
+def _get_ctth_labels(ctype, detected_height, valid=None):
+    labels = np.where(ctype == 255, 8, ctype)
+    labels = np.where(detected_height, labels, 9).astype(np.uint8)
+    # pixels excluded by the scenario are not part of any group
+    if valid is not None:
+        labels[~valid] = CTTH_NLABELS
+    return labels
+
+
+def get_ctth_arrays(data):
+    """
+    Get per pixel CTTH variables and cloud class labels.
+
+    Variables are NaN wherever they do not contribute to the average,
+    pixels excluded by the scenario get the label CTTH_NLABELS.
+    """
     # mask of detected ctth
     detected_clouds = da.logical_and(data['caliop_cma'] == 1,
                                      data['imager_cma'] == 1)
@@ -406,125 +1164,715 @@ def do_ctth_validation(data, resampler, thrs=10):
                                      np.isfinite(data['imager_cth']))
     detected_temperature = np.logical_and(detected_clouds,
                                           np.isfinite(data['imager_ctt']))
-    detected_height_mask = detected_height.astype(int)
 
     # calculate bias and mea for all ctth cases
     delta_h = data['imager_cth'] - data['caliop_cth']  # HEIGHT
     height_bias = np.where(detected_height, delta_h, np.nan)
-    mae = np.abs(height_bias)
     delta_t = data['imager_ctt'] - data['caliop_ctt']  # TEMPERATURE
     temperature_bias = np.where(detected_temperature, delta_t, np.nan)
 
     # clouds levels (from calipso 'cloud type')
-    low_clouds = get_calipso_low_clouds(data['caliop_cflag'])
-    detected_low = np.logical_and(detected_height, low_clouds)
-    bias_low = np.where(detected_low, height_bias, np.nan)
-    bias_temperature_low = np.where(detected_low, temperature_bias, np.nan)
-    mid_clouds = get_calipso_medium_clouds(data['caliop_cflag'])
-    detected_mid = np.logical_and(detected_height, mid_clouds)
-    bias_mid = np.where(detected_mid, height_bias, np.nan)
-    high_clouds = get_calipso_high_clouds(data['caliop_cflag'])
-    detected_high = np.logical_and(detected_height, high_clouds)
-    bias_high = np.where(detected_high, height_bias, np.nan)
-    # opaque/transparent clouds (from calipso 'cloud type')
-    # tp_clouds = get_calipso_tp(data['caliop_cflag'])
-    # detected_tp = np.logical_and(detected_height,tp_clouds)
-    # bias_tp = np.where(detected_tp, height_bias, np.nan)
-    # op_clouds = get_calipso_op(data['caliop_cflag'])
-    # detected_op = np.logical_and(detected_height,op_clouds)
-    # bias_op = np.where(detected_op, height_bias, np.nan)
-    # low+opaque, mid/high+transparent
-    mid_high_tp_clouds = get_calipso_medium_and_high_clouds_tp(
-                                                data['caliop_cflag']
-                                                )
-    detected_mid_high_tp = np.logical_and(detected_height, mid_high_tp_clouds)
-    bias_mid_high_tp = np.where(detected_mid_high_tp, height_bias, np.nan)
-    low_op_clouds = get_calipso_low_clouds_op(data['caliop_cflag'])
-    detected_low_op = np.logical_and(detected_height, low_op_clouds)
-    bias_low_op = np.where(detected_low_op, height_bias, np.nan)
-
-    # resample and filter some data out
-    # N = resampler.get_count()
-    n_matched_cases = resampler.get_sum(detected_height_mask)
-    sev_cth_average = resampler.get_average(data['imager_cth'])
-    cal_cth_average = resampler.get_average(data['caliop_cth'])
-    bias_average = resampler.get_average(height_bias)
-    bias_average = np.where(n_matched_cases < thrs, np.nan, bias_average)
-    mae_average = resampler.get_average(mae)
-    mae_average = np.where(n_matched_cases < thrs, np.nan, mae_average)
-    bias_temperature_average = resampler.get_average(temperature_bias)
-    bias_temperature_average = np.where(n_matched_cases < thrs, np.nan,
-                                        bias_temperature_average)
-
-    n_matched_cases_low = resampler.get_sum(detected_low.astype(int))
-    bias_low_average = resampler.get_average(bias_low)
-    bias_low_average = np.where(n_matched_cases_low < thrs,
-                                np.nan, bias_low_average)
-    bias_temperature_low_average = resampler.get_average(bias_temperature_low)
-    bias_temperature_low_average = np.where(n_matched_cases_low < thrs, np.nan,
-                                            bias_temperature_low_average)
-    n_matched_cases_mid = resampler.get_sum(detected_mid.astype(int))
-    bias_mid_average = resampler.get_average(bias_mid)
-    bias_mid_average = np.where(n_matched_cases_mid < thrs, np.nan,
-                                bias_mid_average)
-    n_matched_cases_high = resampler.get_sum(detected_high.astype(int))
-    bias_high_average = resampler.get_average(bias_high)
-    bias_high_average = np.where(n_matched_cases_high < thrs, np.nan,
-                                 bias_high_average)
-
-    # n_matched_cases_tp = resampler.get_sum(detected_tp.astype(int))
-    # bias_tp_average = resampler.get_average(bias_tp)
-    # bias_tp_average = np.where(n_matched_cases_tp<thrs,
-    # np.nan, bias_tp_average)
-    # n_matched_cases_op = resampler.get_sum(detected_op.astype(int))
-    # bias_op_average = resampler.get_average(bias_op)
-    # bias_op_average = np.where(n_matched_cases_op<thrs,
-    # np.nan, bias_op_average)
-
-    n_matched_cases_mid_high_tp = resampler.get_sum(
-                                        detected_mid_high_tp.astype(int)
-                                        )
-    bias_mid_high_tp_average = resampler.get_average(bias_mid_high_tp)
-    bias_mid_high_tp_average = np.where(n_matched_cases_mid_high_tp < thrs,
-                                        np.nan, bias_mid_high_tp_average)
-    n_matched_cases_low_op = resampler.get_sum(detected_low_op.astype(int))
-    bias_low_op_average = resampler.get_average(bias_low_op)
-    bias_low_op_average = np.where(n_matched_cases_low_op < thrs,
-                                   np.nan, bias_low_op_average)
+    arrays = [da.asarray(data['caliop_ctype']), detected_height]
+    if data.get('valid') is not None:
+        arrays.append(da.asarray(data['valid']))
+    labels = da.map_blocks(_get_ctth_labels, *arrays, dtype=np.uint8)
+
+    variables = dict()
+    variables['imager_cth'] = data['imager_cth']
+    variables['caliop_cth'] = data['caliop_cth']
+    variables['height_bias'] = height_bias
+    variables['height_mae'] = np.abs(height_bias)
+    variables['temperature_bias'] = temperature_bias
+    return variables, labels
+
+
+# codes are compacted by counting if their range is at most this many times
+# their number, else by sorting (see _compact_codes)
+COMPACT_RANGE = 4
+
+
+def _compact_codes(codes):
+    """
+    Get the sorted unique codes and the position of every code in them as
+    np.unique(codes, return_inverse=True). Codes spanning up to
+    COMPACT_RANGE times their number are counted instead of sorted, so
+    temporaries stay proportional to the number of codes.
+    """
+    size = int(codes.max()) + 1 if codes.size > 0 else 0
+    if size > COMPACT_RANGE * codes.size:
+        return np.unique(codes, return_inverse=True)
+    occupied = np.bincount(codes, minlength=size) > 0
+    position = np.cumsum(occupied) - 1
+    return np.flatnonzero(occupied), position[codes]
+
+
+def _grouped_chunk(labels, idxs, *variables, out_size, nlabels):
+    """
+    Sparse statistics of one chunk for every occurring (label, grid box).
+
+    Returns the occurring codes grid index * nlabels + label and an array
+    with the number of pixels followed by count, sum and sum of squares of
+    the finite values of every variable.
+    """
+    valid = np.logical_and(idxs >= 0, idxs < out_size)
+    valid &= labels < nlabels
+    codes = idxs[valid].astype(np.int64) * nlabels + labels[valid]
+    ucodes, inverse = _compact_codes(codes)
+    nvar = len(variables)
+    stats = np.empty((1 + 3 * nvar, ucodes.size))
+    stats[0] = np.bincount(inverse, minlength=ucodes.size)
+    for cnt, x in enumerate(variables):
+        x = x[valid]
+        finite = np.isfinite(x)
+        inv = inverse[finite]
+        x = x[finite]
+        stats[1 + cnt] = np.bincount(inv, minlength=ucodes.size)
+        stats[1 + nvar + cnt] = np.bincount(inv, weights=x,
+                                            minlength=ucodes.size)
+        stats[1 + 2 * nvar + cnt] = np.bincount(inv, weights=x * x,
+                                                minlength=ucodes.size)
+    return ucodes, stats
+
+
+def _grouped_combine(*parts):
+    """ Merge sparse chunk statistics by summing up equal codes. """
+    codes = np.concatenate([p[0] for p in parts])
+    stats = np.concatenate([p[1] for p in parts], axis=1)
+    ucodes, inverse = _compact_codes(codes)
+    merged = np.empty((stats.shape[0], ucodes.size))
+    for row in range(stats.shape[0]):
+        merged[row] = np.bincount(inverse, weights=stats[row],
+                                  minlength=ucodes.size)
+    return ucodes, merged
+
+
+def _grouped_finalize(part, out_size, nlabels, nvar, groups, pairs):
+    """ Sum sparse statistics over label groups onto the target grid. """
+    codes, stats = part
+    cells, labels = np.divmod(codes, nlabels)
+
+    def _to_grid(row, group):
+        sel = slice(None) if group is None else np.isin(labels, group)
+        return np.bincount(cells[sel], weights=stats[row][sel],
+                           minlength=out_size)
+
+    npix = np.stack([_to_grid(0, g) for g in groups])
+    result = [npix.astype(np.int64)]
+    for offset in range(3):
+        result.append(np.stack([_to_grid(1 + offset * nvar + ivar, g)
+                                for ivar, g in pairs]))
+    result[1] = result[1].astype(np.int64)
+    return tuple(result)
+
+
+def get_grouped_stats(variables, labels, idxs, out_size, nlabels,
+                      groups, pairs, fan_in=8):
+    """
+    Per grid box statistics of several variables grouped by a pixel label,
+    obtained in a single pass over the pixels.
+
+    variables: list of 1D arrays
+    labels:    integer label (0 <= label < nlabels) of every pixel
+    groups:    list of label collections (None: all labels) for which the
+               number of pixels is returned
+    pairs:     list of (variable index, label collection) for which count,
+               sum and sum of squares of the finite values are returned
+
+    Every chunk is reduced to sparse statistics of its occurring (grid box,
+    label) codes, merged in a tree with the given fan-in (see
+    get_grouped_part) and summed over the label groups onto the grid once,
+    so the partials in flight are bounded by the pixels of the chunks and
+    not by out_size. Returns lazy arrays npix (len(groups), out_size) and
+    count, sum, sumsq (len(pairs), out_size).
+    """
+    part = get_grouped_part(variables, labels, idxs, out_size, nlabels,
+                            fan_in)
+    stats = dask.delayed(_grouped_finalize, nout=4)(
+                part, out_size, nlabels, len(variables), groups, pairs)
+    nrows = [len(groups)] + 3 * [len(pairs)]
+    dtypes = [np.int64, np.int64, np.float64, np.float64]
+    return [da.from_delayed(values, (n, out_size), dtype)
+            for values, n, dtype in zip(stats, nrows, dtypes)]
+
+
+def get_grouped_part(variables, labels, idxs, out_size, nlabels, fan_in=8):
+    """
+    Get the merged sparse statistics (codes, stats) of all occurring
+    (grid box, label) codes as delayed object (see get_grouped_stats).
+    """
+    labels = da.asarray(labels)
+    arrays = [da.asarray(idxs).rechunk(labels.chunks)]
+    arrays += [da.asarray(x).rechunk(labels.chunks) for x in variables]
+    # unoptimized, so tasks shared with other collections are not fused
+    # into copies computed several times
+    blocks = zip(labels.to_delayed(optimize_graph=False),
+                 *[arr.to_delayed(optimize_graph=False) for arr in arrays])
+    chunk = dask.delayed(_grouped_chunk, nout=2, pure=True)
+    parts = [dask.delayed(tuple)(chunk(*b, out_size=out_size,
+                                       nlabels=nlabels))
+             for b in blocks]
+    while len(parts) > 1:
+        parts = [dask.delayed(_grouped_combine)(*parts[i:i + fan_in])
+                 for i in range(0, len(parts), fan_in)]
+    return parts[0]
+
+
+def _get_ctth_pixel_vars():
+    """ Names of the pixel variables of CTTH_VARS. """
+    return list(dict.fromkeys(var for var, _, _ in CTTH_VARS.values()))
+
+
+def _get_ctth_groups(names):
+    """ Label groups and (variable, label group) pairs of CTTH_VARS. """
+    groups = list(CTTH_CLASSES.values())
+    pairs = [(names.index(var), None if cls is None else CTTH_CLASSES[cls])
+             for var, cls, _ in CTTH_VARS.values()]
+    return groups, pairs
+
+
+def get_ctth_aggregates(data, idxs, out_size):
+    """ Get lazy CTTH partial aggregates (see get_aggregates). """
+    variables, labels = get_ctth_arrays(data)
+    names = list(variables)
+    groups, pairs = _get_ctth_groups(names)
+    npix, count, sums, sumsq = get_grouped_stats(
+                                    [variables[v] for v in names], labels,
+                                    idxs, out_size, CTTH_NLABELS,
+                                    groups, pairs)
+    agg = dict()
+    agg['ctth_nmatch'] = npix
+    agg['ctth_count'] = count
+    agg['ctth_sum'] = sums
+    agg['ctth_sumsq'] = sumsq
+    return agg
+
+
+def get_ctth_scores(agg, shape, thrs=10):
+    """
+    Calculate CTTH scores from partial aggregates.
+
+    thrs: threshold value for filtering boxes with small number of obs
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        averages = agg['ctth_sum'] / agg['ctth_count']
+    averages = np.where(agg['ctth_count'] == 0, np.nan, averages)
+
+    nmatch = dict()
+    for cnt, cls in enumerate(CTTH_CLASSES):
+        nmatch[cls] = agg['ctth_nmatch'][cnt].reshape(shape)
+
+    avg = dict()
+    for cnt, (var, (_, _, cls)) in enumerate(CTTH_VARS.items()):
+        avg[var] = averages[cnt].reshape(shape)
+        if cls is not None:
+            avg[var] = np.where(nmatch[cls] < thrs, np.nan, avg[var])
 
     # calculate scores
     scores = dict()
-    scores['Bias CTH'] = [bias_average, -4000, 4000, 'bwr']
-    scores['MAE CTH'] = [mae_average, 0, 2500, 'Reds']
+    scores['Bias CTH'] = [avg['height_bias'], -4000, 4000, 'bwr']
+    scores['MAE CTH'] = [avg['height_mae'], 0, 2500, 'Reds']
 
-    scores['Bias low'] = [bias_low_average, -2000, 2000, 'bwr']
-    scores['Bias middle'] = [bias_mid_average, -2000, 2000, 'bwr']
-    scores['Bias high'] = [bias_high_average, -6000, 6000, 'bwr']
+    scores['Bias low'] = [avg['height_bias_low'], -2000, 2000, 'bwr']
+    scores['Bias middle'] = [avg['height_bias_mid'], -2000, 2000, 'bwr']
+    scores['Bias high'] = [avg['height_bias_high'], -6000, 6000, 'bwr']
 
-    # scores['Bias opaque'] = [bias_op_average, -4000, 4000, 'bwr']
-    # scores['Bias transparent'] = [bias_tp_average, -4000, 4000, 'bwr']
-    scores['Bias low opaque'] = [bias_low_op_average, -2000, 2000, 'bwr']
-    scores['Bias mid+high transparent'] = [bias_mid_high_tp_average,
+    scores['Bias low opaque'] = [avg['height_bias_low_op'],
+                                 -2000, 2000, 'bwr']
+    scores['Bias mid+high transparent'] = [avg['height_bias_mid_high_tp'],
                                            -6000, 6000, 'bwr']
 
-    scores['Bias temperature'] = [bias_temperature_average, -30, 30, 'bwr']
-    scores['Bias temperature low'] = [bias_temperature_low_average,
+    scores['Bias temperature'] = [avg['temperature_bias'], -30, 30, 'bwr']
+    scores['Bias temperature low'] = [avg['temperature_bias_low'],
                                       -10, 10, 'bwr']
 
-    scores['CALIOP CTH mean'] = [cal_cth_average, 1000, 14000, 'rainbow']
-    scores['SEVIRI CTH mean'] = [sev_cth_average, 1000, 14000, 'rainbow']
-    scores['Num_detected_height'] = [n_matched_cases, None, None, 'rainbow']
+    scores['CALIOP CTH mean'] = [avg['caliop_cth'], 1000, 14000, 'rainbow']
+    scores['SEVIRI CTH mean'] = [avg['imager_cth'], 1000, 14000, 'rainbow']
+    scores['Num_detected_height'] = [nmatch['all'], None, None, 'rainbow']
+    return scores
 
-    # addit_scores = do_ctp_validation(data, adef, out_size, idxs)
-    # scores.update(addit_scores)
 
-    # scores['N_matched_cases_low'] = [N_matched_cases_low,
-    # None, None, 'rainbow']
-    # scores['N_matched_cases_middle'] = [N_matched_cases_mid,
-    # None, None, 'rainbow']
-    # scores['N_matched_cases_high'] = [N_matched_cases_high,
-    # None, None, 'rainbow']
-    return scores
+def do_ctth_validation(data, resampler, thrs=10):
+    """ thrs: threshold value for filtering boxes with small number of obs """
+    adef = resampler.target_area
+    agg = get_ctth_aggregates(data, resampler.idxs, adef.size)
+    agg = dask.compute(agg)[0]
+    return get_ctth_scores(agg, adef.shape, thrs)
+
+
+# variables, plot limits (after unit scaling) and number of bins per axis
+# of the scatter plot histograms
+SCATTER_VARS = ['cth', 'ctt']
+SCATTER_LIMS = {'cth': (0, 25), 'ctt': (150, 325)}
+SCATTER_NBINS = 100
+# running sums of the scatter regression
+SCATTER_MOMENTS = ['n', 'sx', 'sy', 'sxx', 'syy', 'sxy']
+
+
+def get_scatter_scale(variable, dataset):
+    """ Divisor of the values to the plot units of the scatter plots. """
+    # divide CCI CTH by 1000 to convert from m to km
+    if variable == 'cth' and dataset == 'CCI':
+        return 1000
+    return 1
+
+
+def get_scatter_values(data, variable, dataset):
+    """
+    Get lazy imager and CALIOP values of a scatter plot variable in plot
+    units, divided in their own dtype like the values of the baseline plot.
+    """
+    scale = get_scatter_scale(variable, dataset)
+    x = da.asarray(data['imager_' + variable])
+    y = da.asarray(data['caliop_' + variable])
+    if scale != 1:
+        x, y = x / scale, y / scale
+    return x, y
+
+
+def _scatter_bins(x, lims, nbins):
+    """
+    Get the bin of every value in nbins uniform bins between lims as
+    np.histogram2d: bins are closed on the left, the last one also on the
+    right; -1 outside of the limits.
+    """
+    edges = np.linspace(lims[0], lims[1], nbins + 1)
+    bins = np.searchsorted(edges, x, side='right') - 1
+    bins[x == edges[-1]] = nbins - 1
+    valid = np.logical_and(x >= edges[0], x <= edges[-1])
+    return np.where(valid, bins, -1)
+
+
+def _scatter_codes(x, y, valid=None, lims=None, nbins=None):
+    """
+    Encode the 2D histogram bin (imager, caliop) of every pixel.
+
+    Pixels with invalid values, outside of the limits or not valid
+    (scenario mask) get the overflow code nbins * nbins.
+    """
+    ix = _scatter_bins(x, lims, nbins)
+    iy = _scatter_bins(y, lims, nbins)
+    inside = np.logical_and(ix >= 0, iy >= 0)
+    if valid is not None:
+        inside &= valid
+    return np.where(inside, ix * nbins + iy, nbins * nbins)
+
+
+def _scatter_chunk(x, y, valid=None, strata=None, lims=None, nbins=None,
+                   nstrata=1):
+    """
+    Scatter accumulators of one chunk (see get_scatter_aggregates) of every
+    stratum (strata: stratum of every pixel, None: one stratum).
+
+    Returns array (1, nstrata, nbins * nbins + len(SCATTER_MOMENTS)) of
+    the flattened histogram followed by the regression sums.
+    """
+    if strata is None:
+        strata = np.zeros(x.shape, dtype=np.int64)
+    nhist = nbins * nbins + 1
+    codes = strata * nhist + _scatter_codes(x, y, valid, lims, nbins)
+    hist = np.bincount(codes, minlength=nstrata * nhist)
+    hist = hist.reshape(nstrata, nhist)[:, :-1]
+
+    # pixels of the scenario with valid values in both arrays
+    finite = np.logical_and(np.isfinite(x), np.isfinite(y))
+    if valid is not None:
+        finite &= valid
+    strata = strata[finite]
+    x = x[finite].astype(np.float64)
+    y = y[finite].astype(np.float64)
+    sums = [np.bincount(strata, minlength=nstrata)]
+    sums += [np.bincount(strata, weights=m, minlength=nstrata)
+             for m in [x, y, x * x, y * y, x * y]]
+    return np.concatenate([hist, np.stack(sums, axis=1)], axis=1)[
+               np.newaxis].astype(np.float64)
+
+
+def _get_scatter_stats(data, dataset, strata=None, nstrata=1):
+    """
+    Get lazy scatter accumulators of every variable and stratum, reduced
+    chunk by chunk in one task per chunk.
+
+    Returns histograms (nstrata, nvar, nbins, nbins) and regression sums
+    (nstrata, nvar, len(SCATTER_MOMENTS)).
+    """
+    nbins = SCATTER_NBINS
+    hists, sums = [], []
+    for variable in SCATTER_VARS:
+        x, y = get_scatter_values(data, variable, dataset)
+        valid = data.get('valid')
+        if valid is not None:
+            valid = da.asarray(valid).rechunk(x.chunks)
+        if strata is not None:
+            strata = da.asarray(strata).rechunk(x.chunks)
+        stats = da.map_blocks(_scatter_chunk, x, y.rechunk(x.chunks), valid,
+                              strata, lims=SCATTER_LIMS[variable],
+                              nbins=nbins, nstrata=nstrata, new_axis=[1, 2],
+                              chunks=((1,) * x.numblocks[0], (nstrata,),
+                                      (nbins * nbins +
+                                       len(SCATTER_MOMENTS),)),
+                              dtype=np.float64)
+        stats = stats.sum(axis=0)
+        hists.append(stats[:, :nbins * nbins].astype(np.int64)
+                     .reshape(nstrata, nbins, nbins))
+        sums.append(stats[:, nbins * nbins:])
+    return da.stack(hists, axis=1), da.stack(sums, axis=1)
+
+
+def get_scatter_aggregates(data, dataset):
+    """
+    Get lazy scatter plot accumulators of imager vs CALIOP CTH/CTT.
+
+    scatter_hist: fixed bin 2D count histogram [var, imager bin, caliop bin]
+    scatter_sums: regression sums [var, moment] (see SCATTER_MOMENTS)
+
+    Both are obtained chunk by chunk and merge by summation like the
+    gridded aggregates.
+    """
+    hists, sums = _get_scatter_stats(data, dataset)
+    return {'scatter_hist': hists[0], 'scatter_sums': sums[0]}
+
+
+def get_stratified_scatter(data, codes, nstrata, dataset):
+    """
+    Get lazy scatter plot accumulators (see get_scatter_aggregates) of
+    every (satz, sunz) stratum, codes: stratum of every pixel (see
+    get_strata_codes). The strata are the leading dimension.
+    """
+    hists, sums = _get_scatter_stats(data, dataset, codes, nstrata)
+    return {'scatter_hist': hists, 'scatter_sums': sums}
+
+
+def get_regression(sums):
+    """
+    Get slope, intercept and correlation coefficient r of the linear
+    regression from running sums (see get_scatter_aggregates).
+    """
+    n, sx, sy, sxx, syy, sxy = sums
+    if n < 2:
+        return np.nan, np.nan, np.nan
+    cov = sxy - sx * sy / n
+    var_x = sxx - sx * sx / n
+    var_y = syy - sy * sy / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.float64(cov) / var_x
+        r = np.float64(cov) / np.sqrt(var_x * var_y)
+    intercept = (sy - slope * sx) / n
+    return slope, intercept, r
+
+
+def get_aggregates(data, idxs, out_size, dataset='CCI'):
+    """
+    Get lazy per grid box partial aggregates of one scenario.
+
+    All aggregates are counts or sums over pixels, so aggregates of
+    different files can be merged with merge_aggregates() and scores
+    derived afterwards with get_scores().
+    """
+    agg = dict()
+    agg['cma'] = da.stack(get_contingency_table(data['caliop_cma'],
+                                                data['imager_cma'],
+                                                idxs, out_size,
+                                                data.get('valid')))
+    agg['cph'] = da.stack(get_contingency_table(data['caliop_cph'],
+                                                data['imager_cph'],
+                                                idxs, out_size,
+                                                data.get('valid')))
+    agg.update(get_ctth_aggregates(data, idxs, out_size))
+    agg.update(get_scatter_aggregates(data, dataset))
+    return agg
+
+
+# number of labels of the sparse statistics (see get_sparse_parts)
+SPARSE_NLABELS = {'cma': 4, 'cph': 4, 'ctth': CTTH_NLABELS}
+
+
+def get_sparse_parts(data, idxs, out_size):
+    """
+    Get lazy sparse statistics (see get_grouped_part) of the CMA/CPH
+    contingency categories and the CTTH variables on out_size grid boxes.
+
+    Only occurring (grid box, label) combinations are kept, so memory does
+    not grow with out_size (e.g. bins or strata times grid boxes).
+    """
+    parts = dict()
+    for var in ['cma', 'cph']:
+        arrays = [data['caliop_' + var], data['imager_' + var]]
+        if data.get('valid') is not None:
+            arrays.append(data['valid'])
+        labels = da.map_blocks(_contingency_labels, *arrays, dtype=np.uint8)
+        parts[var] = get_grouped_part([], labels, idxs, out_size,
+                                      SPARSE_NLABELS[var])
+    variables, labels = get_ctth_arrays(data)
+    parts['ctth'] = get_grouped_part([variables[v] for v in
+                                      _get_ctth_pixel_vars()], labels, idxs,
+                                     out_size, CTTH_NLABELS)
+    return parts
+
+
+def _as_delayed(arr):
+    """
+    Get a dask array as one delayed object. Its graph is not optimized, so
+    tasks shared with other collections are not copied (see
+    get_grouped_part).
+    """
+    return arr.rechunk(arr.shape).to_delayed(optimize_graph=False).item()
+
+
+def get_sparse_aggregates(data, idxs, out_size, dataset='CCI'):
+    """
+    Get lazy sparse aggregates of one scenario on out_size grid boxes, or
+    on the (bin, grid box) indices of get_binned_idxs, and its (not binned)
+    scatter plot accumulators, see select_bins and expand_bins.
+    """
+    agg = get_sparse_parts(data, idxs, out_size)
+    # dask.compute() of mixed arrays and delayed objects may return them
+    # grouped by type, so all parts are delayed objects
+    agg.update({key: _as_delayed(val) for key, val in
+                get_scatter_aggregates(data, dataset).items()})
+    return agg
+
+
+def get_stratified_parts(data, idxs, out_size, codes, nstrata,
+                         dataset='CCI'):
+    """
+    Get lazy sparse statistics (see get_sparse_parts) of all pixels on the
+    (stratum, grid box) indices of get_stratified_idxs, and the scatter
+    plot accumulators of every stratum (see get_stratified_scatter).
+    """
+    parts = {key: _as_delayed(val) for key, val in
+             get_stratified_scatter(data, codes, nstrata, dataset).items()}
+    parts.update(get_sparse_parts(data, idxs, out_size))
+    return parts
+
+
+def _regroup_part(part, nlabels, size, regroup):
+    """
+    Regroup sparse statistics on (outer, grid box) indices outer * size +
+    grid index. regroup maps the outer indices to new ones, -1 drops them,
+    statistics of equal new codes are summed up.
+    """
+    codes, stats = part
+    idxs, labels = np.divmod(codes, nlabels)
+    outer, cells = np.divmod(idxs, size)
+    outer = regroup(outer)
+    keep = outer >= 0
+    codes = (outer[keep] * size + cells[keep]) * nlabels + labels[keep]
+    return _grouped_combine((codes, stats[:, keep]))
+
+
+def densify_aggregates(parts, out_size):
+    """
+    Get the gridded aggregates on out_size grid boxes from sparse
+    statistics (see get_sparse_parts), scatter accumulators are kept.
+    Statistics of outer indices (e.g. bins) are summed up.
+    """
+    names = _get_ctth_pixel_vars()
+    agg = dict()
+    for key in ['cma', 'cph']:
+        codes, stats = parts[key]
+        size = SPARSE_NLABELS[key] * out_size
+        table = np.bincount(codes % size, weights=stats[0], minlength=size)
+        agg[key] = np.ascontiguousarray(table.reshape(out_size, -1).T,
+                                        dtype=np.int64)
+    codes, stats = parts['ctth']
+    npix, count, sums, sumsq = _grouped_finalize(
+                                   (codes % (CTTH_NLABELS * out_size), stats),
+                                   out_size, CTTH_NLABELS, len(names),
+                                   *_get_ctth_groups(names))
+    agg['ctth_nmatch'] = npix
+    agg['ctth_count'] = count
+    agg['ctth_sum'] = sums
+    agg['ctth_sumsq'] = sumsq
+    for key in SCATTER_DIMS:
+        if key in parts:
+            agg[key] = parts[key]
+    return agg
+
+
+def is_sparse(agg):
+    """ True for sparse aggregates (see get_sparse_aggregates). """
+    return isinstance(agg['cma'], tuple)
+
+
+def select_strata(parts, size, nstrata, selection):
+    """
+    Get the sparse aggregates (see get_sparse_aggregates) of a selection of
+    strata (see get_strata_selection) from computed stratified statistics
+    (see get_stratified_parts), binned ones for binned statistics.
+    """
+    agg = dict()
+    for key, nlabels in SPARSE_NLABELS.items():
+        # outer index: bin * nstrata + stratum
+        agg[key] = _regroup_part(
+            parts[key], nlabels, size,
+            lambda outer: np.where(selection[outer % nstrata],
+                                   outer // nstrata, -1))
+    for key in SCATTER_DIMS:
+        agg[key] = parts[key][selection].sum(axis=0)
+    return agg
+
+
+def merge_aggregates(*aggs):
+    """
+    Merge partial aggregates by summing them up, sparse statistics (codes,
+    stats) by summing up equal codes.
+    """
+    merged = dict()
+    for key, val in aggs[0].items():
+        if isinstance(val, tuple):
+            merged[key] = _grouped_combine(*[agg[key] for agg in aggs])
+            continue
+        if any(isinstance(agg[key], da.Array) for agg in aggs):
+            # lazy aggregates (see load_aggregates) stay lazy
+            merged[key] = sum((agg[key] for agg in aggs[1:]), val)
+            continue
+        merged[key] = np.array(val, copy=True)
+        for agg in aggs[1:]:
+            merged[key] += agg[key]
+    return merged
+
+
+def expand_bins(agg, size, nbins):
+    """
+    Get dense binned aggregates with nbins * size grid boxes from sparse
+    binned aggregates (see get_sparse_aggregates).
+    """
+    return densify_aggregates(agg, nbins * size) if is_sparse(agg) else agg
+
+
+def select_bins(agg, size, bins=None, densify=True):
+    """
+    Get the aggregates of the sum over a selection of bins from sparse or
+    dense binned aggregates (see get_sparse_aggregates and expand_bins),
+    None: all bins. Lazy dense aggregates stay lazy, sparse ones stay
+    sparse if not densify.
+
+    The scatter accumulators are not binned, they are only kept if all bins
+    are selected.
+    """
+    if is_sparse(agg):
+        if bins is not None:
+            agg = {key: _regroup_part(
+                       agg[key], nlabels, size,
+                       lambda outer: np.where(np.isin(outer, list(bins)),
+                                              0, -1))
+                   for key, nlabels in SPARSE_NLABELS.items()}
+        return densify_aggregates(agg, size) if densify else agg
+
+    selected = dict()
+    for key, values in agg.items():
+        if key in AGG_DIMS:
+            values = values.reshape(values.shape[0], -1, size)
+            if bins is not None:
+                values = values[:, list(bins)]
+            selected[key] = values.sum(axis=1)
+        elif bins is None:
+            selected[key] = values
+    return selected
+
+
+def get_dense_aggregates(agg, size):
+    """
+    Get the gridded aggregates of one scenario as numpy arrays from sparse
+    (all bins summed up), dense or lazy (see load_aggregates) aggregates.
+    """
+    if is_sparse(agg):
+        return densify_aggregates(agg, size)
+    return dask.compute(agg)[0]
+
+
+def get_scores(agg, shape, thrs=10):
+    """ Calculate CMA, CPH and CTTH scores from partial aggregates. """
+    cma_scores = get_contingency_scores(*agg['cma'], shape, 'clr', 'cld')
+    cph_scores = get_contingency_scores(*agg['cph'], shape, 'liq', 'ice')
+    ctth_scores = get_ctth_scores(agg, shape, thrs)
+    return cma_scores, cph_scores, ctth_scores
+
+
+def get_latlon_area(resolution):
+    """ Get a global regular lat/lon grid with resolution in degrees. """
+    return create_area_def('latlon_{}deg'.format(resolution),
+                           {'proj': 'longlat', 'datum': 'WGS84'},
+                           area_extent=[-180, -90, 180, 90],
+                           resolution=resolution,
+                           description='Global {} deg lat/lon grid'.format(
+                               resolution))
+
+
+def get_pyramid_factors(resolutions, shape):
+    """
+    Get block factors {resolution: factor} of the levels of a grid pyramid
+    relative to its finest level min(resolutions).
+    """
+    fine = min(resolutions)
+    factors = dict()
+    for res in sorted(resolutions):
+        factor = int(round(res / fine))
+        if not np.isclose(factor * fine, res) or \
+                shape[0] % factor or shape[1] % factor:
+            raise Exception('Resolution {} is no block multiple of the {} '
+                            'grid'.format(res, fine))
+        factors[res] = factor
+    return factors
+
+
+def _coarsen_part(part, nlabels, shape, factor):
+    """
+    Block-sum sparse statistics on (outer, grid box) indices (see
+    _regroup_part) of a grid of shape over factor x factor grid boxes.
+    """
+    codes, stats = part
+    ny, nx = shape
+    idxs, labels = np.divmod(codes, nlabels)
+    outer, cells = np.divmod(idxs, ny * nx)
+    rows, cols = np.divmod(cells, nx)
+    cells = rows // factor * (nx // factor) + cols // factor
+    size = (ny // factor) * (nx // factor)
+    return _grouped_combine(((outer * size + cells) * nlabels + labels,
+                             stats))
+
+
+def coarsen_aggregates(agg, shape, factor):
+    """
+    Get the aggregates of a grid coarsened by block-summing factor x factor
+    grid boxes, sparse aggregates stay sparse. Aggregates not on the grid
+    (scatter) are kept.
+    """
+    ny, nx = shape
+    coarse = dict()
+    for key, values in agg.items():
+        if is_sparse(agg) and key in SPARSE_NLABELS:
+            values = _coarsen_part(values, SPARSE_NLABELS[key], shape,
+                                   factor)
+        elif key in AGG_DIMS:
+            values = values.reshape(-1, ny // factor, factor,
+                                    nx // factor, factor)
+            values = values.sum(axis=(2, 4)).reshape(values.shape[0], -1)
+        coarse[key] = values
+    return coarse
+
+
+def get_pyramid(aggs, adef, resolutions):
+    """
+    Derive all levels of a grid pyramid from the {scenario: aggregates} of
+    its finest level adef.
+
+    Returns {resolution: (area definition, {scenario: aggregates})}.
+    """
+    fine = min(resolutions)
+    if not adef.crs.is_geographic or not np.allclose(
+            [adef.pixel_size_x, adef.pixel_size_y], fine):
+        raise Exception('Finest resolution {} is not the one of the grid '
+                        '{}'.format(fine, adef.area_id))
+    pyramid = dict()
+    for res, factor in get_pyramid_factors(resolutions, adef.shape).items():
+        if factor == 1:
+            pyramid[res] = (adef, aggs)
+            continue
+        pyramid[res] = (adef.aggregate(x=factor, y=factor),
+                        {sc: coarsen_aggregates(agg, adef.shape, factor)
+                         for sc, agg in aggs.items()})
+    return pyramid
 
 
 def do_ctp_validation(data, adef, out_size, idxs):
@@ -535,30 +1883,15 @@ def do_ctp_validation(data, adef, out_size, idxs):
     detected_height = da.logical_and(detected_clouds,
                                      np.isfinite(data['imager_cth']))
     # find pps low and caliop low
-    low_clouds_c = get_calipso_low_clouds(data['caliop_cflag'])
+    low_clouds_c = da.asarray(data['caliop_ctype']).map_blocks(
+                                    get_cloud_class, cls='low', dtype=bool)
     detected_low_c = np.logical_and(detected_height, low_clouds_c)
     low_clouds_pps = da.where(data['imager_ctp'] > 680., 1, 0)
     detected_low_pps = da.logical_and(detected_height, low_clouds_pps)
 
     # pattern: CALIOP_SEVIRI
-    cld_cld_a = da.logical_and(detected_low_c == 1, detected_low_pps == 1)
-    clr_cld_b = da.logical_and(detected_low_c == 0, detected_low_pps == 1)
-    cld_clr_c = da.logical_and(detected_low_c == 1, detected_low_pps == 0)
-    clr_clr_d = da.logical_and(detected_low_c == 0, detected_low_pps == 0)
-
-    cld_cld_a = cld_cld_a.astype(np.int64)
-    clr_cld_b = clr_cld_b.astype(np.int64)
-    cld_clr_c = cld_clr_c.astype(np.int64)
-    clr_clr_d = clr_clr_d.astype(np.int64)
-
-    a, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=cld_cld_a, density=False)
-    b, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=clr_cld_b, density=False)
-    c, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=cld_clr_c, density=False)
-    d, _ = da.histogram(idxs, bins=out_size, range=(0, out_size),
-                        weights=clr_clr_d, density=False)
+    a, b, c, d = get_contingency_table(detected_low_c, detected_low_pps,
+                                       idxs, out_size, data.get('valid'))
 
     # n = a + b + c + d
     # n2d = N.reshape(adef.shape)
@@ -574,9 +1907,10 @@ def do_ctp_validation(data, adef, out_size, idxs):
     return scores
 
 
-def get_cosfield(lat):
+def get_cosfield(lat, chunks='auto'):
+    """ chunks: dask chunks of the grid, 'auto' uses dask's chunk-size """
     latcos = np.abs(np.cos(lat * np.pi / 180))
-    cosfield = da.from_array(latcos, chunks=(1000, 1000))  # [mask]
+    cosfield = da.from_array(latcos, chunks=chunks)  # [mask]
     return cosfield
 
 
@@ -584,119 +1918,183 @@ def weighted_spatial_average(data, cosfield):
     if isinstance(data, xr.DataArray):
         data = data.data
     if isinstance(data, np.ndarray):
-        data = da.from_array(data, chunks=(1000, 1000))
-    return da.nansum(data * cosfield) / da.nansum(cosfield)
+        data = da.from_array(data, chunks=cosfield.chunks)
+    # only weights of valid grid boxes
+    weights = da.where(da.isfinite(data), cosfield, 0)
+    return da.nansum(data * cosfield) / da.sum(weights)
+
+
+# grid boxes with less observations are not shown in CMA/CPH maps
+NOBS_MIN = 50
+# figure templates for map plots, see get_figure_template
+_FIGURE_TEMPLATES = dict()
+
+
+def get_figure_template(crs, names, layout, figsize, shape):
+    """
+    Get figure with one map panel per score, created once per layout.
+
+    The axes, coastlines and colorbars are kept and only image data, color
+    ranges and titles are replaced for every output.
+    Returns the figure and {name: (axes, image, colorbar)}.
+    """
+    key = (crs.proj4_init, tuple(crs.bounds), tuple(names), layout, figsize,
+           shape)
+    if key not in _FIGURE_TEMPLATES:
+        fig = plt.figure(figsize=figsize)
+        panels = dict()
+        for cnt, s in enumerate(names):
+            ax = fig.add_subplot(*layout, cnt + 1, projection=crs)
+            ims = ax.imshow(np.full(shape, np.nan),
+                            transform=crs,
+                            extent=crs.bounds,
+                            origin='upper',
+                            interpolation='none'
+                            )
+            ax.coastlines(color='black')
+            cbar = fig.colorbar(ims, ax=ax)
+            panels[s] = (ax, ims, cbar)
+        _FIGURE_TEMPLATES[key] = (fig, panels)
+    return _FIGURE_TEMPLATES[key]
+
+
+def close_figure_templates():
+    """ Close all figure templates. """
+    for fig, _ in _FIGURE_TEMPLATES.values():
+        plt.close(fig)
+    _FIGURE_TEMPLATES.clear()
+
+
+def _update_panel(panel, values, cmap, title):
+    ax, ims, cbar = panel
+    ims.set_data(values[0])
+    ims.set_cmap(cmap)
+    ims.norm.vmin = values[1]
+    ims.norm.vmax = values[2]
+    # vmin/vmax None: scale to data as imshow does
+    ims.autoscale_None()
+    cbar.update_normal(ims)
+    ax.set_title(title)
 
 
 def make_plot(scores, optf, crs, dnt, var, cosfield):
-    fig = plt.figure(figsize=(16, 7))
-    for cnt, s in enumerate(scores.keys()):
+    shape = np.shape(scores['Nobs'][0])
+    fig, panels = get_figure_template(crs, list(scores), (4, 4), (16, 7),
+                                      shape)
+    nobs = np.asarray(scores['Nobs'][0])
+    for s in scores.keys():
         values = scores[s]
-        values[0] = da.where(scores['Nobs'][0] < 50, np.nan, values[0])
-        ax = fig.add_subplot(4, 4, cnt + 1, projection=crs)
-        ims = ax.imshow(values[0],
-                        transform=crs,
-                        extent=crs.bounds,
-                        vmin=values[1],
-                        vmax=values[2],
-                        cmap=plt.get_cmap(values[3]),
-                        origin='upper',
-                        interpolation='none'
-                        )
-        ax.coastlines(color='black')
+        values[0] = np.where(nobs < NOBS_MIN, np.nan, values[0])
         # mean = weighted_spatial_average(values[0], cosfield).compute()
         # mean = '{:.2f}'.format(da.nanmean(values[0]).compute())
         mean = ''
-        ax.set_title(var + ' ' + s + ' ' + dnt + ' {}'.format(mean))
-        plt.colorbar(ims)
-    plt.tight_layout()
-    plt.savefig(optf)
+        _update_panel(panels[s], values, plt.get_cmap(values[3]),
+                      var + ' ' + s + ' ' + dnt + ' {}'.format(mean))
+    fig.tight_layout()
+    fig.savefig(optf)
     print('SAVED ', os.path.basename(optf))
 
 
-def make_plot_CTTH(scores, optf, crs, dnt, var, cosfield):
-    fig = plt.figure(figsize=(16, 12))
-    for cnt, s in enumerate(scores.keys()):
+def make_plot_CTTH(scores, optf, crs, dnt, var, cosfield, stats=None):
+    """ stats: summary statistics of the scores, computed if not given """
+    shape = np.shape(scores['Num_detected_height'][0])
+    fig, panels = get_figure_template(crs, list(scores), (4, 3), (16, 12),
+                                      shape)
+    if stats is None:
+        stats = dask.compute(get_summary_stats(
+                    scores, cosfield, scores['Num_detected_height'][0]))[0]
+    for s in scores.keys():
         values = scores[s]
         masked_values = np.ma.array(values[0], mask=np.isnan(values[0]))
-        cmap = plt.get_cmap(values[3])
+        cmap = copy.copy(plt.get_cmap(values[3]))
         cmap.set_bad('grey', 1.)
-        ax = fig.add_subplot(4, 3, cnt + 1, projection=crs)  # ccrs.Robinson()
-        ims = ax.imshow(masked_values,
-                        transform=crs,
-                        extent=crs.bounds,
-                        vmin=values[1],
-                        vmax=values[2],
-                        cmap=cmap,
-                        origin='upper',
-                        interpolation='none'
-                        )
-        ax.coastlines(color='black')
-        # mean = ''
-        mean = weighted_spatial_average(values[0], cosfield).compute()
-        mean = '{:.2f}'.format(da.nanmean(values[0]).compute())
-        ax.set_title(var + ' ' + s + ' ' + dnt + ' {}'.format(mean))
-        plt.colorbar(ims)
-    plt.tight_layout()
-    plt.savefig(optf)
-    plt.close()
+        mean = '{:.2f}'.format(stats[s]['mean'])
+        _update_panel(panels[s], [masked_values] + values[1:], cmap,
+                      var + ' ' + s + ' ' + dnt + ' {}'.format(mean))
+    fig.tight_layout()
+    fig.savefig(optf)
     print('SAVED ', os.path.basename(optf))
 
 
-def make_scatter(data, optf, dnt, dataset):
-    from scipy.stats import linregress
+def _render_plot(job):
+    func, args = job
+    with log_stage('plot', file=os.path.basename(args[1])):
+        func(*args)
+
+
+def _render_plot_worker(job):
+    """ _render_plot() for process pool workers, one thread per worker """
+    with dask.config.set(scheduler='synchronous'):
+        _render_plot(job)
+
+
+def render_plots(jobs, nprocs=1):
+    """
+    Render plot jobs (function, arguments), in a pool of nprocs processes
+    if nprocs > 1. jobs may be a generator, at most 2 * nprocs of them are
+    pending in the pool. Figure templates are closed afterwards.
+    """
+    if nprocs > 1:
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            pending = set()
+            for job in jobs:
+                if len(pending) >= 2 * nprocs:
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(pool.submit(_render_plot_worker, job))
+            for future in pending:
+                future.result()
+    else:
+        for job in jobs:
+            _render_plot(job)
+    close_figure_templates()
+
+
+def make_scatter(agg, optf, dnt):
+    """
+    Plot imager vs CALIOP CTH/CTT histograms and regression lines from the
+    scatter accumulators of get_scatter_aggregates().
+    """
     from matplotlib.colors import LogNorm
 
     fig = plt.figure(figsize=(12, 4))
-    # variable to be plotted
-    vars = ['cth', 'ctt']
-    # limits for plotting
-    lims = {'cth': (0, 25), 'ctt': (150, 325)}
     # units for plotting
-    units = {'cth': 'km', 'ctt': 'm'}
-
-    for cnt, variable in enumerate(vars):
-        x = data['imager_' + variable].compute()
-        y = data['caliop_' + variable].compute()
+    units = {'cth': 'km', 'ctt': 'K'}
 
-        # divide CCI CTH by 1000 to convert from m to km
-        if variable == 'cth' and dataset == 'CCI':
-            x /= 1000
-            y /= 1000
+    for cnt, variable in enumerate(SCATTER_VARS):
+        lims = SCATTER_LIMS[variable]
+        edges = np.linspace(lims[0], lims[1], SCATTER_NBINS + 1)
+        hist = np.ma.masked_equal(agg['scatter_hist'][cnt], 0)
 
         # dummy data for 1:1 line
-        dummy = np.arange(0, lims[variable][1])
-
-        # remove nans in both arrays
-        mask = np.logical_or(np.isnan(x), np.isnan(y))
-        x = x[~mask]
-        y = y[~mask]
+        dummy = np.arange(0, lims[1])
 
         ax = fig.add_subplot(1, 2, cnt + 1)
-        h = ax.hist2d(x, y,
-                      bins=(100, 100),
-                      cmap=plt.get_cmap('YlOrRd'),
-                      norm=LogNorm())
+        h = ax.pcolormesh(edges, edges, hist.T,
+                          cmap=plt.get_cmap('YlOrRd'),
+                          norm=LogNorm())
 
-        # make linear regression
-        reg = linregress(x, y)
+        # linear regression from running sums
+        slope, intercept, r = get_regression(agg['scatter_sums'][cnt])
         # plot linear regression
-        ax.plot(reg[0] * dummy + reg[1], color='blue')
+        ax.plot(slope * dummy + intercept, color='blue')
         # plot 1:1 line
         ax.plot(dummy, dummy, color='black')
 
         ax.set_xlabel('imager_{} [{}]'.format(variable, units[variable]))
         ax.set_ylabel('caliop_{} [{}]'.format(variable, units[variable]))
-        ax.set_xlim(lims[variable])
-        ax.set_ylim(lims[variable])
+        ax.set_xlim(lims)
+        ax.set_ylim(lims)
         ax.set_title(variable.upper() + ' ' + dnt, fontweight='bold')
         # write regression parameters to plot
-        ax.annotate(xy=(0.05, 0.9),
-                    s='r={:.2f}\nr**2={:.2f}'.format(reg[2], reg[2] * reg[2]),
+        ax.annotate('r={:.2f}\nr**2={:.2f}'.format(r, r * r),
+                    xy=(0.05, 0.9),
                     xycoords='axes fraction', color='blue', fontweight='bold',
                     backgroundcolor='lightgrey')
 
-        plt.colorbar(h[3], ax=ax)
+        plt.colorbar(h, ax=ax)
 
     plt.tight_layout()
     plt.savefig(optf)
@@ -704,8 +2102,16 @@ def make_scatter(data, optf, dnt, dataset):
     print('SAVED ', os.path.basename(optf))
 
 
-def run(ipath, ifile, opath, dnts, satzs,
-        year, month, dataset, chunksize=100000):
+OFILES = {'CMA': 'CMA_SEVIRI_CALIOP_{}{}_DNT-{}_SATZ-{}.png',
+          'CPH': 'CPH_SEVIRI_CALIOP_{}{}_DNT-{}_SATZ-{}.png',
+          'CTTH': 'CTTH_SEVIRI_CALIOP_{}{}_DNT-{}_SATZ-{}.png',
+          'SCATTER': 'SCATTER_SEVIRI_CALIOP_{}{}_DNT-{}_SATZ-{}.png',
+          'SUMMARY': 'SUMMARY_SEVIRI_CALIOP_{}{}',
+          'CI': 'CI_SEVIRI_CALIOP_{}{}.nc'}
+
+
+def get_scenarios(dnts, satzs, dataset):
+    """ Check run options and get list of (dnt, satz_lim) scenarios. """
     # if dnts is single string convert to list
     if isinstance(dnts, str):
         dnts = [dnts]
@@ -717,15 +2123,9 @@ def run(ipath, ifile, opath, dnts, satzs,
     if dataset not in ['CCI', 'CLAAS3']:
         raise Exception('Dataset {} not available!'.format(dataset))
 
-    ofile_cma = 'CMA_SEVIRI_CALIOP_{}{}_DNT-{}_SATZ-{}.png'
-    ofile_cph = 'CPH_SEVIRI_CALIOP_{}{}_DNT-{}_SATZ-{}.png'
-    ofile_ctth = 'CTTH_SEVIRI_CALIOP_{}{}_DNT-{}_SATZ-{}.png'
-    ofile_scat = 'SCATTER_SEVIRI_CALIOP_{}{}_DNT-{}_SATZ-{}.png'
-
-    # iterate over satzen limitations
+    # if satz_lim list item is string convert it to float
+    satz_lims = []
     for satz_lim in satzs:
-
-        # if satz_lim list item is string convert it to float
         if satz_lim is not None:
             if isinstance(satz_lim, str):
                 try:
@@ -733,50 +2133,1090 @@ def run(ipath, ifile, opath, dnts, satzs,
                 except ValueError:
                     msg = 'Cannot convert {} to float'
                     raise Exception(msg.format(satz_lim))
+        satz_lims.append(satz_lim)
+
+    dnts = [dnt.upper() for dnt in dnts]
+    for dnt in dnts:
+        if dnt not in ['ALL', 'DAY', 'NIGHT', 'TWILIGHT']:
+            raise Exception('DNT {} not recognized'.format(dnt))
+
+    # iterate over satzen limitations
+    return [(dnt, satz_lim) for satz_lim in satz_lims for dnt in dnts]
+
+
+def get_matchup_files(ipattern):
+    """ Get sorted list of matchup files in directory or matching glob. """
+    if os.path.isdir(ipattern):
+        ipattern = os.path.join(ipattern, '*.h5')
+    files = sorted(glob.glob(ipattern))
+    if len(files) == 0:
+        raise Exception('No matchup files found for {}'.format(ipattern))
+    return files
+
+
+# archive index of matchup files, see update_archive_index()
+INDEX_VERSION = 1
+# cell size [deg] of the occupancy bitmaps of the archive index
+INDEX_CELL = 5
+# time variables of the matchup files [seconds since 1970]
+TIME_VARS = [('calipso', 'sec_1970'), ('imager', 'time')]
+
+
+def get_occupancy(lon, lat):
+    """ Get the global occupancy bitmap (INDEX_CELL cells) of lon/lat. """
+    ny, nx = 180 // INDEX_CELL, 360 // INDEX_CELL
+    valid = np.isfinite(lon) & np.isfinite(lat)
+    iy = np.clip(((lat[valid] + 90) // INDEX_CELL).astype(int), 0, ny - 1)
+    ix = ((lon[valid] + 180) // INDEX_CELL).astype(int) % nx
+    bitmap = np.zeros((ny, nx), dtype=bool)
+    bitmap[iy, ix] = True
+    return bitmap
+
+
+def _encode_bitmap(bitmap):
+    return np.packbits(bitmap).tobytes().hex()
 
-        for dnt in dnts:
 
-            dnt = dnt.upper()
-            if dnt not in ['ALL', 'DAY', 'NIGHT', 'TWILIGHT']:
-                raise Exception('DNT {} not recognized'.format(dnt))
+def _decode_bitmap(code):
+    ny, nx = 180 // INDEX_CELL, 360 // INDEX_CELL
+    bits = np.unpackbits(np.frombuffer(bytes.fromhex(code), dtype=np.uint8))
+    return bits[:ny * nx].reshape(ny, nx).astype(bool)
 
-            # set output filenames for CPH and CMA plot
-            ofile_cma = ofile_cma.format(year, month, dnt, satz_lim)
-            ofile_cph = ofile_cph.format(year, month, dnt, satz_lim)
-            ofile_ctth = ofile_ctth.format(year, month, dnt, satz_lim)
-            ofile_scat = ofile_scat.format(year, month, dnt, satz_lim)
 
-            # get matchup data
-            data, latlon = get_collocated_file_info(os.path.join(ipath, ifile),
-                                                    chunksize, dnt, satz_lim,
-                                                    dataset)
+def get_area_occupancy(adef):
+    """
+    Get the occupancy bitmap of a target area, dilated by one cell so that
+    areas only partly covering a cell are not missed.
+    """
+    lon, lat = adef.get_lonlats()
+    bitmap = get_occupancy(lon.ravel(), lat.ravel())
+    dilated = bitmap.copy()
+    dilated[1:] |= bitmap[:-1]
+    dilated[:-1] |= bitmap[1:]
+    dilated |= np.roll(dilated, 1, axis=1) | np.roll(dilated, -1, axis=1)
+    return dilated
+
+
+def index_matchup_file(mfile, dataset, blocksize=10**6):
+    """
+    Get the archive index entry of a matchup file: size, mtime, number of
+    pixels, lat/lon bounding box, occupancy bitmap and time range.
+    Only lat/lon and time are read, block by block.
+    """
+    stat = os.stat(mfile)
+    with h5py.File(mfile, 'r') as file:
+        groups = {'calipso': file['calipso'],
+                  'imager': get_imager_group(file, dataset)}
+        lat = groups['imager']['latitude']
+        lon = groups['imager']['longitude']
+        npix = lat.shape[0]
+        bitmap = np.zeros((180 // INDEX_CELL, 360 // INDEX_CELL), dtype=bool)
+        bbox = [np.inf, np.inf, -np.inf, -np.inf]
+        for start in range(0, npix, blocksize):
+            blat = lat[start:start + blocksize].astype(np.float64)
+            blon = lon[start:start + blocksize].astype(np.float64)
+            blat[np.abs(blat) > 90] = np.nan
+            blon[np.abs(blon) > 360] = np.nan
+            bitmap |= get_occupancy(blon, blat)
+            if np.isfinite(blat).any() and np.isfinite(blon).any():
+                bbox = [min(bbox[0], np.nanmin(blon)),
+                        min(bbox[1], np.nanmin(blat)),
+                        max(bbox[2], np.nanmax(blon)),
+                        max(bbox[3], np.nanmax(blat))]
+
+        time_range = None
+        for group, name in TIME_VARS:
+            if name not in groups[group]:
+                continue
+            var = groups[group][name]
+            blocks = [()] if var.ndim == 0 else [
+                slice(start, start + blocksize)
+                for start in range(0, var.shape[0], blocksize)]
+            for block in blocks:
+                times = np.asarray(var[block], dtype=np.float64)
+                times = times[np.isfinite(times) & (times > 0)]
+                if times.size == 0:
+                    continue
+                block_range = [float(times.min()), float(times.max())]
+                if time_range is not None:
+                    block_range = [min(time_range[0], block_range[0]),
+                                   max(time_range[1], block_range[1])]
+                time_range = block_range
+            break
+
+    return {'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'npix': int(npix),
+            'bbox': [float(b) for b in bbox] if np.isfinite(bbox).all()
+            else None,
+            'occupancy': _encode_bitmap(bitmap),
+            'time': time_range}
+
+
+def update_archive_index(mfiles, index_file, dataset):
+    """
+    Build or update the archive index (JSON) of matchup files.
+
+    Only files which are new or changed (size/mtime) since the last update
+    are read. Returns the index {absolute path: entry}.
+    """
+    index = dict()
+    if os.path.isfile(index_file):
+        with open(index_file) as fh:
+            content = json.load(fh)
+        if content.get('version') == INDEX_VERSION and \
+                content.get('cell') == INDEX_CELL:
+            index = content['files']
+
+    changed = False
+    for mfile in mfiles:
+        key = os.path.abspath(mfile)
+        stat = os.stat(mfile)
+        entry = index.get(key)
+        if entry is None or (entry['size'], entry['mtime_ns']) != (
+                stat.st_size, stat.st_mtime_ns):
+            print('INDEXING ', os.path.basename(mfile))
+            index[key] = index_matchup_file(mfile, dataset)
+            changed = True
+
+    if changed:
+        _write_json(index_file, {'version': INDEX_VERSION,
+                                 'cell': INDEX_CELL,
+                                 'files': index})
+        print('SAVED ', os.path.basename(index_file))
+    return index
+
+
+def get_period_seconds(period):
+    """
+    Get (start, end) seconds since 1970 of a period given as (start, end)
+    datetimes, date strings or seconds.
+    """
+    def _seconds(value):
+        if isinstance(value, (int, float)):
+            return float(value)
+        return float((np.datetime64(value) - np.datetime64('1970-01-01'))
+                     / np.timedelta64(1, 's'))
+    return _seconds(period[0]), _seconds(period[1])
+
+
+def select_files(mfiles, index, adef=None, period=None):
+    """
+    Select the matchup files with pixels in the target area and period
+    according to the archive index, without reading the files.
+
+    Files without time information are kept for any period.
+    """
+    occupancy = None if adef is None else get_area_occupancy(adef)
+    if period is not None:
+        start, end = get_period_seconds(period)
+
+    selected = []
+    for mfile in mfiles:
+        entry = index[os.path.abspath(mfile)]
+        if entry['npix'] == 0:
+            reason = 'no pixels'
+        elif occupancy is not None and not (
+                _decode_bitmap(entry['occupancy']) & occupancy).any():
+            reason = 'outside of area'
+        elif period is not None and entry['time'] is not None and (
+                entry['time'][1] < start or entry['time'][0] > end):
+            reason = 'outside of period'
+        else:
+            selected.append(mfile)
+            continue
+        print('SKIPPED ', os.path.basename(mfile), '({})'.format(reason))
+    return selected
+
+
+# number of chunks of a matchup file reduced in one dask computation, the
+# results of the batches are merged into running aggregates
+REDUCE_BATCH = 16
+
+
+def get_chunk_batches(chunks, nchunks=REDUCE_BATCH):
+    """ Get pixel slices of batches of nchunks consecutive chunks. """
+    bounds = np.cumsum((0,) + tuple(chunks))
+    return [slice(int(bounds[i]), int(bounds[min(i + nchunks, len(chunks))]))
+            for i in range(0, len(chunks), nchunks)]
+
+
+def get_reduction(data, latlon, idxs, scenarios, adef, dataset='CCI',
+                  binning=None, strata=None):
+    """
+    Get the lazy partial aggregates of every scenario (stratified sparse
+    statistics if strata are given) of matchup data, see reduce_collocated.
+    """
+    out_size = adef.size
+    if strata is not None:
+        idxs = get_stratified_idxs(data, idxs, out_size, strata)
+        out_size *= get_nstrata(strata)
+    if binning is not None:
+        idxs = get_binned_idxs(data, latlon, idxs, out_size, binning)
+        out_size *= BINNINGS[binning]
+
+    if strata is not None:
+        return get_stratified_parts(data, idxs, out_size,
+                                    get_strata_codes(data, strata),
+                                    get_nstrata(strata), dataset)
+    # all scenarios are reduced in one pass over the data
+    return {(dnt, satz_lim): get_sparse_aggregates(
+                apply_scenario(data, dnt, satz_lim), idxs, out_size, dataset)
+            for dnt, satz_lim in scenarios}
+
+
+def reduce_collocated(data, latlon, mfile, scenarios, adef, chunksize,
+                      idxs_cache=True, dataset='CCI', binning=None,
+                      strata=None):
+    """
+    Reduce loaded matchup data to partial aggregates of every scenario.
 
-            adef = load_area('areas.yaml', 'pc_world')
+    binning: key of BINNINGS, the aggregates of every bin are obtained in
+             the same pass (see get_binned_idxs)
+    strata:  satz limits resolved by (satz, sunz) stratified gridded
+             aggregates (see get_stratified_idxs). The gridded aggregates
+             of all scenarios are then sums over the strata of a single
+             reduction instead of one reduction per scenario.
 
-            # for each input pixel get target pixel index
-            resampler = BucketResampler(adef, latlon['lon'], latlon['lat'])
-            idxs = resampler.idxs
+    The pixels are reduced in batches of REDUCE_BATCH chunks whose results
+    are merged at once, so memory does not grow with the file size.
 
-            # get output grid size/lat/lon
-            out_size = adef.size
-            lon, lat = adef.get_lonlats()
+    Returns dict {(dnt, satz_lim): sparse aggregates} (see
+    get_sparse_aggregates).
+    """
+    fname = os.path.basename(mfile)
+    with log_stage('indexing', file=fname):
+        idxs = get_target_idxs(mfile, adef, latlon, chunksize, idxs_cache)
+    if strata is not None:
+        strata = tuple(sorted(strata))
+
+    batches = []
+    for sel in get_chunk_batches(data['satz'].chunks[0], REDUCE_BATCH):
+        batches.append(get_reduction(
+            {key: val[sel] for key, val in data.items()},
+            {key: da.asarray(val)[sel] for key, val in latlon.items()},
+            da.asarray(idxs)[sel], scenarios, adef, dataset, binning,
+            strata))
+    merge = merge_aggregates if strata is not None else \
+        merge_scenario_aggregates
+    result = None
+    with log_stage('reduce', collections=batches, file=fname,
+                   scenarios=list(scenarios)):
+        for batch in batches:
+            part = dask.compute(batch)[0]
+            result = part if result is None else merge(result, part)
+    if strata is None:
+        return result
+    return {sc: select_strata(result, adef.size, get_nstrata(strata),
+                              get_strata_selection(strata, *sc))
+            for sc in scenarios}
+
+
+def reduce_file(mfile, scenarios, adef, dataset, chunksize=None,
+                idxs_cache=True, cache=False, memory_budget=None,
+                nworkers=None, binning=None, strata=None):
+    """
+    Read one matchup file and reduce it with reduce_collocated().
 
-            # do validation
-            cma_scores = do_cma_validation(data, adef, out_size, idxs)
-            cph_scores = do_cph_validation(data, adef, out_size, idxs)
-            ctth_scores = do_ctth_validation(data, resampler, thrs=10)
+    chunksize: chunk size of the matchup arrays, derived from memory_budget
+               and nworkers if None (see get_chunksize)
+    binning:   key of BINNINGS to group the aggregates by
+    strata:    satz limits of stratified aggregates (see reduce_collocated)
+    """
+    if chunksize is None:
+        out_size, nscenarios = adef.size, len(scenarios)
+        if strata is not None:
+            # a single reduction of all scenarios
+            out_size *= get_nstrata(strata)
+            nscenarios = 1
+        if binning is not None:
+            out_size *= BINNINGS[binning]
+        chunksize = get_chunksize(mfile, dataset, memory_budget, nworkers,
+                                  out_size, nscenarios)
+    with log_stage('load', file=os.path.basename(mfile),
+                   chunksize=chunksize):
+        data, latlon = load_collocated_file(mfile, chunksize, dataset, cache)
+        if binning in TIME_BINNINGS:
+            data = dict(data, time=read_pixel_time(mfile, dataset,
+                                                   chunksize))
+    return reduce_collocated(data, latlon, mfile, scenarios, adef,
+                             chunksize, idxs_cache, dataset, binning, strata)
+
+
+@functools.lru_cache(maxsize=None)
+def get_plot_geometry(adef):
+    """ Get crs and cos(lat) field of the target grid for plotting. """
+    # get crs for plotting
+    crs = adef.to_cartopy_crs()
+
+    # get cos(lat) filed for weighted average on global regular grid
+    lon, lat = adef.get_lonlats()
+    cosfield = get_cosfield(lat)
+    return crs, cosfield
+
+
+def get_plot_jobs(scores, opath, ofile_args, dnt, adef, stats=None):
+    """
+    Get the plot jobs of the CMA, CPH and CTTH maps (see render_plots)
+    from the scores of one scenario (see get_scores).
 
-            # get crs for plotting
-            crs = adef.to_cartopy_crs()
+    stats: summary statistics of the scores (see get_summary_stats)
+    """
+    cma_scores, cph_scores, ctth_scores = scores
+    crs, cosfield = get_plot_geometry(adef)
+    ctth_stats = None if stats is None else stats['CTTH']
+
+    return [(make_plot,
+             (cma_scores,
+              os.path.join(opath, OFILES['CMA'].format(*ofile_args)),
+              crs, dnt, 'CMA', cosfield)),
+            (make_plot,
+             (cph_scores,
+              os.path.join(opath, OFILES['CPH'].format(*ofile_args)),
+              crs, dnt, 'CPH', cosfield)),
+            (make_plot_CTTH,
+             (ctth_scores,
+              os.path.join(opath, OFILES['CTTH'].format(*ofile_args)),
+              crs, dnt, 'CTTH', cosfield, ctth_stats))]
+
+
+def get_summary_stats(scores, cosfield, nobs, nobs_min=None):
+    """
+    Get lazy global statistics of every score map: cos(lat) weighted mean,
+    unweighted mean, total number of observations and number of valid
+    grid boxes.
 
-            # get cos(lat) filed for weighted average on global regular grid
-            cosfield = get_cosfield(lat)
+    nobs:     number of observations map
+    nobs_min: ignore grid boxes with less observations (as in the maps)
+    """
+    nobs = np.asarray(nobs)
+    stats = dict()
+    for s, values in scores.items():
+        data = np.asarray(values[0], dtype=np.float64)
+        if nobs_min is not None:
+            data = np.where(nobs < nobs_min, np.nan, data)
+        data = da.from_array(data, chunks=cosfield.chunks)
+        stats[s] = {'weighted_mean': weighted_spatial_average(data, cosfield),
+                    'mean': da.nanmean(data),
+                    'nobs': nobs.sum(),
+                    'valid_cells': da.isfinite(data).sum()}
+    return stats
+
+
+def write_summary(stats, opath, year, month, dataset):
+    """
+    Write summary statistics {(dnt, satz_lim): {var: {score: stats}}} to
+    CSV and JSON files.
+    """
+    rows = []
+    for (dnt, satz_lim), var_stats in stats.items():
+        for var, score_stats in var_stats.items():
+            for score, values in score_stats.items():
+                row = {'dataset': dataset, 'year': str(year),
+                       'month': str(month), 'dnt': dnt, 'satz': satz_lim,
+                       'variable': var, 'score': score}
+                for key, value in values.items():
+                    value = value.item()
+                    row[key] = None if value != value else value
+                rows.append(row)
+
+    ofile = os.path.join(opath, OFILES['SUMMARY'].format(year, month))
+    with open(ofile + '.json', 'w') as fh:
+        json.dump(rows, fh, indent=1)
+    with open(ofile + '.csv', 'w', newline='') as fh:
+        writer = csv.DictWriter(fh, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print('SAVED ', os.path.basename(ofile) + '.csv/.json')
+
+
+def get_ci_maps(agg, scores, shape, nboot):
+    """
+    Get lazy CMA/CPH maps of CI_SCORES, their bootstrap confidence
+    intervals and the number of observations of one scenario.
 
-            # do plotting
-            make_plot(cma_scores, os.path.join(opath, ofile_cma), crs,
-                      dnt, 'CMA', cosfield)
-            make_plot(cph_scores, os.path.join(opath, ofile_cph), crs,
-                      dnt, 'CPH', cosfield)
-            make_plot_CTTH(ctth_scores, os.path.join(opath, ofile_ctth),
-                           crs, dnt, 'CTTH', cosfield)
-            make_scatter(data, os.path.join(opath, ofile_scat), dnt, dataset)
+    scores: CMA, CPH and CTTH scores of the aggregates (see get_scores)
+    """
+    labels = dict((score[0], score[1]) for score in CONTINGENCY_SCORES)
+    maps = dict()
+    for var, var_scores in zip(['CMA', 'CPH'], scores):
+        maps[var] = {'scores': [var_scores[labels[name]][0]
+                                for name in CI_SCORES],
+                     'ci': get_contingency_ci(agg[var.lower()], shape, nboot),
+                     'nobs': var_scores['Nobs'][0]}
+    return maps
+
+
+def write_ci(maps, opath, year, month, dataset, adef, nboot):
+    """
+    Write the maps {(dnt, satz_lim): maps} of CI_SCORES and their bootstrap
+    confidence intervals (see get_ci_maps) to a NetCDF file next to the
+    score maps.
+    """
+    dnts = list(dict.fromkeys(sc[0] for sc in maps))
+    satzs = list(dict.fromkeys(sc[1] for sc in maps))
+    labels = dict((score[0], score[1]) for score in CONTINGENCY_SCORES)
+
+    def _stack(get):
+        return np.stack([np.stack([get((dnt, satz_lim)) for dnt in dnts])
+                         for satz_lim in satzs])
+
+    dims = ('satz', 'dnt')
+    data_vars = dict()
+    for var in ['CMA', 'CPH']:
+        data_vars[var + '_scores'] = (
+            dims + ('ci_score', 'y', 'x'),
+            _stack(lambda sc: np.stack(maps[sc][var]['scores']).astype(
+                                  np.float32)))
+        data_vars[var + '_ci'] = (dims + ('ci_score', 'bound', 'y', 'x'),
+                                  _stack(lambda sc: maps[sc][var]['ci']))
+        data_vars[var + '_nobs'] = (dims + ('y', 'x'),
+                                    _stack(lambda sc: maps[sc][var]['nobs']))
+    coords = {'satz': [_satz_to_coord(s) for s in satzs],
+              'dnt': dnts,
+              'ci_score': [labels[name] for name in CI_SCORES],
+              'bound': ['lower', 'upper']}
+    attrs = {'dataset': dataset, 'year': str(year), 'month': str(month),
+             'area_id': adef.area_id, 'area_def': adef.dump(),
+             'nboot': nboot, 'level': CI_LEVEL}
+    ds = xr.Dataset(data_vars, coords=coords, attrs=attrs)
+    encoding = dict((var, {'zlib': True, 'complevel': 4})
+                    for var in ds.data_vars)
+    ofile = os.path.join(opath, OFILES['CI'].format(year, month))
+    ds.to_netcdf(ofile, encoding=encoding)
+    print('SAVED ', os.path.basename(ofile))
+
+
+def make_outputs(aggs, opath, year, month, dataset, adef, thrs=10,
+                 plot_nprocs=1, nboot=None):
+    """
+    Calculate scores of all scenarios from aggregates, write the summary
+    statistics and render the maps.
+
+    The scenarios are densified (see get_dense_aggregates), scored and
+    plotted one after the other, so the gridded aggregates and scores of
+    only one scenario are held at a time.
+
+    nboot: number of bootstrap replicates of the CMA/CPH score confidence
+           intervals written to OFILES['CI'], None: no intervals
+    """
+    crs, cosfield = get_plot_geometry(adef)
+    stats, cis = dict(), dict()
+
+    def _get_jobs(scenario):
+        dnt, satz_lim = scenario
+        agg = get_dense_aggregates(aggs[scenario], adef.size)
+        scores = get_scores(agg, adef.shape, thrs)
+        cma_scores, cph_scores, ctth_scores = scores
+        # only the contingency tables (intervals) and scatter are used
+        agg = {key: val for key, val in agg.items()
+               if key in ['cma', 'cph'] or key in SCATTER_DIMS}
+        # global statistics of all scores in a single compute
+        sc_stats = {
+            'CMA': get_summary_stats(cma_scores, cosfield,
+                                     cma_scores['Nobs'][0], NOBS_MIN),
+            'CPH': get_summary_stats(cph_scores, cosfield,
+                                     cph_scores['Nobs'][0], NOBS_MIN),
+            'CTTH': get_summary_stats(ctth_scores, cosfield,
+                                      ctth_scores['Num_detected_height'][0])}
+        ci = get_ci_maps(agg, scores, adef.shape, nboot) if nboot else dict()
+        with log_stage('summary', collections=[sc_stats, ci],
+                       scenario=[dnt, satz_lim]):
+            stats[scenario], cis[scenario] = dask.compute(sc_stats, ci)
+
+        ofile_args = (year, month, dnt, satz_lim)
+        jobs = get_plot_jobs(scores, opath, ofile_args, dnt, adef,
+                             stats[scenario])
+        # aggregate files of older versions have no scatter accumulators
+        if 'scatter_hist' in agg:
+            jobs.append((make_scatter,
+                         ({key: agg[key] for key in SCATTER_DIMS},
+                          os.path.join(opath,
+                                       OFILES['SCATTER'].format(*ofile_args)),
+                          dnt)))
+        return jobs
+
+    render_plots((job for scenario in aggs for job in _get_jobs(scenario)),
+                 plot_nprocs)
+    write_summary(stats, opath, year, month, dataset)
+    if nboot:
+        write_ci(cis, opath, year, month, dataset, adef, nboot)
+
+
+def make_pyramid_outputs(aggs, opath, year, month, dataset, adef,
+                         resolutions=None, thrs=10, plot_nprocs=1,
+                         nboot=None):
+    """
+    make_outputs() for every level of a grid pyramid with the finest level
+    adef. The outputs of each level are written to opath/RES-<res>deg.
+    Without resolutions only the outputs of adef are written to opath.
+    """
+    if resolutions is None:
+        make_outputs(aggs, opath, year, month, dataset, adef, thrs,
+                     plot_nprocs, nboot)
+        return
+
+    pyramid = get_pyramid(aggs, adef, resolutions)
+    for res, (level_adef, level_aggs) in pyramid.items():
+        level_opath = os.path.join(opath, 'RES-{}deg'.format(res))
+        os.makedirs(level_opath, exist_ok=True)
+        make_outputs(level_aggs, level_opath, year, month, dataset,
+                     level_adef, thrs, plot_nprocs, nboot)
+
+
+def make_binned_outputs(aggs, opath, year, month, dataset, adef,
+                        binning=None, bins=None, resolutions=None, thrs=10,
+                        plot_nprocs=1, nboot=None):
+    """
+    make_pyramid_outputs() of binned aggregates (see get_binned_idxs): the
+    outputs of all bins collapsed are written to opath, the outputs of
+    every selection of bins to opath/<label> (see get_bin_label).
+
+    bins: list of bins or of collections of bins summed up into one output,
+          e.g. [[5, 6, 7], [17, 18, 19]]. Default: every single bin.
+    Without binning the outputs of aggs are written to opath.
+    """
+    if binning is None:
+        make_pyramid_outputs(aggs, opath, year, month, dataset, adef,
+                             resolutions, thrs, plot_nprocs, nboot)
+        return
+
+    if bins is None:
+        bins = range(BINNINGS[binning])
+    for selection in [None] + list(bins):
+        sel_opath = opath
+        if selection is not None:
+            selection = np.atleast_1d(selection).tolist()
+            sel_opath = os.path.join(opath,
+                                     get_bin_label(binning, selection))
+            os.makedirs(sel_opath, exist_ok=True)
+        sel_aggs = {sc: select_bins(agg, adef.size, selection, densify=False)
+                    for sc, agg in aggs.items()}
+        make_pyramid_outputs(sel_aggs, sel_opath, year, month, dataset,
+                             adef, resolutions, thrs, plot_nprocs, nboot)
+
+
+# names of the leading dimensions of the aggregates, the last dimension
+# is the flattened target grid
+AGG_DIMS = {'cma': ('category',),
+            'cph': ('category',),
+            'ctth_nmatch': ('ctth_class',),
+            'ctth_count': ('ctth_var',),
+            'ctth_sum': ('ctth_var',),
+            'ctth_sumsq': ('ctth_var',)}
+# dimensions of the scatter plot accumulators (not on the target grid)
+SCATTER_DIMS = {'scatter_hist': ('scatter_var', 'imager_bin', 'caliop_bin'),
+                'scatter_sums': ('scatter_var', 'moment')}
+AGG_DTYPES = {'cma': np.int64,
+              'cph': np.int64,
+              'ctth_nmatch': np.int64,
+              'ctth_count': np.int64,
+              'ctth_sum': np.float64,
+              'ctth_sumsq': np.float64}
+AGG_COORDS = {'category': ['a', 'b', 'c', 'd'],
+              'ctth_class': list(CTTH_CLASSES),
+              'ctth_var': list(CTTH_VARS),
+              'scatter_var': SCATTER_VARS,
+              'moment': SCATTER_MOMENTS}
+
+
+def _satz_to_coord(satz_lim):
+    return np.nan if satz_lim is None else float(satz_lim)
+
+
+def _coord_to_satz(satz_lim):
+    return None if np.isnan(satz_lim) else float(satz_lim)
+
+
+def get_lazy_aggregates(agg, size, nbins=1):
+    """
+    Get the dense aggregates of one scenario with nbins * size grid boxes
+    (see expand_bins) as dask arrays. Sparse aggregates are only densified
+    when they are computed.
+    """
+    if not is_sparse(agg):
+        return {key: da.asarray(val) for key, val in agg.items()}
+    # not hashed, the statistics may be large
+    dense = dask.delayed(expand_bins, pure=False)(agg, size, nbins)
+    lazy = {key: da.from_delayed(dense[key],
+                                 (len(AGG_COORDS[dims[0]]), nbins * size),
+                                 AGG_DTYPES[key])
+            for key, dims in AGG_DIMS.items()}
+    lazy.update({key: da.asarray(agg[key]) for key in SCATTER_DIMS
+                 if key in agg})
+    return lazy
+
+
+def _get_score_maps(agg, shape, thrs):
+    """ Stacked float32 CMA, CPH and CTTH score maps (see get_scores). """
+    return tuple(np.stack([np.asarray(values[0], dtype=np.float32)
+                           for values in scores.values()])
+                 for scores in get_scores(agg, shape, thrs))
+
+
+def aggregates_to_dataset(aggs, adef, dataset, thrs=10, binning=None):
+    """
+    Convert {(dnt, satz_lim): aggregates} to a xarray Dataset.
+
+    Contains the raw aggregates and the scores derived from them on the
+    target grid with dataset, dnt and satz as coordinates. satz is NaN for
+    scenarios without satellite zenith angle limitation. Binned aggregates
+    (see get_binned_idxs) have an additional bin dimension, their scores
+    are the ones of all bins collapsed.
+
+    The variables are dask arrays of one scenario per chunk (see
+    get_lazy_aggregates), writing the dataset densifies and scores one
+    scenario at a time.
+    """
+    dnts = list(dict.fromkeys(sc[0] for sc in aggs))
+    satzs = list(dict.fromkeys(sc[1] for sc in aggs))
+    ny, nx = adef.shape
+
+    def _stack(get):
+        return da.stack([da.stack([get((dnt, satz_lim)) for dnt in dnts])
+                         for satz_lim in satzs])[np.newaxis]
+
+    base_dims = ('dataset', 'satz', 'dnt')
+    grid_dims, grid_shape = ('y', 'x'), (ny, nx)
+    nbins = 1
+    if binning is not None:
+        nbins = BINNINGS[binning]
+        grid_dims, grid_shape = ('bin', 'y', 'x'), (nbins, ny, nx)
+    aggs = {sc: get_lazy_aggregates(agg, adef.size, nbins)
+            for sc, agg in aggs.items()}
+    data_vars = dict()
+    for key, dims in AGG_DIMS.items():
+        values = _stack(lambda sc: aggs[sc][key].reshape((-1,) + grid_shape))
+        data_vars[key] = (base_dims + dims + grid_dims, values)
+    for key, dims in SCATTER_DIMS.items():
+        data_vars[key] = (base_dims + dims, _stack(lambda sc: aggs[sc][key]))
+
+    coords = {'dataset': [dataset],
+              'satz': [_satz_to_coord(s) for s in satzs],
+              'dnt': dnts}
+    coords.update(AGG_COORDS)
+    if binning is not None:
+        coords['bin'] = np.arange(nbins)
+
+    # scores derived from the aggregates, names from a single grid box
+    names = [list(scores) for scores in get_scores(
+                 {key: np.ones((len(AGG_COORDS[dims[0]]), 1),
+                               AGG_DTYPES[key])
+                  for key, dims in AGG_DIMS.items()}, (1, 1), thrs)]
+    if binning is not None:
+        aggs = {sc: select_bins(agg, adef.size) for sc, agg in aggs.items()}
+    maps = {sc: dask.delayed(_get_score_maps, nout=3, pure=False)(
+                {key: agg[key] for key in AGG_DIMS}, adef.shape, thrs)
+            for sc, agg in aggs.items()}
+    for cnt, var in enumerate(['CMA', 'CPH', 'CTTH']):
+        values = _stack(lambda sc: da.from_delayed(
+                            maps[sc][cnt], (len(names[cnt]), ny, nx),
+                            np.float32))
+        data_vars[var + '_scores'] = (base_dims + (var + '_score', 'y', 'x'),
+                                      values)
+        coords[var + '_score'] = names[cnt]
+
+    attrs = {'area_id': adef.area_id,
+             'thrs': thrs}
+    if binning is not None:
+        attrs['binning'] = binning
+    return xr.Dataset(data_vars, coords=coords, attrs=attrs)
+
+
+def save_aggregates(aggs, ofile, adef, dataset, year, month, thrs=10,
+                    attrs=None, binning=None):
+    """
+    Write aggregates and scores to a compressed, chunked NetCDF file.
+
+    The file is replaced atomically, readers never see a partial file.
+
+    attrs:   additional global attributes
+    binning: binning of the aggregates (see get_binned_idxs)
+    """
+    ds = aggregates_to_dataset(aggs, adef, dataset, thrs, binning)
+    ds.attrs.update({'year': str(year), 'month': str(month),
+                     'area_def': adef.dump()})
+    ds.attrs.update(attrs or {})
+    encoding = dict()
+    for var in ds.data_vars:
+        chunks = (1,) * (ds[var].ndim - 2) + ds[var].shape[-2:]
+        encoding[var] = {'zlib': True, 'complevel': 4, 'chunksizes': chunks}
+    tmp = ofile + '.tmp{}'.format(os.getpid())
+    try:
+        ds.to_netcdf(tmp, encoding=encoding)
+        os.replace(tmp, ofile)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    print('SAVED ', os.path.basename(ofile))
+
+
+def load_aggregates(ifile):
+    """
+    Read aggregates written by save_aggregates().
+
+    The aggregates are dask arrays read one scenario at a time when they
+    are computed, the file is kept open as long as they are referenced.
+
+    Returns {(dnt, satz_lim): aggregates} and the file attributes
+    (including dataset and binning if the aggregates are binned).
+    """
+    aggs = dict()
+    # one chunk per scenario (and bin), selections of bins read only those
+    ds = xr.open_dataset(ifile)
+    ds = ds.chunk({dim: 1 for dim in ['dataset', 'satz', 'dnt', 'bin']
+                   if dim in ds.dims})
+    attrs = dict(ds.attrs)
+    attrs['dataset'] = str(ds['dataset'].values[0])
+    for isatz, satz_lim in enumerate(ds['satz'].values):
+        for idnt, dnt in enumerate(ds['dnt'].values):
+            agg = dict()
+            for key in AGG_DIMS:
+                values = ds[key].data[0, isatz, idnt]
+                agg[key] = values.reshape(values.shape[0], -1)
+            for key in SCATTER_DIMS:
+                if key in ds:
+                    agg[key] = ds[key].data[0, isatz, idnt]
+            aggs[(str(dnt), _coord_to_satz(satz_lim))] = agg
+    return aggs, attrs
+
+
+def get_store_area(attrs, area_file='areas.yaml'):
+    """ Get the area definition of an aggregate file from its attributes. """
+    # files of older versions only have the area id
+    if 'area_def' in attrs:
+        return load_area_from_string(attrs['area_def'], attrs['area_id'])
+    return get_area_def(area_file, attrs['area_id'])
+
+
+def get_target_area(resolutions=None, area_id='pc_world'):
+    """
+    Get the target grid: the global lat/lon grid of the finest resolution
+    in degrees if resolutions are given, else area_id of areas.yaml.
+    """
+    if resolutions is None:
+        return get_area_def('areas.yaml', area_id)
+    return get_latlon_area(min(resolutions))
+
+
+def run_plots(ifile, opath, area_file='areas.yaml', plot_nprocs=1,
+              resolutions=None, nboot=None, bins=None):
+    """
+    Plot CMA, CPH and CTTH maps from an aggregate file without touching
+    the matchup data.
+
+    resolutions: derive maps of these resolutions [deg] from the grid of the
+                 file, the finest one has to be the resolution of the file
+    nboot:       bootstrap replicates of the score confidence intervals
+    bins:        selections of bins of binned aggregates to plot (see
+                 make_binned_outputs)
+    """
+    aggs, attrs = load_aggregates(ifile)
+    adef = get_store_area(attrs, area_file)
+    make_binned_outputs(aggs, opath, attrs['year'], attrs['month'],
+                        attrs['dataset'], adef, attrs.get('binning'), bins,
+                        resolutions, int(attrs['thrs']), plot_nprocs, nboot)
+
+
+def run(ipath, ifile, opath, dnts, satzs,
+        year, month, dataset, chunksize=None, idxs_cache=True,
+        store=None, cache=False, plot_nprocs=1, stage_log=None,
+        perf_report=None, scheduler=None, nworkers=None,
+        memory_budget=None, resolutions=None, nboot=None, binning=None,
+        bins=None, strata=None):
+    """
+    chunksize:     chunk size of the matchup arrays, None: derived from
+                   memory_budget (DEFAULT_CHUNKSIZE without budget)
+    store:         optional NetCDF file to save aggregates and scores to
+    cache:         use sidecar cache of decoded matchup variables
+    plot_nprocs:   number of processes rendering the maps
+    stage_log:     file to append JSON log lines of every stage to
+    perf_report:   html file for a dask performance report (distributed)
+    scheduler:     dask scheduler (see use_scheduler)
+    nworkers:      number of scheduler threads/processes
+    memory_budget: memory for the matchup chunks in flight and their sparse
+                   statistics (see get_chunksize), bytes, '16GB' or 'auto'
+                   (half of the physical memory)
+    resolutions:   list of lat/lon grid resolutions [deg] of the maps,
+                   e.g. [0.25, 0.5, 1, 2]. Pixels are accumulated once on
+                   the finest grid, coarser levels are block sums of it.
+                   Default: pc_world of areas.yaml
+    nboot:         number of bootstrap replicates of the per grid box
+                   confidence intervals of the CMA/CPH Hitrate, Kuiper,
+                   Heidke and Bias, written to OFILES['CI'] next to the
+                   maps. None: no intervals
+    binning:       extra grouping of the aggregates by local solar 'hour',
+                   'day' of month or 'sunz' bin (see BINNINGS), obtained in
+                   the same pass over the pixels. The outputs of all bins
+                   are written to opath, the ones of each bin to
+                   opath/<label>, e.g. opath/HOUR-06
+    bins:          selections of bins to write outputs for, e.g.
+                   [[5, 6, 7], [17, 18, 19]], default: every single bin
+    strata:        satz limits [deg] resolved by satz/sunz stratified
+                   accumulators, e.g. STRATA_SATZ or range(5, 90, 5). The
+                   pixels are then reduced once for all scenarios, every
+                   satz limit of satzs has to be one of strata. Memory of
+                   the accumulators grows with the number of strata.
+    """
+    with stage_logging(stage_log, perf_report), \
+            use_scheduler(scheduler, nworkers):
+        scenarios = get_scenarios(dnts, satzs, dataset)
+
+        # read and decode matchup data once for all scenarios
+        mfile = os.path.join(ipath, ifile)
+        adef = get_target_area(resolutions)
+        aggs = reduce_file(mfile, scenarios, adef, dataset, chunksize,
+                           idxs_cache, cache, memory_budget,
+                           get_nworkers(scheduler, nworkers), binning,
+                           strata)
+        if store is not None:
+            save_aggregates(aggs, store, adef, dataset, year, month,
+                            binning=binning)
+
+        make_binned_outputs(aggs, opath, year, month, dataset, adef,
+                            binning, bins, resolutions,
+                            plot_nprocs=plot_nprocs, nboot=nboot)
+
+
+def _reduce_file_worker(mfile, scenarios, adef, dataset, chunksize,
+                        idxs_cache, cache, memory_budget, binning, strata):
+    """ reduce_file() for process pool workers, one thread per worker """
+    with dask.config.set(scheduler='synchronous'):
+        return reduce_file(mfile, scenarios, adef, dataset, chunksize,
+                           idxs_cache, cache, memory_budget, 1, binning,
+                           strata)
+
+
+def merge_scenario_aggregates(aggs_a, aggs_b):
+    """ Merge {scenario: aggregates} dicts of two (sets of) files. """
+    return {sc: merge_aggregates(aggs_a[sc], aggs_b[sc]) for sc in aggs_a}
+
+
+def tree_merge(partials, merge=merge_scenario_aggregates):
+    """
+    Merge an iterable of partial aggregates pairwise in a binary tree.
+
+    Partials are merged as they arrive, so at most log2(N) of them are
+    held in memory at a time.
+    """
+    stack = []
+    for part in partials:
+        level = 0
+        while len(stack) > 0 and stack[-1][0] == level:
+            part = merge(stack.pop()[1], part)
+            level += 1
+        stack.append((level, part))
+    if len(stack) == 0:
+        raise Exception('Nothing to merge')
+    merged = stack.pop()[1]
+    while len(stack) > 0:
+        merged = merge(stack.pop()[1], merged)
+    return merged
+
+
+def reduce_files(mfiles, scenarios, adef, dataset, chunksize=None,
+                 idxs_cache=True, nprocs=1, cache=False, memory_budget=None,
+                 nworkers=None, binning=None, strata=None):
+    """
+    Reduce matchup files to merged partial aggregates of every scenario.
+
+    nprocs:        number of worker processes, files are distributed over
+                   the workers and each returns its partial aggregates to
+                   be merged in a tree (see tree_merge). Serially reduced
+                   files are merged into a running accumulator.
+    memory_budget: total memory budget, shared by the worker processes
+    nworkers:      number of dask workers (serial case, see get_chunksize)
+    binning:       key of BINNINGS to group the aggregates by
+    strata:        satz limits of stratified aggregates (see
+                   reduce_collocated)
+    """
+    if nprocs > 1:
+        if memory_budget is not None:
+            memory_budget = get_memory_budget(memory_budget) // nprocs
+        worker = functools.partial(_reduce_file_worker, scenarios=scenarios,
+                                   adef=adef, dataset=dataset,
+                                   chunksize=chunksize,
+                                   idxs_cache=idxs_cache, cache=cache,
+                                   memory_budget=memory_budget,
+                                   binning=binning, strata=strata)
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            return tree_merge(pool.map(worker, mfiles))
+
+    # serial files are merged into one running accumulator
+    merged = None
+    for mfile in mfiles:
+        print('REDUCING ', os.path.basename(mfile))
+        aggs = reduce_file(mfile, scenarios, adef, dataset, chunksize,
+                           idxs_cache, cache, memory_budget, nworkers,
+                           binning, strata)
+        merged = aggs if merged is None else \
+            merge_scenario_aggregates(merged, aggs)
+    if merged is None:
+        raise Exception('Nothing to merge')
+    return merged
+
+
+def run_archive(ipattern, opath, dnts, satzs, year, month, dataset,
+                chunksize=None, idxs_cache=True, nprocs=1, store=None,
+                cache=False, plot_nprocs=1, stage_log=None,
+                perf_report=None, scheduler=None, nworkers=None,
+                memory_budget=None, resolutions=None, area_id='pc_world',
+                index=None, period=None, nboot=None, binning=None,
+                bins=None, strata=None):
+    """
+    Validate all matchup files in a directory or matching a glob pattern.
+
+    Files are reduced to per grid box partial aggregates which are merged,
+    so memory usage does not depend on the number of files. With nprocs > 1
+    files are reduced in parallel by a pool of worker processes. If store is
+    given, the merged aggregates and scores are saved to this NetCDF file.
+    With cache set, decoded matchup variables are memory-mapped from a
+    sidecar cache next to each file (created on first use). The maps are
+    rendered by plot_nprocs processes. Timings, memory and dask statistics
+    of every stage are appended as JSON lines to stage_log if given. See
+    run() for scheduler, nworkers, memory_budget, resolutions, nboot,
+    binning, bins and strata.
+
+    area_id: target area of areas.yaml (if no resolutions are given)
+    index:   archive index file (built/updated on the fly), files without
+             pixels in the target area or period are skipped unread
+    period:  (start, end) of the period to validate, needs index
+    """
+    with stage_logging(stage_log, perf_report), \
+            use_scheduler(scheduler, nworkers):
+        scenarios = get_scenarios(dnts, satzs, dataset)
+        adef = get_target_area(resolutions, area_id)
+
+        mfiles = get_matchup_files(ipattern)
+        if index is not None:
+            mfiles = select_files(mfiles,
+                                  update_archive_index(mfiles, index, dataset),
+                                  adef, period)
+        elif period is not None:
+            raise Exception('Selecting a period needs an archive index')
+        if len(mfiles) == 0:
+            raise Exception('No matchup files in area/period')
+
+        aggs = reduce_files(mfiles, scenarios, adef, dataset, chunksize,
+                            idxs_cache, nprocs, cache, memory_budget,
+                            get_nworkers(scheduler, nworkers), binning,
+                            strata)
+        if store is not None:
+            save_aggregates(aggs, store, adef, dataset, year, month,
+                            binning=binning)
+
+        make_binned_outputs(aggs, opath, year, month, dataset, adef,
+                            binning, bins, resolutions,
+                            plot_nprocs=plot_nprocs, nboot=nboot)
+
+
+def get_ingest_record(mfile):
+    """ Get the ingest registry entry (path, size, mtime, sha1) of a file. """
+    stat = os.stat(mfile)
+    return {'file': os.path.abspath(mfile),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha1': get_file_hash(mfile)}
+
+
+def get_new_files(mfiles, registry):
+    """
+    Get the files of mfiles which are not in the ingest registry yet.
+
+    A file is known if path, size and mtime are registered (without
+    reading it), or if its content hash is registered (e.g. a copied or
+    renamed file). Files changed since their ingestion are skipped as well,
+    their old contribution cannot be removed from the store.
+
+    Returns list of (file, ingest record).
+    """
+    by_path = {rec['file']: rec for rec in registry}
+    hashes = {rec['sha1'] for rec in registry}
+    new = []
+    for mfile in mfiles:
+        stat = os.stat(mfile)
+        rec = by_path.get(os.path.abspath(mfile))
+        if rec is not None and (rec['size'], rec['mtime_ns']) == (
+                stat.st_size, stat.st_mtime_ns):
+            print('SKIPPED ', os.path.basename(mfile), '(already ingested)')
+            continue
+        record = get_ingest_record(mfile)
+        if record['sha1'] in hashes:
+            print('SKIPPED ', os.path.basename(mfile), '(already ingested)')
+        elif rec is not None:
+            print('SKIPPED ', os.path.basename(mfile),
+                  '(changed since ingestion, rebuild the store)')
+        else:
+            new.append((mfile, record))
+            hashes.add(record['sha1'])
+    return new
+
+
+def update_store(ipattern, store, dnts, satzs, year, month, dataset,
+                 opath=None, chunksize=None, idxs_cache=True, nprocs=1,
+                 cache=False, plot_nprocs=1, memory_budget=None,
+                 resolutions=None, nboot=None, binning=None, bins=None,
+                 strata=None):
+    """
+    Add new matchup files to a persistent monthly aggregate store.
+
+    The store (NetCDF, see save_aggregates) keeps the accumulated
+    aggregates of every scenario together with a registry of the ingested
+    files. Only files not ingested yet are reduced and added to the store,
+    re-ingesting a file is detected and skipped. The store is created by
+    the first call. If opath is given, the maps, scatter plots and summary
+    are regenerated from the updated aggregates (see run() for
+    resolutions, nboot, binning, bins and strata).
+    """
+    scenarios = get_scenarios(dnts, satzs, dataset)
+    adef = get_target_area(resolutions)
+
+    aggs, registry = None, []
+    if os.path.isfile(store):
+        aggs, attrs = load_aggregates(store)
+        if 'ingested' not in attrs:
+            raise Exception('{} has no ingest registry, it was not created '
+                            'by update_store()'.format(store))
+        if attrs['dataset'] != dataset or \
+                (attrs['year'], attrs['month']) != (str(year), str(month)):
+            raise Exception('{} holds {} {}{}'.format(
+                store, attrs['dataset'], attrs['year'], attrs['month']))
+        if set(aggs) != set(scenarios):
+            raise Exception('Scenarios differ from the ones in '
+                            '{}'.format(store))
+        # compared as written, a reloaded proj dict area differs in its crs
+        if get_store_area(attrs).dump() != adef.dump():
+            raise Exception('Target grid differs from the one of '
+                            '{}'.format(store))
+        if attrs.get('binning') != binning:
+            raise Exception('Binning differs from the one of '
+                            '{}'.format(store))
+        registry = json.loads(attrs['ingested'])
+
+    new = get_new_files(get_matchup_files(ipattern), registry)
+    if len(new) == 0:
+        print('No new matchup files for {}'.format(store))
+        return
+
+    new_aggs = reduce_files([mfile for mfile, _ in new], scenarios, adef,
+                            dataset, chunksize, idxs_cache, nprocs, cache,
+                            memory_budget, binning=binning, strata=strata)
+    if aggs is not None:
+        # merged lazily, the store is written one scenario at a time
+        nbins = 1 if binning is None else BINNINGS[binning]
+        new_aggs = {sc: get_lazy_aggregates(agg, adef.size, nbins)
+                    for sc, agg in new_aggs.items()}
+        new_aggs = merge_scenario_aggregates(aggs, new_aggs)
+    registry += [record for _, record in new]
+    save_aggregates(new_aggs, store, adef, dataset, year, month,
+                    attrs={'ingested': json.dumps(registry)},
+                    binning=binning)
+
+    if opath is not None:
+        # lazy aggregates of the replaced store are not read again, the
+        # scenarios keep the keys of new_aggs
+        aggs, _ = load_aggregates(store)
+        aggs = {sc: aggs[sc] for sc in new_aggs}
+        make_binned_outputs(aggs, opath, year, month, dataset, adef,
+                            binning, bins, resolutions,
+                            plot_nprocs=plot_nprocs, nboot=nboot)
@@ -0,0 +1,328 @@
+"""
+Batch validation of many months/datasets from a job manifest.
+
+Every job of a manifest (YAML or JSON) is validated with run_archive() and
+recorded in a ledger when it is completed. Jobs whose matchup files,
+parameters and code are unchanged since their last run (and whose outputs
+still exist) are skipped, so an interrupted batch resumes with the first
+job not completed:
+
+    python batch.py run jobs.yaml --nprocs 4
+    python batch.py status jobs.yaml
+
+Manifest, the path templates are filled in with dataset, year and month:
+
+    defaults:
+      dataset: CCI
+      dnts: [ALL, DAY, NIGHT, TWILIGHT]
+      satzs: [null, 70]
+      ipattern: /data/matchups/{dataset}/{year}{month}*.h5
+      opath: /data/figs/{dataset}/{year}
+      store: /data/stores/{dataset}_{year}{month}.nc
+    jobs:
+      - {year: '2019', month: '07'}
+      - {year: '2019', month: '08', nboot: 200}
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import datetime
+import hashlib
+import inspect
+import json
+import os
+import time
+import atrain_plot as ap
+
+
+LEDGER_VERSION = 1
+
+# run_archive() arguments every job needs
+JOB_KEYS = ['dataset', 'year', 'month', 'dnts', 'satzs', 'ipattern',
+            'opath']
+
+# arguments formatted with dataset, year and month
+PATH_KEYS = ['ipattern', 'opath', 'store', 'index', 'stage_log',
+             'perf_report']
+
+# run_archive() arguments which do not change the outputs (up to rounding),
+# not part of the job hash
+RUNTIME_KEYS = ['chunksize', 'idxs_cache', 'nprocs', 'cache', 'plot_nprocs',
+                'stage_log', 'perf_report', 'scheduler', 'nworkers',
+                'memory_budget']
+
+# source files the outputs depend on
+CODE_FILES = ['atrain_plot.py', 'scores.py']
+
+
+def load_manifest(mfile):
+    """ Read a YAML (.yaml/.yml) or JSON job manifest. """
+    with open(mfile) as fh:
+        if os.path.splitext(mfile)[1].lower() in ['.yaml', '.yml']:
+            import yaml
+            return yaml.safe_load(fh)
+        return json.load(fh)
+
+
+def get_jobs(manifest):
+    """
+    Get the run_archive() arguments of every job of a manifest: the job
+    entries updated with their defaults, month as two digits and the path
+    templates filled in. A job may be given a 'name' (default
+    <dataset>_<year><month>).
+    """
+    options = set(inspect.signature(ap.run_archive).parameters)
+    jobs = []
+    for entry in manifest['jobs']:
+        job = dict(manifest.get('defaults', dict()))
+        job.update(entry)
+        missing = [key for key in JOB_KEYS if job.get(key) is None]
+        if len(missing) > 0:
+            raise Exception('Job {} misses {}'.format(entry, missing))
+        unknown = set(job) - options - {'name'}
+        if len(unknown) > 0:
+            raise Exception('Unknown job options {}'.format(sorted(unknown)))
+        job['year'] = str(job['year'])
+        job['month'] = '{:02d}'.format(int(job['month']))
+        for key in PATH_KEYS:
+            if job.get(key) is not None:
+                job[key] = job[key].format(dataset=job['dataset'],
+                                           year=job['year'],
+                                           month=job['month'])
+        job.setdefault('name', '{}_{}{}'.format(job['dataset'], job['year'],
+                                                job['month']))
+        jobs.append(job)
+
+    # outputs are told apart by the year and month in their file names
+    for key in ['name', ('opath', 'year', 'month'), 'store']:
+        keys = [key] if isinstance(key, str) else list(key)
+        values = [tuple(job[k] for k in keys) for job in jobs
+                  if job.get(keys[0]) is not None]
+        if len(set(values)) != len(values):
+            raise Exception('Jobs with the same {}'.format('/'.join(keys)))
+    return jobs
+
+
+def read_ledger(ledger):
+    """
+    Get the last record {job name: record} of every job in a ledger.
+
+    A line cut off by an interrupted write is ignored.
+    """
+    records = dict()
+    if not os.path.isfile(ledger):
+        return records
+    with open(ledger) as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('version') == LEDGER_VERSION:
+                records[record['job']] = record
+    return records
+
+
+def append_ledger(ledger, record):
+    """ Append a record as one JSON line and sync it to disk. """
+    with open(ledger, 'a') as fh:
+        fh.write(json.dumps(record) + '\n')
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def get_input_records(mfiles, known):
+    """
+    Get the ingest records (path, size, mtime, sha1) of matchup files.
+
+    Files with the path, size and mtime of a known record are not read
+    again, their content hash is taken from the record.
+    """
+    records = []
+    for mfile in mfiles:
+        stat = os.stat(mfile)
+        rec = known.get(os.path.abspath(mfile))
+        if rec is None or (rec['size'], rec['mtime_ns']) != (
+                stat.st_size, stat.st_mtime_ns):
+            rec = ap.get_ingest_record(mfile)
+        records.append(rec)
+    return records
+
+
+def get_code_hash():
+    """ Get sha1 of the source files the outputs depend on. """
+    path = os.path.dirname(os.path.abspath(ap.__file__))
+    sha1 = hashlib.sha1()
+    for name in CODE_FILES:
+        sha1.update(ap.get_file_hash(os.path.join(path, name)).encode())
+    return sha1.hexdigest()
+
+
+def get_job_params(job):
+    """ Get the job arguments which determine its outputs. """
+    return {key: value for key, value in job.items()
+            if key not in RUNTIME_KEYS and key != 'name'}
+
+
+def get_job_key(job, inputs, code):
+    """ Get content hash of the inputs, parameters and code of a job. """
+    content = {'params': get_job_params(job),
+               'inputs': [(rec['file'], rec['sha1']) for rec in inputs],
+               'code': code}
+    return hashlib.sha1(json.dumps(content, sort_keys=True,
+                                   default=list).encode()).hexdigest()
+
+
+def get_job_outputs(job):
+    """
+    Get {file: mtime_ns} of the outputs of a job on disk: files in opath
+    (and below) with year and month in their name, and the store.
+    """
+    tag = '{}{}'.format(job['year'], job['month'])
+    outputs = dict()
+    for root, _, files in os.walk(job['opath']):
+        for name in files:
+            if tag in name:
+                ofile = os.path.abspath(os.path.join(root, name))
+                outputs[ofile] = os.stat(ofile).st_mtime_ns
+    store = job.get('store')
+    if store is not None and os.path.isfile(store):
+        outputs[os.path.abspath(store)] = os.stat(store).st_mtime_ns
+    return outputs
+
+
+def get_job_state(record, key):
+    """ State of a job from its ledger record and its current key. """
+    if record is None:
+        return 'new'
+    if record['key'] != key:
+        return 'changed'
+    if not all(os.path.isfile(ofile) for ofile in record['outputs']):
+        return 'outputs missing'
+    return 'done'
+
+
+def plan_jobs(jobs, records):
+    """
+    Get (job, key, input records, state) of every job, see get_job_state.
+    """
+    known = {rec['file']: rec for record in records.values()
+             for rec in record['inputs']}
+    code = get_code_hash()
+    plan = []
+    for job in jobs:
+        inputs = get_input_records(ap.get_matchup_files(job['ipattern']),
+                                   known)
+        key = get_job_key(job, inputs, code)
+        plan.append((job, key, inputs,
+                     get_job_state(records.get(job['name']), key)))
+    return plan
+
+
+def run_job(job):
+    """
+    Validate the matchup files of one job with run_archive().
+
+    Returns the output files written (or rewritten) and the run time.
+    """
+    os.makedirs(job['opath'], exist_ok=True)
+    before = get_job_outputs(job)
+    start = time.perf_counter()
+    kwargs = {key: value for key, value in job.items() if key != 'name'}
+    ap.run_archive(**kwargs)
+    elapsed = time.perf_counter() - start
+    outputs = [ofile for ofile, mtime in get_job_outputs(job).items()
+               if before.get(ofile) != mtime]
+    return sorted(outputs), elapsed
+
+
+def run_batch(mfile, ledger=None, nprocs=1, force=False):
+    """
+    Run the jobs of a manifest which are not up to date.
+
+    Jobs are run by a pool of nprocs processes (see run_archive() nprocs
+    for files of a job in parallel). Every completed job is appended to
+    the ledger (default: <manifest>.ledger) at once, so an interrupted
+    batch resumes with the jobs not completed. A job is up to date if the
+    content of its matchup files, its parameters (but RUNTIME_KEYS) and
+    CODE_FILES are those of its last run and its outputs exist. A failed
+    job does not stop the others, it is run again by the next batch.
+
+    force: run all jobs
+    """
+    ledger = mfile + '.ledger' if ledger is None else ledger
+    plan = plan_jobs(get_jobs(load_manifest(mfile)), read_ledger(ledger))
+    pending = dict()
+    for job, key, inputs, state in plan:
+        if state == 'done' and not force:
+            print('SKIPPED ', job['name'], '(up to date)')
+        else:
+            pending[job['name']] = (job, key, inputs)
+
+    def _complete(name, outputs, elapsed):
+        job, key, inputs = pending[name]
+        append_ledger(ledger, {'version': LEDGER_VERSION,
+                               'job': name,
+                               'key': key,
+                               'params': get_job_params(job),
+                               'inputs': inputs,
+                               'outputs': outputs,
+                               'time_s': elapsed,
+                               'date': datetime.datetime.now().isoformat()})
+        print('COMPLETED ', name, '({:.1f} s)'.format(elapsed))
+
+    failed = []
+    if nprocs > 1:
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            futures = {pool.submit(run_job, job): name
+                       for name, (job, _, _) in pending.items()}
+            for future in as_completed(futures):
+                try:
+                    _complete(futures[future], *future.result())
+                except Exception as err:
+                    print('FAILED ', futures[future], err)
+                    failed.append(futures[future])
+    else:
+        for name, (job, _, _) in pending.items():
+            print('RUNNING ', name)
+            try:
+                _complete(name, *run_job(job))
+            except Exception as err:
+                print('FAILED ', name, err)
+                failed.append(name)
+    if len(failed) > 0:
+        raise Exception('Jobs failed: {}'.format(', '.join(failed)))
+
+
+def print_status(mfile, ledger=None):
+    """ Print the state of every job of a manifest (see get_job_state). """
+    ledger = mfile + '.ledger' if ledger is None else ledger
+    plan = plan_jobs(get_jobs(load_manifest(mfile)), read_ledger(ledger))
+    for job, _, inputs, state in plan:
+        print('{:20s} {:>6d} files  {}'.format(job['name'], len(inputs),
+                                               state))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='run the jobs not up to date')
+    run.add_argument('manifest')
+    run.add_argument('--ledger', default=None)
+    run.add_argument('--nprocs', type=int, default=1,
+                     help='number of jobs run in parallel')
+    run.add_argument('--force', action='store_true', help='run all jobs')
+
+    status = sub.add_parser('status', help='print the state of every job')
+    status.add_argument('manifest')
+    status.add_argument('--ledger', default=None)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_batch(args.manifest, args.ledger, args.nprocs, args.force)
+    else:
+        print_status(args.manifest, args.ledger)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+"""
+Synthetic matchup files and stage benchmarks of the validation pipeline.
+
+Generate a synthetic atrain_match matchup file and benchmark it:
+
+    python benchmark.py generate /tmp/synthetic.h5 --npix 1000000
+    python benchmark.py run /tmp/synthetic.h5 --ofile bench.json
+    python benchmark.py run /tmp/synthetic.h5 --resolution 0.25
+    python benchmark.py compare bench_old.json bench.json
+"""
+from pyresample.bucket import BucketResampler
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+import dask
+import dask.array as da
+import h5py
+import numpy as np
+import atrain_plot as ap
+
+
+# imager group name of the matchup files for each dataset
+IMAGER_GROUPS = {'CCI': 'cci', 'CLAAS': 'pps', 'CLAAS3': 'pps'}
+
+# stages of the pipeline, in order of execution
+STAGES = ['load', 'masking', 'indexing', 'cma', 'cph', 'ctth', 'plotting',
+          'scatter']
+
+
+def _synthetic_block(rng, n, nlayers, start_time):
+    """ Get one block of synthetic CALIOP and imager variables. """
+    lat = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    # CALIOP profiles every 1/3 s
+    sec_1970 = start_time + np.arange(n) / 3.
+    lon = rng.uniform(-180, 180, n)
+
+    # CALIOP top layer: feature type (1 clear, 2 cloud, 3 aerosol),
+    # phase (bits 6-7) and cloud type (bits 10-12)
+    cloudy = rng.random(n) < 0.65
+    ftype = np.where(cloudy, 2, rng.choice([1, 3], n))
+    phase = rng.integers(0, 4, n)
+    ctype = rng.integers(0, 8, n)
+    flags = (ftype | (phase << 5) | (ctype << 9)).astype(np.uint16)
+    # lower layers are clear
+    cflags = np.ones((n, nlayers), dtype=np.uint16)
+    cflags[:, 0] = flags
+
+    # CALIOP cloud top [km] and temperature [deg C]
+    elev = np.maximum(rng.normal(300, 500, n), 0)
+    cal_cth = np.clip(rng.gamma(2., 2.5, n), 0.1, 20)
+    cal_ctt = 15 - 6.5 * cal_cth + rng.normal(0, 2, n)
+    top = np.full((n, nlayers), -9999, dtype=np.float32)
+    top[:, 0] = np.where(cloudy, cal_cth + elev / 1000, -9999)
+    temp = np.full((n, nlayers), -9999, dtype=np.float32)
+    temp[:, 0] = np.where(cloudy, cal_ctt, -9999)
+
+    # imager detects most of the clouds with noisy heights [m] / temps [K]
+    detected = np.where(cloudy, rng.random(n) < 0.9, rng.random(n) < 0.1)
+    cth = np.where(detected, cal_cth * 1000 + rng.normal(0, 1500, n), -9)
+    ctt = np.where(detected, cal_ctt + 273.15 + rng.normal(0, 8, n), -9)
+    cma = np.where(rng.random(n) < 0.02, -1, detected.astype(np.int8))
+    # 0 no cloud, 1 liquid, 2 ice, -1 missing
+    cph = np.where(detected, 1 + (phase % 2), 0)
+    cph = np.where(rng.random(n) < 0.02, -1, cph)
+
+    calipso = {'sec_1970': sec_1970,
+               'feature_classification_flags': cflags,
+               'layer_top_altitude': top,
+               'midlayer_temperature': temp,
+               'elevation': elev.astype(np.float32),
+               'cloud_fraction': np.where(cloudy, rng.uniform(0.5, 1, n),
+                                          rng.uniform(0, 0.5, n)
+                                          ).astype(np.float32)}
+    imager = {'ctth_height': cth.astype(np.float32),
+              'ctth_temperature': ctt.astype(np.float32),
+              'cpp_phase': cph.astype(np.int8),
+              'cloudmask': cma.astype(np.int8),
+              'satz': rng.uniform(0, 85, n).astype(np.float32),
+              'sunz': rng.uniform(0, 180, n).astype(np.float32),
+              'latitude': lat.astype(np.float32),
+              'longitude': lon.astype(np.float32)}
+    return calipso, imager
+
+
+def make_synthetic_file(ofile, npix, dataset='CCI', seed=0, nlayers=10,
+                        blocksize=1000000, start_time=1561939200.):
+    """
+    Write a synthetic matchup file with the calipso and cci/pps group layout
+    of atrain_match output.
+
+    The file is written block by block, so files of 10**8 pixels and more
+    can be generated with bounded memory.
+
+    npix:       number of matchup pixels
+    nlayers:    number of CALIOP layers (only the top layer is used)
+    blocksize:  number of pixels generated at once
+    start_time: time of the first pixel [seconds since 1970]
+    """
+    if dataset not in IMAGER_GROUPS:
+        raise Exception('Dataset {} not known!'.format(dataset))
+    npix = int(npix)
+    rng = np.random.default_rng(seed)
+
+    with h5py.File(ofile, 'w') as file:
+        groups = {'calipso': file.create_group('calipso'),
+                  'imager': file.create_group(IMAGER_GROUPS[dataset])}
+        for start in range(0, npix, blocksize):
+            n = min(blocksize, npix - start)
+            blocks = dict(zip(['calipso', 'imager'],
+                              _synthetic_block(rng, n, nlayers,
+                                               start_time + start / 3.)))
+            for gname, block in blocks.items():
+                group = groups[gname]
+                for name, values in block.items():
+                    if name not in group:
+                        group.create_dataset(
+                            name, shape=(npix,) + values.shape[1:],
+                            dtype=values.dtype,
+                            chunks=(min(npix, 65536),) + values.shape[1:])
+                    group[name][start:start + n] = values
+    print('SAVED ', os.path.basename(ofile))
+
+
+class _Stage:
+    """ Context manager timing one stage and tracing its peak memory. """
+
+    def __init__(self, results, name, npix, trace_memory):
+        self.results = results
+        self.name = name
+        self.npix = npix
+        self.trace_memory = trace_memory
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        result = {'time_s': elapsed,
+                  'mpix_per_s': self.npix / elapsed / 1e6}
+        if self.trace_memory:
+            result['peak_mem_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        # resident set size peak of the process so far (kB on linux)
+        result['max_rss_mb'] = resource.getrusage(
+                                   resource.RUSAGE_SELF).ru_maxrss / 2**10
+        self.results[self.name] = result
+        print('{:10s} {:8.2f} s'.format(self.name, elapsed))
+
+
+def get_benchmark_area(resolution=2, area_file=None, area_id='pc_world'):
+    """
+    Get the target grid of a benchmark: area_id of area_file if given, else
+    the global lat/lon grid of resolution [deg] (see get_latlon_area).
+    """
+    if area_file is not None:
+        return ap.get_area_def(area_file, area_id)
+    return ap.get_latlon_area(resolution)
+
+
+def run_benchmark(ifile, dataset='CCI', chunksize=100000, ofile=None,
+                  dnts=('ALL', 'DAY', 'NIGHT', 'TWILIGHT'), satzs=(None, 70),
+                  trace_memory=True, resolution=2, area_file=None,
+                  area_id='pc_world'):
+    """
+    Time and memory-profile every stage of the pipeline on one matchup file.
+
+    The matchup data are loaded into memory first, so each of the following
+    stages measures its own work only. Peak memory is traced with
+    tracemalloc (numpy and python allocations), which slows down the stages
+    (plotting in particular); only compare timings of runs with the same
+    trace_memory setting. The target grid is the global lat/lon grid of
+    resolution [deg], or area_id of area_file if given.
+
+    Returns the results and writes them to ofile as JSON if given.
+    """
+    scenarios = ap.get_scenarios(list(dnts), list(satzs), dataset)
+    adef = get_benchmark_area(resolution, area_file, area_id)
+    stages = dict()
+
+    with h5py.File(ifile, 'r') as file:
+        npix = file['calipso']['cloud_fraction'].shape[0]
+
+    def stage(name):
+        return _Stage(stages, name, npix, trace_memory)
+
+    with stage('load'):
+        data, latlon = ap.load_collocated_file(ifile, chunksize, dataset)
+        data, latlon = dask.persist(data, latlon)
+
+    with stage('masking'):
+        masks = [ap.apply_scenario(data, *sc)['valid'] for sc in scenarios]
+        dask.compute([mask.sum() for mask in masks if mask is not None])
+
+    with stage('indexing'):
+        resampler = BucketResampler(adef, latlon['lon'], latlon['lat'])
+        idxs = resampler.idxs.compute().astype(np.int32)
+        idxs = da.from_array(idxs, chunks=chunksize)
+
+    with stage('cma'):
+        dask.compute(ap.do_cma_validation(data, adef, adef.size, idxs))
+
+    with stage('cph'):
+        dask.compute(ap.do_cph_validation(data, adef, adef.size, idxs))
+
+    with stage('ctth'):
+        agg = dask.compute(ap.get_ctth_aggregates(data, idxs, adef.size))[0]
+        dask.compute(ap.get_ctth_scores(agg, adef.shape))
+
+    with tempfile.TemporaryDirectory() as opath:
+        agg = dask.compute(ap.get_aggregates(data, idxs, adef.size,
+                                             dataset))[0]
+        scores = ap.get_scores(agg, adef.shape)
+        ofile_args = ('0000', '00', 'ALL', None)
+
+        with stage('plotting'):
+            ap.render_plots(ap.get_plot_jobs(scores, opath, ofile_args,
+                                             'ALL', adef))
+
+        with stage('scatter'):
+            scatter = dask.compute(ap.get_scatter_aggregates(data,
+                                                             dataset))[0]
+            ap.make_scatter(scatter,
+                            os.path.join(opath, ap.OFILES['SCATTER'].format(
+                                *ofile_args)), 'ALL')
+
+    results = {'meta': {'file': os.path.abspath(ifile),
+                        'npix': npix,
+                        'dataset': dataset,
+                        'chunksize': chunksize,
+                        'nscenarios': len(scenarios),
+                        'area_id': adef.area_id,
+                        'grid_size': int(adef.size),
+                        'trace_memory': trace_memory,
+                        'date': datetime.datetime.now().isoformat(),
+                        'host': platform.node(),
+                        'cpu_count': os.cpu_count(),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'dask': dask.__version__},
+               'stages': stages}
+    if ofile is not None:
+        with open(ofile, 'w') as fh:
+            json.dump(results, fh, indent=1)
+        print('SAVED ', os.path.basename(ofile))
+    return results
+
+
+def compare_benchmarks(ifile_a, ifile_b):
+    """ Print the stage timings of two benchmark files and their ratio. """
+    with open(ifile_a) as fh:
+        bench_a = json.load(fh)
+    with open(ifile_b) as fh:
+        bench_b = json.load(fh)
+    for key in ['npix', 'chunksize', 'trace_memory', 'area_id']:
+        if bench_a['meta'].get(key) != bench_b['meta'].get(key):
+            print('WARNING: {} differs ({} vs {})'.format(
+                      key, bench_a['meta'].get(key), bench_b['meta'].get(key)))
+    stages_a = bench_a['stages']
+    stages_b = bench_b['stages']
+    print('{:10s} {:>10s} {:>10s} {:>8s}'.format('stage', 'a [s]', 'b [s]',
+                                                 'b/a'))
+    for name in STAGES:
+        if name in stages_a and name in stages_b:
+            ta = stages_a[name]['time_s']
+            tb = stages_b[name]['time_s']
+            print('{:10s} {:10.2f} {:10.2f} {:8.2f}'.format(name, ta, tb,
+                                                           tb / ta))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    gen = sub.add_parser('generate', help='write a synthetic matchup file')
+    gen.add_argument('ofile')
+    gen.add_argument('--npix', type=float, default=1e6)
+    gen.add_argument('--dataset', default='CCI')
+    gen.add_argument('--seed', type=int, default=0)
+
+    run = sub.add_parser('run', help='benchmark the pipeline stages')
+    run.add_argument('ifile')
+    run.add_argument('--ofile', default='benchmark.json')
+    run.add_argument('--dataset', default='CCI')
+    run.add_argument('--chunksize', type=int, default=100000)
+    run.add_argument('--no-memory', action='store_true',
+                     help='do not trace memory')
+    run.add_argument('--resolution', type=float, default=2,
+                     help='resolution [deg] of the global lat/lon grid')
+    run.add_argument('--area-file', default=None,
+                     help='area file of the target grid instead')
+    run.add_argument('--area-id', default='pc_world')
+
+    cmp = sub.add_parser('compare', help='compare two benchmark files')
+    cmp.add_argument('ifile_a')
+    cmp.add_argument('ifile_b')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        make_synthetic_file(args.ofile, args.npix, args.dataset, args.seed)
+    elif args.command == 'run':
+        run_benchmark(args.ifile, args.dataset, args.chunksize, args.ofile,
+                      trace_memory=not args.no_memory,
+                      resolution=args.resolution, area_file=args.area_file,
+                      area_id=args.area_id)
+    else:
+        compare_benchmarks(args.ifile_a, args.ifile_b)
+
+
+if __name__ == '__main__':
+    main()
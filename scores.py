@@ -1,51 +1,210 @@
 """ Module containing functions to calculate scores """
+import numpy as np
+
+
+# scores of a contingency table a (1_1), b (0_1), c (1_0), d (0_0) as
+# (numerator, denominator, value of cells with zero denominator); the terms
+# are names of the sums computed once per batch in get_batch_scores
+SCORES = {'hitrate': ('a+d', 'n', np.nan),
+          'pod_clr': ('d', 'b+d', np.nan),
+          'pod_cld': ('a', 'a+c', np.nan),
+          'far_clr': ('c', 'c+d', np.nan),
+          'far_cld': ('b', 'a+b', np.nan),
+          'pofd_clr': ('c', 'a+c', np.nan),
+          'pofd_cld': ('b', 'b+d', np.nan),
+          'heidke': ('2(ad-bc)', '(a+c)(c+d)+(a+b)(b+d)', 0),
+          'kuiper': ('ad-bc', '(a+c)(b+d)', 0),
+          'bias': ('b-c', 'n', np.nan),
+          'mean_cal': ('a+c', 'n', np.nan),
+          'mean_img': ('a+b', 'n', np.nan)}
+
+
+def _get_terms(a, b, c, d, names):
+    """ Get the sums needed by the numerators/denominators of the scores. """
+    terms = {'a': a, 'b': b, 'c': c, 'd': d}
+    pairs = {'a+b': (a, b), 'a+c': (a, c), 'a+d': (a, d), 'b+d': (b, d),
+             'c+d': (c, d)}
+    needed = set(term for name in names for term in SCORES[name][:2])
+    # pairwise sums the products are made of
+    if needed & {'(a+c)(b+d)', '(a+c)(c+d)+(a+b)(b+d)'}:
+        needed |= {'a+c', 'b+d'}
+    if '(a+c)(c+d)+(a+b)(b+d)' in needed:
+        needed |= {'a+b', 'c+d'}
+    for term, (x, y) in pairs.items():
+        if term in needed:
+            terms[term] = np.add(x, y)
+    if 'n' in needed:
+        if 'a+b' in terms and 'c+d' in terms:
+            terms['n'] = terms['a+b'] + terms['c+d']
+        else:
+            terms['n'] = np.add(a, b)
+            terms['n'] += c
+            terms['n'] += d
+    if 'b-c' in needed:
+        terms['b-c'] = np.subtract(b, c)
+    if needed & {'ad-bc', '2(ad-bc)'}:
+        terms['ad-bc'] = a * d
+        terms['ad-bc'] -= b * c
+    if '2(ad-bc)' in needed:
+        terms['2(ad-bc)'] = 2 * terms['ad-bc']
+    if '(a+c)(b+d)' in needed:
+        terms['(a+c)(b+d)'] = terms['a+c'] * terms['b+d']
+    if '(a+c)(c+d)+(a+b)(b+d)' in needed:
+        terms['(a+c)(c+d)+(a+b)(b+d)'] = terms['a+c'] * terms['c+d']
+        terms['(a+c)(c+d)+(a+b)(b+d)'] += terms['a+b'] * terms['b+d']
+    return terms
+
+
+def get_batch_scores(table, names=None, dtype=np.float64, out=None):
+    """
+    Calculate several scores of stacked contingency tables in one sweep.
+
+    The sums shared by the scores (n, a+c, ad-bc, ...) are computed once
+    and every score is divided into its slice of one output buffer. Cells
+    with a zero denominator get NaN (heidke/kuiper: 0) without warnings.
+
+    table: array (4, ...) of stacked a, b, c, d counts (not modified)
+    names: scores to calculate (keys of SCORES, default: all)
+    dtype: float type of the calculation and the scores (e.g. np.float32)
+    out:   optional preallocated buffer (len(names),) + table.shape[1:]
+
+    Returns the scores stacked in the order of names.
+    """
+    names = list(SCORES) if names is None else list(names)
+    table = np.asarray(table)
+    if table.shape[0] != 4:
+        raise Exception('Contingency table must have shape (4, ...)!')
+    shape = (len(names),) + table.shape[1:]
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise Exception('Output buffer must have shape {}!'.format(shape))
+
+    terms = _get_terms(*table.astype(dtype, copy=False), names)
+    for score, name in zip(out, names):
+        num, denom, fill = SCORES[name]
+        nonzero = terms[denom] != 0
+        score.fill(fill)
+        np.divide(terms[num], terms[denom], out=score, where=nonzero)
+    return out
+
+
+def _nanquantiles(values, quantiles):
+    """
+    Quantiles of values (nscores, nboot, ncells) along axis 1 ignoring NaN,
+    linear interpolation as np.nanquantile (which loops over the cells).
+
+    Returns array (nscores, len(quantiles), ncells).
+    """
+    values = np.sort(values, axis=1)
+    nvalid = np.isfinite(values).sum(axis=1, keepdims=True)
+    result = []
+    for q in quantiles:
+        pos = q * np.maximum(nvalid - 1, 0)
+        lower = np.floor(pos).astype(np.int64)
+        upper = np.minimum(lower + 1, np.maximum(nvalid - 1, 0))
+        frac = (pos - lower).astype(values.dtype)
+        low = np.take_along_axis(values, lower, axis=1)
+        high = np.take_along_axis(values, upper, axis=1)
+        result.append(np.where(nvalid > 0, low + frac * (high - low), np.nan))
+    return np.concatenate(result, axis=1)
+
+
+def get_bootstrap_ci(table, names=None, nboot=200, level=0.95, seed=0,
+                     dtype=np.float32, batchsize=2**22):
+    """
+    Percentile bootstrap confidence intervals of the scores of stacked
+    contingency tables.
+
+    The a/b/c/d counts of every cell are resampled nboot times from a
+    multinomial distribution with the observed frequencies, so the pixels
+    are not needed. Cost is proportional to the number of cells times
+    nboot; cells are processed in batches of about batchsize resampled
+    tables to bound memory. Cells without observations get NaN.
+
+    table: array (4, ...) of stacked a, b, c, d counts
+    names: scores to calculate (keys of SCORES, default: all)
+    level: confidence level of the intervals
+    seed:  seed (or sequence of seeds) of the random generator
+
+    Returns the lower and upper bounds, array (len(names), 2, ...).
+    """
+    names = list(SCORES) if names is None else list(names)
+    table = np.asarray(table)
+    if table.shape[0] != 4:
+        raise Exception('Contingency table must have shape (4, ...)!')
+    counts = table.reshape(4, -1).T.astype(np.int64)
+    ncells = counts.shape[0]
+    n = counts.sum(axis=1)
+    # any probabilities for empty cells, their bounds are set to NaN
+    pvals = counts / np.maximum(n, 1)[:, np.newaxis]
+    pvals[n == 0, 0] = 1
+
+    rng = np.random.default_rng(seed)
+    quantiles = [(1 - level) / 2, (1 + level) / 2]
+    bounds = np.full((len(names), 2, ncells), np.nan, dtype=dtype)
+    step = max(1, batchsize // nboot)
+    buf = np.empty((len(names), nboot, min(step, ncells)), dtype=dtype)
+    for start in range(0, ncells, step):
+        cells = slice(start, min(start + step, ncells))
+        size = cells.stop - cells.start
+        samples = rng.multinomial(n[cells], pvals[cells],
+                                  size=(nboot, size))
+        replicates = get_batch_scores(samples.transpose(2, 0, 1), names,
+                                      dtype, buf[:, :, :size])
+        bounds[:, :, cells] = _nanquantiles(replicates, quantiles)
+    bounds[:, :, n == 0] = np.nan
+    return bounds.reshape((len(names), 2) + table.shape[1:])
+
+
+def _get_score(name, a=0, b=0, c=0, d=0):
+    """
+    Score of SCORES from a, b, c, d counts (see get_batch_scores), counts
+    the score does not depend on may be left 0.
+    """
+    return get_batch_scores(np.stack(np.broadcast_arrays(a, b, c, d)),
+                            [name])[0]
+
 
 def hitrate(a, d, n):
-    return (a + d) / n
+    return _get_score('hitrate', a=a, b=n - a - d, d=d)
 
 
 def pod_clr(b, d):
-    return d / (b + d)
+    return _get_score('pod_clr', b=b, d=d)
 
 
 def pod_cld(a, c):
-    return a / (a + c)
+    return _get_score('pod_cld', a=a, c=c)
 
 
 def far_clr(c, d):
-    return c / (c + d)
+    return _get_score('far_clr', c=c, d=d)
 
 
 def far_cld(a, b):
-    return b / (a + b)
+    return _get_score('far_cld', a=a, b=b)
 
 
 def pofd_clr(a, c):
-    return c / (a + c)
+    return _get_score('pofd_clr', a=a, c=c)
 
 
 def pofd_cld(b, d):
-    return b / (b + d)
+    return _get_score('pofd_cld', b=b, d=d)
 
 
 def heidke(a, b, c, d):
-    num = 2 * ((a * d) - (b * c))
-    denom = ((a + c) * (c + d) + (a + b) * (b + d))
-    denom[denom == 0] = 1
-    return num / denom
+    return _get_score('heidke', a, b, c, d)
 
 
 def kuiper(a, b, c, d):
-    num = (a * d - b * c)
-    denom = (a + c) * (b + d)
-    denom[denom == 0] = 1
-    kuipers = num / denom
-    return kuipers
+    return _get_score('kuiper', a, b, c, d)
 
 
 def bias(b, c, n):
-    return (b - c) / n
+    return _get_score('bias', a=n - b - c, b=b, c=c)
 
 
 def mean(x, y, n):
-    return (x + y) / n
\ No newline at end of file
+    return _get_score('mean_cal', a=x, c=y, d=n - x - y)
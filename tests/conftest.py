@@ -0,0 +1,43 @@
+"""
+Fixtures: a small synthetic matchup file (see benchmark.make_synthetic_file),
+a coarse target grid and the decoded pixels with their grid indices as numpy
+arrays for the reference computations.
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+NPIX = 40000
+# several chunks per file, so chunk merges and batches are exercised
+CHUNKSIZE = 5000
+RESOLUTION = 10
+
+
+@pytest.fixture(scope='session')
+def mfile(tmp_path_factory):
+    import benchmark
+    ofile = tmp_path_factory.mktemp('matchups') / '20190701_CCI.h5'
+    benchmark.make_synthetic_file(str(ofile), NPIX, blocksize=10000)
+    return str(ofile)
+
+
+@pytest.fixture(scope='session')
+def adef():
+    import atrain_plot as ap
+    return ap.get_latlon_area(RESOLUTION)
+
+
+@pytest.fixture(scope='session')
+def pixels(mfile, adef):
+    """ Decoded pixels and their target grid index 'idxs' (BucketResampler). """
+    import dask
+    from pyresample.bucket import BucketResampler
+    import atrain_plot as ap
+    data, latlon = ap.load_collocated_file(mfile, CHUNKSIZE)
+    idxs = BucketResampler(adef, latlon['lon'], latlon['lat']).idxs
+    data, latlon, idxs = dask.compute(data, latlon, idxs)
+    data.update(latlon)
+    data['idxs'] = idxs
+    return data
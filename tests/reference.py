@@ -0,0 +1,96 @@
+"""
+Plain numpy reference computations of the original validation: masks and
+histograms of the decoded pixels per scenario, no kernels of atrain_plot.
+"""
+import numpy as np
+import atrain_plot as ap
+
+SCENARIOS = [(dnt, satz_lim) for satz_lim in [None, 70]
+             for dnt in ['ALL', 'DAY', 'NIGHT', 'TWILIGHT']]
+
+
+def scenario_valid(px, dnt='ALL', satz_lim=None):
+    """ Pixels of a DNT/SATZ scenario (limits of get_scenario_mask). """
+    satz, sunz = px['satz'], px['sunz']
+    valid = np.ones(satz.shape, dtype=bool)
+    if satz_lim is not None:
+        valid &= ~(satz > satz_lim)
+    if dnt == 'DAY':
+        valid &= ~(sunz >= 80)
+    elif dnt == 'NIGHT':
+        valid &= ~(sunz <= 95)
+    elif dnt == 'TWILIGHT':
+        valid &= np.logical_and(sunz > 80, sunz < 95)
+    return valid
+
+
+def histogram(idxs, size, mask, weights=None):
+    """ Sum per grid box like the original np.histogram of the indices. """
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)[mask]
+    return np.histogram(idxs[mask], bins=size, range=(0, size),
+                        weights=weights)[0]
+
+
+def contingency_table(px, var, valid, size):
+    """ a, b, c, d counts of CMA or CPH per grid box. """
+    cal, img = px['caliop_' + var], px['imager_' + var]
+    pairs = [(1, 1), (0, 1), (1, 0), (0, 0)]
+    return np.stack([histogram(px['idxs'], size,
+                               valid & (cal == i) & (img == j))
+                     for i, j in pairs])
+
+
+def ctth_aggregates(px, valid, size):
+    """ CTTH aggregates (see get_ctth_aggregates) from the pixel masks. """
+    detected = np.logical_and(px['caliop_cma'] == 1, px['imager_cma'] == 1)
+    height = detected & np.isfinite(px['imager_cth'])
+    temperature = detected & np.isfinite(px['imager_ctt'])
+    variables = {'imager_cth': px['imager_cth'],
+                 'caliop_cth': px['caliop_cth'],
+                 'height_bias': np.where(height, px['imager_cth'] -
+                                         px['caliop_cth'], np.nan),
+                 'temperature_bias': np.where(temperature, px['imager_ctt'] -
+                                              px['caliop_ctt'], np.nan)}
+    variables['height_mae'] = np.abs(variables['height_bias'])
+    # cloud type decoded flag by flag as originally
+    ctype = ap._decode_cloud_type(px['caliop_cflag'])
+    classes = {'all': height}
+    for cls in ['low', 'mid', 'high', 'mid_high_tp', 'low_op']:
+        classes[cls] = height & ap.get_cloud_class(ctype, cls)
+
+    agg = {'ctth_nmatch': np.stack([histogram(px['idxs'], size,
+                                              valid & classes[cls])
+                                    for cls in ap.CTTH_CLASSES])}
+    count, sums, sumsq = [], [], []
+    for var, cls, _ in ap.CTTH_VARS.values():
+        x = variables[var]
+        sel = valid & np.isfinite(x)
+        if cls is not None:
+            sel &= classes[cls]
+        count.append(histogram(px['idxs'], size, sel))
+        sums.append(histogram(px['idxs'], size, sel, x))
+        sumsq.append(histogram(px['idxs'], size, sel,
+                               np.asarray(x, np.float64) ** 2))
+    agg['ctth_count'] = np.stack(count)
+    agg['ctth_sum'] = np.stack(sums)
+    agg['ctth_sumsq'] = np.stack(sumsq)
+    return agg
+
+
+def aggregates(px, valid, size):
+    """ Gridded aggregates of one scenario (see get_aggregates). """
+    agg = ctth_aggregates(px, valid, size)
+    agg['cma'] = contingency_table(px, 'cma', valid, size)
+    agg['cph'] = contingency_table(px, 'cph', valid, size)
+    return agg
+
+
+def assert_aggregates(agg, ref, keys=None):
+    """ Counts are equal, sums equal up to rounding of the float32 data. """
+    for key in ref if keys is None else keys:
+        if key in ['ctth_sum', 'ctth_sumsq', 'scatter_sums']:
+            np.testing.assert_allclose(agg[key], ref[key], rtol=1e-5,
+                                       atol=1e-3, err_msg=key)
+        else:
+            np.testing.assert_array_equal(agg[key], ref[key], err_msg=key)
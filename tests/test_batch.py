@@ -0,0 +1,146 @@
+import functools
+import json
+import os
+import shutil
+import pytest
+
+pytest.importorskip('atrain_match')
+import atrain_plot as ap  # noqa: E402
+import batch  # noqa: E402
+import reference  # noqa: E402
+
+
+def test_ledger(tmp_path):
+    ledger = str(tmp_path / 'jobs.ledger')
+    assert batch.read_ledger(ledger) == dict()
+    first = {'version': batch.LEDGER_VERSION, 'job': 'a', 'key': '1'}
+    batch.append_ledger(ledger, first)
+    batch.append_ledger(ledger, {'version': batch.LEDGER_VERSION,
+                                 'job': 'b', 'key': '2'})
+    batch.append_ledger(ledger, {'version': batch.LEDGER_VERSION + 1,
+                                 'job': 'a', 'key': '3'})
+    with open(ledger, 'a') as fh:
+        # write cut off by an interruption
+        fh.write(json.dumps({'version': batch.LEDGER_VERSION, 'job': 'b',
+                             'key': '4'})[:20])
+    records = batch.read_ledger(ledger)
+    assert records == {'a': first, 'b': {'version': batch.LEDGER_VERSION,
+                                         'job': 'b', 'key': '2'}}
+
+
+@pytest.fixture
+def manifest(mfile, tmp_path):
+    """ Manifest of two months with a copy of the synthetic file each. """
+    ipath = tmp_path / 'matchups'
+    ipath.mkdir()
+    for month in ['07', '08']:
+        shutil.copy2(mfile, str(ipath / '2019{}01_CCI.h5'.format(month)))
+    content = {'defaults': {'dataset': 'CCI', 'dnts': ['ALL'],
+                            'satzs': [None],
+                            'ipattern': str(ipath / '{year}{month}*.h5'),
+                            'opath': str(tmp_path / 'figs' / '{year}')},
+               'jobs': [{'year': 2019, 'month': 7},
+                        {'year': 2019, 'month': 8}]}
+    ofile = str(tmp_path / 'jobs.json')
+    with open(ofile, 'w') as fh:
+        json.dump(content, fh)
+    return ofile
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    """ Record run_archive() calls, write one output, fail on request. """
+    runs = {'calls': [], 'fail': set()}
+
+    @functools.wraps(ap.run_archive)
+    def run_archive(opath, year, month, **kwargs):
+        runs['calls'].append(year + month)
+        if year + month in runs['fail']:
+            raise Exception('failed')
+        with open(os.path.join(opath, 'cma_{}{}.png'.format(year, month)),
+                  'w') as fh:
+            fh.write('')
+    monkeypatch.setattr(ap, 'run_archive', run_archive)
+    return runs
+
+
+def get_states(manifest):
+    plan = batch.plan_jobs(batch.get_jobs(batch.load_manifest(manifest)),
+                           batch.read_ledger(manifest + '.ledger'))
+    return {job['name']: state for job, _, _, state in plan}
+
+
+def test_run_batch_resume(manifest, runs, capsys):
+    assert get_states(manifest) == {'CCI_201907': 'new', 'CCI_201908': 'new'}
+    runs['fail'].add('201908')
+    with pytest.raises(Exception):
+        batch.run_batch(manifest)
+    assert runs['calls'] == ['201907', '201908']
+    assert get_states(manifest) == {'CCI_201907': 'done',
+                                    'CCI_201908': 'new'}
+
+    # only the failed job is run again
+    runs['fail'].clear()
+    capsys.readouterr()
+    batch.run_batch(manifest)
+    assert runs['calls'][2:] == ['201908']
+    assert 'SKIPPED  CCI_201907' in capsys.readouterr().out
+    batch.run_batch(manifest)
+    assert len(runs['calls']) == 3
+
+    batch.run_batch(manifest, force=True)
+    assert runs['calls'][3:] == ['201907', '201908']
+
+
+def test_run_batch_changes(manifest, runs, tmp_path):
+    batch.run_batch(manifest)
+    ledger = batch.read_ledger(manifest + '.ledger')
+    output, = ledger['CCI_201907']['outputs']
+    assert output.endswith('cma_201907.png')
+
+    # touched inputs keep their content hash
+    ifile = str(tmp_path / 'matchups' / '20190701_CCI.h5')
+    stat = os.stat(ifile)
+    os.utime(ifile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert set(get_states(manifest).values()) == {'done'}
+
+    os.remove(output)
+    with open(str(tmp_path / 'matchups' / '20190801_CCI.h5'), 'ab') as fh:
+        fh.write(b'\0')
+    assert get_states(manifest) == {'CCI_201907': 'outputs missing',
+                                    'CCI_201908': 'changed'}
+    batch.run_batch(manifest)
+    assert runs['calls'][2:] == ['201907', '201908']
+
+    # runtime options do not change the job key, output options do
+    with open(manifest) as fh:
+        content = json.load(fh)
+    content['jobs'][0]['chunksize'] = 1000
+    content['jobs'][1]['nboot'] = 10
+    with open(manifest, 'w') as fh:
+        json.dump(content, fh)
+    assert get_states(manifest) == {'CCI_201907': 'done',
+                                    'CCI_201908': 'changed'}
+
+
+def test_run_batch_store(monkeypatch, manifest, adef, pixels, tmp_path):
+    # no maps, their coastlines need a download
+    monkeypatch.setattr(ap, 'make_binned_outputs', lambda *args, **kw: None)
+    with open(manifest) as fh:
+        content = json.load(fh)
+    content['defaults'].update(
+        {'resolutions': [10], 'chunksize': 5000, 'idxs_cache': False,
+         'store': str(tmp_path / 'stores' / '{dataset}_{year}{month}.nc')})
+    content['jobs'] = content['jobs'][:1]
+    with open(manifest, 'w') as fh:
+        json.dump(content, fh)
+    os.makedirs(str(tmp_path / 'stores'))
+    batch.run_batch(manifest)
+
+    store = str(tmp_path / 'stores' / 'CCI_201907.nc')
+    outputs = batch.read_ledger(manifest + '.ledger')['CCI_201907']['outputs']
+    assert os.path.abspath(store) in outputs
+    aggs, _ = ap.load_aggregates(store)
+    ref = reference.aggregates(pixels, reference.scenario_valid(pixels),
+                               adef.size)
+    reference.assert_aggregates(aggs[('ALL', None)], ref)
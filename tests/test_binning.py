@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('atrain_match')
+import h5py  # noqa: E402
+import atrain_plot as ap  # noqa: E402
+import reference  # noqa: E402
+from conftest import CHUNKSIZE  # noqa: E402
+
+SCENARIOS = [(dnt, satz_lim) for satz_lim in [None, 70]
+             for dnt in ['ALL', 'NIGHT']]
+SELECTIONS = [None, [2], [5, 6, 7]]
+
+
+@pytest.fixture(scope='module')
+def pixel_bins(mfile, pixels):
+    """ Local solar hour and 10 degree sunz bin of every pixel. """
+    with h5py.File(mfile, 'r') as file:
+        seconds = file['calipso']['sec_1970'][:]
+    hour = (seconds % 86400) / 3600 + pixels['lon'] / 15
+    return {'hour': np.floor(hour % 24).astype(np.int64),
+            'sunz': np.minimum(pixels['sunz'] // 10, 17).astype(np.int64)}
+
+
+@pytest.fixture(scope='module', params=['sunz', 'hour'])
+def binned(request, mfile, adef):
+    binning = request.param
+    return binning, ap.reduce_file(mfile, SCENARIOS, adef, 'CCI', CHUNKSIZE,
+                                   idxs_cache=False, binning=binning)
+
+
+def test_binned_aggregates_sparse(binned):
+    _, aggs = binned
+    assert all(ap.is_sparse(agg) for agg in aggs.values())
+
+
+@pytest.mark.parametrize('selection', SELECTIONS)
+def test_select_bins(binned, adef, pixels, pixel_bins, selection):
+    binning, aggs = binned
+    for scenario in SCENARIOS:
+        valid = reference.scenario_valid(pixels, *scenario)
+        if selection is not None:
+            valid &= np.isin(pixel_bins[binning], selection)
+        agg = ap.select_bins(aggs[scenario], adef.size, selection)
+        reference.assert_aggregates(agg, reference.aggregates(pixels, valid,
+                                                              adef.size))
+        assert ('scatter_hist' in agg) == (selection is None)
+
+
+def test_expand_bins(binned, adef):
+    binning, aggs = binned
+    nbins = ap.BINNINGS[binning]
+    for agg in aggs.values():
+        dense = ap.expand_bins(agg, adef.size, nbins)
+        assert dense['cma'].shape == (4, nbins * adef.size)
+        for selection in SELECTIONS:
+            reference.assert_aggregates(
+                ap.select_bins(dense, adef.size, selection),
+                ap.select_bins(agg, adef.size, selection))
+
+
+def test_binned_store(binned, adef, tmp_path):
+    binning, aggs = binned
+    ofile = str(tmp_path / 'store.nc')
+    ap.save_aggregates(aggs, ofile, adef, 'CCI', '2019', '07',
+                       binning=binning)
+    loaded, attrs = ap.load_aggregates(ofile)
+    assert attrs['binning'] == binning
+    for scenario in SCENARIOS:
+        for selection in SELECTIONS:
+            reference.assert_aggregates(
+                ap.select_bins(loaded[scenario], adef.size, selection),
+                ap.select_bins(aggs[scenario], adef.size, selection))
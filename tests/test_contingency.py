@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('atrain_match')
+import dask  # noqa: E402
+import dask.array as da  # noqa: E402
+import atrain_plot as ap  # noqa: E402
+import reference  # noqa: E402
+from conftest import CHUNKSIZE  # noqa: E402
+
+
+@pytest.mark.parametrize('var', ['cma', 'cph'])
+@pytest.mark.parametrize('scenario', reference.SCENARIOS)
+def test_contingency_table(pixels, adef, var, scenario):
+    valid = reference.scenario_valid(pixels, *scenario)
+    mask = ap.get_scenario_mask(pixels['satz'], pixels['sunz'], *scenario)
+    table = ap.get_contingency_table(
+        da.from_array(pixels['caliop_' + var], chunks=CHUNKSIZE),
+        da.from_array(pixels['imager_' + var], chunks=CHUNKSIZE),
+        da.from_array(pixels['idxs'], chunks=CHUNKSIZE), adef.size,
+        None if mask is None else da.from_array(~mask, chunks=CHUNKSIZE))
+    np.testing.assert_array_equal(
+        np.stack(dask.compute(*table)),
+        reference.contingency_table(pixels, var, valid, adef.size))
+
+
+def test_contingency_codes_outside_grid():
+    cal = np.array([1, 0, 1, 0, 1, ap.INVALID], dtype=np.int8)
+    img = np.array([1, 1, 0, 0, 1, 1], dtype=np.int8)
+    idxs = np.array([0, 1, 1, 2, 3, 0])
+    valid = np.array([True, True, True, True, True, True])
+    codes = ap._contingency_codes(cal, img, idxs, valid, out_size=3)
+    table = np.bincount(codes, minlength=4 * 3 + 1)[:4 * 3].reshape(3, 4).T
+    # pixel outside of the grid and invalid category are not counted
+    np.testing.assert_array_equal(table, [[1, 0, 0], [0, 1, 0], [0, 1, 0],
+                                          [0, 0, 1]])
@@ -0,0 +1,83 @@
+import tracemalloc
+import numpy as np
+import pytest
+
+pytest.importorskip('atrain_match')
+import dask  # noqa: E402
+import dask.array as da  # noqa: E402
+import atrain_plot as ap  # noqa: E402
+import reference  # noqa: E402
+from conftest import CHUNKSIZE, NPIX  # noqa: E402
+
+
+def lazy_scenario(pixels, dnt, satz_lim):
+    data = {key: da.from_array(val, chunks=CHUNKSIZE)
+            for key, val in pixels.items()}
+    return ap.apply_scenario(data, dnt, satz_lim), data['idxs']
+
+
+@pytest.mark.parametrize('scenario', reference.SCENARIOS)
+def test_ctth_aggregates(pixels, adef, scenario):
+    data, idxs = lazy_scenario(pixels, *scenario)
+    agg = dask.compute(ap.get_ctth_aggregates(data, idxs, adef.size))[0]
+    ref = reference.ctth_aggregates(
+        pixels, reference.scenario_valid(pixels, *scenario), adef.size)
+    reference.assert_aggregates(agg, ref)
+
+
+@pytest.mark.parametrize('scenario', [('ALL', None), ('NIGHT', 70)])
+def test_sparse_parts(pixels, adef, scenario):
+    data, idxs = lazy_scenario(pixels, *scenario)
+    parts = dask.compute(ap.get_sparse_parts(data, idxs, adef.size))[0]
+    ref = reference.aggregates(
+        pixels, reference.scenario_valid(pixels, *scenario), adef.size)
+    reference.assert_aggregates(ap.densify_aggregates(parts, adef.size), ref)
+
+
+def test_grouped_combine():
+    parts = [(np.array([1, 5]), np.array([[1., 2.], [3., 4.]])),
+             (np.array([0, 5]), np.array([[5., 6.], [7., 8.]]))]
+    codes, stats = ap._grouped_combine(*parts)
+    np.testing.assert_array_equal(codes, [0, 1, 5])
+    np.testing.assert_array_equal(stats, [[5., 1., 8.], [7., 3., 12.]])
+
+
+@pytest.mark.parametrize('batch', [1, 3, ap.REDUCE_BATCH])
+def test_reduce_file_batches(monkeypatch, mfile, adef, pixels, batch):
+    monkeypatch.setattr(ap, 'REDUCE_BATCH', batch)
+    aggs = ap.reduce_file(mfile, reference.SCENARIOS, adef, 'CCI',
+                          CHUNKSIZE, idxs_cache=False)
+    for scenario in reference.SCENARIOS:
+        ref = reference.aggregates(
+            pixels, reference.scenario_valid(pixels, *scenario), adef.size)
+        assert ap.is_sparse(aggs[scenario])
+        reference.assert_aggregates(
+            ap.select_bins(aggs[scenario], adef.size), ref)
+
+
+def test_reduce_file_memory(mfile):
+    # fine grid: dense partials of every chunk and scenario would take GBs,
+    # sparse ones are bounded by the pixels of the chunks
+    adef = ap.get_latlon_area(0.5)
+    tracemalloc.start()
+    try:
+        aggs = ap.reduce_file(mfile, reference.SCENARIOS, adef, 'CCI',
+                              CHUNKSIZE, idxs_cache=False)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # below the gridded aggregates of a single scenario
+    dense = ap.select_bins(aggs[reference.SCENARIOS[0]], adef.size)
+    assert peak < sum(dense[key].nbytes for key in ap.AGG_DIMS)
+
+
+def test_chunksize_partials(mfile):
+    # sparse statistics of every scenario of the chunk in flight count
+    # against the budget once the grid has more boxes than the chunk pixels
+    size = ap.get_latlon_area(0.5).size
+    plain = ap.get_chunksize(mfile, 'CCI', '80MB', 1)
+    coarse = ap.get_chunksize(mfile, 'CCI', '80MB', 1, 1, 8)
+    fine = ap.get_chunksize(mfile, 'CCI', '80MB', 1, size, 8)
+    assert plain == coarse == NPIX
+    assert ap.MIN_CHUNKSIZE <= fine < plain
+    assert 2 * ap.get_partial_bytes(fine, size, 8) < 80 * 10**6
@@ -0,0 +1,62 @@
+import glob
+import os
+import shutil
+import numpy as np
+import pytest
+
+pytest.importorskip('atrain_match')
+import dask.array as da  # noqa: E402
+import atrain_plot as ap  # noqa: E402
+from conftest import CHUNKSIZE  # noqa: E402
+
+
+@pytest.fixture
+def mcopy(mfile, tmp_path):
+    ofile = str(tmp_path / os.path.basename(mfile))
+    shutil.copy2(mfile, ofile)
+    return ofile
+
+
+def get_idxs(ipath, adef, use_cache):
+    _, latlon = ap.load_collocated_file(ipath, CHUNKSIZE)
+    return ap.get_target_idxs(ipath, adef, latlon, CHUNKSIZE, use_cache)
+
+
+def cache_files(ipath, adef):
+    return glob.glob('{}.{}_*.idxs.npy'.format(ipath, adef.area_id))
+
+
+def test_idxs_without_cache(mcopy, adef, pixels):
+    idxs = get_idxs(mcopy, adef, False)
+    assert isinstance(idxs, da.Array)
+    assert cache_files(mcopy, adef) == []
+    np.testing.assert_array_equal(idxs.compute(), pixels['idxs'])
+
+
+def test_idxs_cache_reused(monkeypatch, mcopy, adef, pixels):
+    first = get_idxs(mcopy, adef, True)
+    assert cache_files(mcopy, adef) == [ap.get_idxs_cache_file(mcopy, adef)]
+    np.testing.assert_array_equal(first.compute(), pixels['idxs'])
+
+    def _fail(*args, **kwargs):
+        raise AssertionError('indices recomputed')
+    monkeypatch.setattr(ap, 'BucketResampler', _fail)
+    second = get_idxs(mcopy, adef, True)
+    assert second.chunks[0][0] == CHUNKSIZE
+    np.testing.assert_array_equal(second.compute(), pixels['idxs'])
+
+
+def test_idxs_stale_cache_removed(mcopy, adef, pixels):
+    get_idxs(mcopy, adef, True)
+    other = ap.get_latlon_area(30)
+    get_idxs(mcopy, other, True)
+    stale = ap.get_idxs_cache_file(mcopy, adef)
+
+    stat = os.stat(mcopy)
+    os.utime(mcopy, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    idxs = get_idxs(mcopy, adef, True)
+    assert cache_files(mcopy, adef) == [ap.get_idxs_cache_file(mcopy, adef)]
+    assert not os.path.exists(stale)
+    # caches of other areas are kept
+    assert len(cache_files(mcopy, other)) == 1
+    np.testing.assert_array_equal(idxs.compute(), pixels['idxs'])
@@ -0,0 +1,22 @@
+import h5py
+import numpy as np
+import pytest
+
+pytest.importorskip('atrain_match')
+import atrain_plot as ap  # noqa: E402
+
+
+@pytest.mark.parametrize('blocksize', [10**6, 7777, 1000])
+def test_index_blocks(mfile, pixels, blocksize):
+    entry = ap.index_matchup_file(mfile, 'CCI', blocksize)
+    with h5py.File(mfile, 'r') as file:
+        times = file['calipso']['sec_1970'][:]
+    assert entry['npix'] == pixels['lat'].size
+    assert entry['time'] == [times.min(), times.max()]
+    np.testing.assert_allclose(entry['bbox'],
+                               [pixels['lon'].min(), pixels['lat'].min(),
+                                pixels['lon'].max(), pixels['lat'].max()])
+    np.testing.assert_array_equal(
+        ap._decode_bitmap(entry['occupancy']),
+        ap.get_occupancy(pixels['lon'].astype(np.float64),
+                         pixels['lat'].astype(np.float64)))
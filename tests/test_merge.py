@@ -0,0 +1,86 @@
+import shutil
+import numpy as np
+import pytest
+
+pytest.importorskip('atrain_match')
+import atrain_plot as ap  # noqa: E402
+import reference  # noqa: E402
+import benchmark  # noqa: E402
+from conftest import CHUNKSIZE, RESOLUTION  # noqa: E402
+
+
+@pytest.mark.parametrize('nparts', [1, 2, 5, 8, 13])
+def test_tree_merge(nparts):
+    rng = np.random.default_rng(nparts)
+    parts = [{'ALL': {'cma': rng.integers(0, 10, (4, 6)),
+                      'ctth_sum': rng.random((2, 6))}}
+             for _ in range(nparts)]
+    first = parts[0]['ALL']['cma'].copy()
+    merged = ap.tree_merge(iter(parts))
+    np.testing.assert_array_equal(merged['ALL']['cma'],
+                                  sum(p['ALL']['cma'] for p in parts))
+    np.testing.assert_allclose(merged['ALL']['ctth_sum'],
+                               sum(p['ALL']['ctth_sum'] for p in parts))
+    # inputs are not modified
+    np.testing.assert_array_equal(parts[0]['ALL']['cma'], first)
+
+
+def test_tree_merge_empty():
+    with pytest.raises(Exception):
+        ap.tree_merge([])
+
+
+def test_merge_sparse_aggregates():
+    agg_a = {'cma': (np.array([0, 3]), np.array([[1., 2.]])),
+             'scatter_sums': np.ones(6)}
+    agg_b = {'cma': (np.array([3, 4]), np.array([[5., 1.]])),
+             'scatter_sums': np.ones(6)}
+    merged = ap.merge_aggregates(agg_a, agg_b)
+    np.testing.assert_array_equal(merged['cma'][0], [0, 3, 4])
+    np.testing.assert_array_equal(merged['cma'][1], [[1., 7., 1.]])
+    np.testing.assert_array_equal(merged['scatter_sums'], 2 * np.ones(6))
+
+
+def test_reduce_files(mfile, adef, pixels, tmp_path):
+    mfiles = []
+    for name in ['a.h5', 'b.h5', 'c.h5']:
+        mfiles.append(str(tmp_path / name))
+        shutil.copy2(mfile, mfiles[-1])
+    scenarios = [('ALL', None), ('DAY', 70)]
+    aggs = ap.reduce_files(mfiles, scenarios, adef, 'CCI', CHUNKSIZE,
+                           idxs_cache=False)
+    for scenario in scenarios:
+        ref = reference.aggregates(
+            pixels, reference.scenario_valid(pixels, *scenario), adef.size)
+        reference.assert_aggregates(
+            ap.select_bins(aggs[scenario], adef.size), {key: len(mfiles) * val for key, val in
+                             ref.items()})
+
+
+def test_update_store(monkeypatch, mfile, adef, tmp_path):
+    # no maps, their coastlines need a download
+    outputs = []
+    monkeypatch.setattr(ap, 'make_binned_outputs',
+                        lambda aggs, *args, **kwargs: outputs.append(aggs))
+    ipath = tmp_path / 'matchups'
+    ipath.mkdir()
+    mfiles = [str(ipath / 'a.h5'), str(ipath / 'b.h5')]
+    shutil.copy2(mfile, mfiles[0])
+    benchmark.make_synthetic_file(mfiles[1], 10000, seed=1)
+    store = str(tmp_path / 'store.nc')
+    dnts, satzs = ['ALL', 'NIGHT'], [None, 70]
+    kwargs = dict(opath=str(tmp_path), chunksize=CHUNKSIZE,
+                  idxs_cache=False, resolutions=[RESOLUTION])
+    ap.update_store(mfiles[0], store, dnts, satzs, '2019', '07', 'CCI',
+                    **kwargs)
+    # the lazily read store is merged with the new file and replaced
+    ap.update_store(str(ipath / '*.h5'), store, dnts, satzs, '2019', '07',
+                    'CCI', **kwargs)
+    scenarios = ap.get_scenarios(dnts, satzs, 'CCI')
+    ref = ap.reduce_files(mfiles, scenarios, adef, 'CCI', CHUNKSIZE,
+                          idxs_cache=False)
+    loaded, _ = ap.load_aggregates(store)
+    for scenario in scenarios:
+        dense = ap.select_bins(ref[scenario], adef.size)
+        reference.assert_aggregates(loaded[scenario], dense)
+        reference.assert_aggregates(outputs[-1][scenario], dense)
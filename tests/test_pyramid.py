@@ -0,0 +1,33 @@
+import pytest
+
+pytest.importorskip('atrain_match')
+import atrain_plot as ap  # noqa: E402
+import reference  # noqa: E402
+from conftest import CHUNKSIZE, RESOLUTION  # noqa: E402
+
+SCENARIOS = [('ALL', None), ('NIGHT', 70)]
+
+
+def test_pyramid(mfile, adef):
+    aggs = ap.reduce_file(mfile, SCENARIOS, adef, 'CCI', CHUNKSIZE,
+                          idxs_cache=False)
+    resolutions = [RESOLUTION, 2 * RESOLUTION, 3 * RESOLUTION]
+    pyramid = ap.get_pyramid(aggs, adef, resolutions)
+    assert list(pyramid) == resolutions
+    for res in resolutions[1:]:
+        level_adef, level_aggs = pyramid[res]
+        coarse = ap.get_latlon_area(res)
+        assert level_adef.shape == coarse.shape
+        ref = ap.reduce_file(mfile, SCENARIOS, coarse, 'CCI', CHUNKSIZE,
+                             idxs_cache=False)
+        for scenario in SCENARIOS:
+            reference.assert_aggregates(
+                ap.select_bins(level_aggs[scenario], coarse.size),
+                ap.select_bins(ref[scenario], coarse.size))
+
+
+@pytest.mark.parametrize('resolutions', [[RESOLUTION / 2, RESOLUTION],
+                                         [2 * RESOLUTION, 4 * RESOLUTION]])
+def test_pyramid_base_resolution(adef, resolutions):
+    with pytest.raises(Exception):
+        ap.get_pyramid({}, adef, resolutions)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('atrain_match')
+import dask  # noqa: E402
+import dask.array as da  # noqa: E402
+import atrain_plot as ap  # noqa: E402
+import reference  # noqa: E402
+from conftest import CHUNKSIZE  # noqa: E402
+
+
+def scatter_values(pixels, variable, valid):
+    """ Values of the original scatter plot: scaled, NaN pairs removed. """
+    x = pixels['imager_' + variable][valid]
+    y = pixels['caliop_' + variable][valid]
+    if variable == 'cth':
+        # divide CCI CTH by 1000 to convert from m to km
+        x /= 1000
+        y /= 1000
+    mask = np.logical_or(np.isnan(x), np.isnan(y))
+    return x[~mask], y[~mask]
+
+
+@pytest.mark.parametrize('scenario', [('ALL', None), ('DAY', 70)])
+def test_scatter_aggregates(pixels, scenario):
+    data = {key: da.from_array(val, chunks=CHUNKSIZE)
+            for key, val in pixels.items()}
+    data = ap.apply_scenario(data, *scenario)
+    agg = dask.compute(ap.get_scatter_aggregates(data, 'CCI'))[0]
+    valid = reference.scenario_valid(pixels, *scenario)
+    for cnt, variable in enumerate(ap.SCATTER_VARS):
+        x, y = scatter_values(pixels, variable, valid)
+        hist = np.histogram2d(x, y, bins=ap.SCATTER_NBINS,
+                              range=[ap.SCATTER_LIMS[variable]] * 2)[0]
+        np.testing.assert_array_equal(agg['scatter_hist'][cnt], hist)
+
+        slope, intercept, r = ap.get_regression(agg['scatter_sums'][cnt])
+        x, y = x.astype(np.float64), y.astype(np.float64)
+        np.testing.assert_allclose([slope, intercept], np.polyfit(x, y, 1),
+                                   rtol=1e-6)
+        np.testing.assert_allclose(r, np.corrcoef(x, y)[0, 1], rtol=1e-6)
+
+
+def test_scatter_bins_edges():
+    x = np.array([0, 0.25, 0.1 * 3, 24.75, 25, 25.0001, -1e-9, np.nan],
+                 dtype=np.float32)
+    bins = ap._scatter_bins(x, (0, 25), 100)
+    finite = np.isfinite(x)
+    ref = np.histogram(x[finite], bins=100, range=(0, 25))[0]
+    np.testing.assert_array_equal(
+        np.bincount(bins[bins >= 0], minlength=100), ref)
+    np.testing.assert_array_equal(bins[[0, 4, 5, 6, 7]], [0, 99, -1, -1, -1])
+
+
+def test_stratified_scatter(pixels):
+    data = {key: da.from_array(val, chunks=CHUNKSIZE)
+            for key, val in pixels.items()}
+    nstrata = ap.get_nstrata(ap.STRATA_SATZ)
+    codes = ap.get_strata_codes(data, ap.STRATA_SATZ)
+    strata, full = dask.compute(
+        ap.get_stratified_scatter(data, codes, nstrata, 'CCI'),
+        ap.get_scatter_aggregates(data, 'CCI'))
+    np.testing.assert_array_equal(strata['scatter_hist'].sum(axis=0),
+                                  full['scatter_hist'])
+    np.testing.assert_allclose(strata['scatter_sums'].sum(axis=0),
+                               full['scatter_sums'])
@@ -0,0 +1,145 @@
+import warnings
+import numpy as np
+import pytest
+import scores
+
+# the scores as originally computed from a, b, c, d arrays
+BASELINE = {'hitrate': lambda a, b, c, d: (a + d) / (a + b + c + d),
+            'pod_clr': lambda a, b, c, d: d / (b + d),
+            'pod_cld': lambda a, b, c, d: a / (a + c),
+            'far_clr': lambda a, b, c, d: c / (c + d),
+            'far_cld': lambda a, b, c, d: b / (a + b),
+            'pofd_clr': lambda a, b, c, d: c / (a + c),
+            'pofd_cld': lambda a, b, c, d: b / (b + d),
+            'heidke': lambda a, b, c, d: 2 * (a * d - b * c) / np.where(
+                (a + c) * (c + d) + (a + b) * (b + d) == 0, 1,
+                (a + c) * (c + d) + (a + b) * (b + d)),
+            'kuiper': lambda a, b, c, d: (a * d - b * c) / np.where(
+                (a + c) * (b + d) == 0, 1, (a + c) * (b + d)),
+            'bias': lambda a, b, c, d: (b - c) / (a + b + c + d),
+            'mean_cal': lambda a, b, c, d: (a + c) / (a + b + c + d),
+            'mean_img': lambda a, b, c, d: (a + b) / (a + b + c + d)}
+
+
+def get_table(shape=(20, 30), seed=0):
+    """ Random contingency tables with empty cells and empty categories. """
+    rng = np.random.default_rng(seed)
+    table = rng.integers(0, 50, (4,) + shape)
+    table[:, rng.random(shape) < 0.2] = 0
+    cells = table.reshape(4, -1)
+    cells[rng.integers(0, 4, cells.shape[1]), np.arange(cells.shape[1])] = 0
+    return table
+
+
+def baseline_scores(table, names):
+    a, b, c, d = np.asarray(table, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.stack([BASELINE[name](a, b, c, d) for name in names])
+
+
+@pytest.mark.parametrize('dtype, rtol', [(np.float64, 1e-12),
+                                         (np.float32, 1e-5)])
+def test_batch_scores(dtype, rtol):
+    table = get_table()
+    names = list(scores.SCORES)
+    result = scores.get_batch_scores(table, names, dtype=dtype)
+    assert result.dtype == dtype
+    np.testing.assert_allclose(result, baseline_scores(table, names),
+                               rtol=rtol, atol=1e-6)
+
+
+def test_batch_scores_out():
+    table = get_table((50,))
+    names = ['kuiper', 'hitrate']
+    out = np.empty((2, 50))
+    result = scores.get_batch_scores(table, names, out=out)
+    assert result is out
+    np.testing.assert_allclose(out, baseline_scores(table, names))
+    with pytest.raises(Exception):
+        scores.get_batch_scores(table, names, out=np.empty((3, 50)))
+    with pytest.raises(Exception):
+        scores.get_batch_scores(table[:3], names)
+
+
+def test_nanquantiles():
+    rng = np.random.default_rng(1)
+    values = rng.random((3, 40, 25))
+    values[rng.random(values.shape) < 0.3] = np.nan
+    values[:, :, 0] = np.nan
+    values[:, 1:, 1] = np.nan
+    quantiles = [0.025, 0.5, 0.975]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        ref = np.nanquantile(values, quantiles, axis=1).transpose(1, 0, 2)
+    np.testing.assert_allclose(scores._nanquantiles(values, quantiles), ref,
+                               rtol=1e-12)
+
+
+@pytest.mark.parametrize('batchsize', [2**22, 1000])
+def test_bootstrap_ci(batchsize):
+    table = get_table((6, 7))
+    names = ['hitrate', 'kuiper', 'heidke', 'bias']
+    nboot, level, seed = 100, 0.9, 3
+    bounds = scores.get_bootstrap_ci(table, names, nboot, level, seed,
+                                     np.float64, batchsize)
+    assert bounds.shape == (len(names), 2) + table.shape[1:]
+
+    # resample every cell with the same random numbers as the batches
+    counts = table.reshape(4, -1).T
+    n = counts.sum(axis=1)
+    pvals = counts / np.maximum(n, 1)[:, np.newaxis]
+    pvals[n == 0, 0] = 1
+    rng = np.random.default_rng(seed)
+    step = max(1, batchsize // nboot)
+    ref = []
+    for start in range(0, n.size, step):
+        cells = slice(start, start + step)
+        samples = rng.multinomial(n[cells], pvals[cells],
+                                  size=(nboot, n[cells].size))
+        replicates = baseline_scores(samples.transpose(2, 0, 1), names)
+        with warnings.catch_warnings():
+            # all-NaN slices of empty cells
+            warnings.simplefilter('ignore', RuntimeWarning)
+            ref.append(np.nanquantile(replicates, [(1 - level) / 2,
+                                                   (1 + level) / 2],
+                                      axis=1).transpose(1, 0, 2))
+    ref = np.concatenate(ref, axis=2)
+    ref[:, :, n == 0] = np.nan
+    np.testing.assert_allclose(bounds.reshape(ref.shape), ref, rtol=1e-12)
+
+
+def test_score_functions():
+    a, b, c, d = get_table((40,))
+    n = a + b + c + d
+    results = {'hitrate': scores.hitrate(a, d, n),
+               'pod_clr': scores.pod_clr(b, d),
+               'pod_cld': scores.pod_cld(a, c),
+               'far_clr': scores.far_clr(c, d),
+               'far_cld': scores.far_cld(a, b),
+               'pofd_clr': scores.pofd_clr(a, c),
+               'pofd_cld': scores.pofd_cld(b, d),
+               'heidke': scores.heidke(a, b, c, d),
+               'kuiper': scores.kuiper(a, b, c, d),
+               'bias': scores.bias(b, c, n),
+               'mean_cal': scores.mean(a, c, n),
+               'mean_img': scores.mean(a, b, n)}
+    ref = baseline_scores((a, b, c, d), list(results))
+    np.testing.assert_allclose(np.stack(list(results.values())), ref,
+                               rtol=1e-12)
+
+
+@pytest.mark.parametrize('name', list(scores.SCORES))
+def test_needed_terms(name):
+    table = get_table((10,)).astype(np.float64)
+    terms = scores._get_terms(*table, [name])
+    # only the terms of the score and the ones they are made of
+    parts = {'2(ad-bc)': {'ad-bc'},
+             '(a+c)(b+d)': {'a+c', 'b+d'},
+             '(a+c)(c+d)+(a+b)(b+d)': {'a+b', 'a+c', 'b+d', 'c+d'}}
+    expected = set(scores.SCORES[name][:2])
+    for term in list(expected):
+        expected |= parts.get(term, set())
+    assert set(terms) == expected | {'a', 'b', 'c', 'd'}
+    np.testing.assert_allclose(
+        scores.get_batch_scores(table, [name])[0],
+        baseline_scores(table, [name])[0], rtol=1e-12)
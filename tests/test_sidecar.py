@@ -0,0 +1,48 @@
+import os
+import shutil
+import numpy as np
+import pytest
+
+pytest.importorskip('atrain_match')
+import dask  # noqa: E402
+import atrain_plot as ap  # noqa: E402
+from conftest import CHUNKSIZE  # noqa: E402
+
+
+@pytest.fixture
+def mcopy(mfile, tmp_path):
+    ofile = str(tmp_path / os.path.basename(mfile))
+    shutil.copy2(mfile, ofile)
+    return ofile
+
+
+def assert_decoded(data, latlon, pixels):
+    for key, values in dict(data, **latlon).items():
+        ref = pixels[key]
+        dtype = ap.SIDECAR_DTYPES.get(key)
+        if dtype is not None:
+            ref = ref.astype(dtype)
+        np.testing.assert_array_equal(values, ref, err_msg=key)
+
+
+def test_sidecar(monkeypatch, mcopy, pixels):
+    data, latlon = dask.compute(*ap.load_collocated_file(mcopy, CHUNKSIZE,
+                                                         cache=True))
+    assert set(data) == set(pixels) - {'lat', 'lon', 'idxs'}
+    assert_decoded(data, latlon, pixels)
+
+    # a touched file with unchanged content keeps its cache
+    stat = os.stat(mcopy)
+    os.utime(mcopy, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    monkeypatch.setattr(ap, 'write_sidecar', None)
+    cached = ap.load_collocated_file(mcopy, CHUNKSIZE, cache=True)
+    assert cached[0]['satz'].chunks[0][0] == CHUNKSIZE
+    assert_decoded(*dask.compute(*cached), pixels)
+
+
+def test_sidecar_outdated(mcopy):
+    ap.load_collocated_file(mcopy, CHUNKSIZE, cache=True)
+    assert ap.read_sidecar(mcopy, 'CCI', CHUNKSIZE) is not None
+    with open(mcopy, 'ab') as fh:
+        fh.write(b'\0')
+    assert ap.read_sidecar(mcopy, 'CCI', CHUNKSIZE) is None
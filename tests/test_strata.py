@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('atrain_match')
+import atrain_plot as ap  # noqa: E402
+import reference  # noqa: E402
+from conftest import CHUNKSIZE  # noqa: E402
+
+
+@pytest.mark.parametrize('scenario', reference.SCENARIOS)
+def test_strata_selection(scenario):
+    # pixels on, next to and between the satz and sunz edges
+    edges = np.array(ap.STRATA_SATZ + ap.STRATA_SUNZ, dtype=np.float64)
+    values = np.concatenate([[-1, 0, 180, np.nan], edges, edges - 1e-6,
+                             edges + 1e-6, np.arange(0.5, 180, 2.5)])
+    satz, sunz = [val.ravel() for val in np.meshgrid(values, values)]
+    selection = ap.get_strata_selection(ap.STRATA_SATZ, *scenario)
+    codes = ap._strata_codes(satz, sunz, ap.STRATA_SATZ)
+    assert selection.size == ap.get_nstrata(ap.STRATA_SATZ)
+    np.testing.assert_array_equal(
+        selection[codes],
+        reference.scenario_valid({'satz': satz, 'sunz': sunz}, *scenario))
+
+
+def test_strata_unresolved_satz():
+    with pytest.raises(Exception):
+        ap.get_strata_selection(ap.STRATA_SATZ, 'ALL', 65)
+
+
+def test_stratified_reduction(mfile, adef, pixels):
+    aggs = ap.reduce_file(mfile, reference.SCENARIOS, adef, 'CCI', CHUNKSIZE,
+                          idxs_cache=False, strata=ap.STRATA_SATZ)
+    for scenario in reference.SCENARIOS:
+        ref = reference.aggregates(
+            pixels, reference.scenario_valid(pixels, *scenario), adef.size)
+        reference.assert_aggregates(
+            ap.select_bins(aggs[scenario], adef.size), ref)
+
+
+def test_stratified_binning(mfile, adef):
+    scenarios = [('DAY', None), ('NIGHT', 70)]
+    kwargs = dict(idxs_cache=False, binning='sunz')
+    plain = ap.reduce_file(mfile, scenarios, adef, 'CCI', CHUNKSIZE, **kwargs)
+    strata = ap.reduce_file(mfile, scenarios, adef, 'CCI', CHUNKSIZE,
+                            strata=ap.STRATA_SATZ, **kwargs)
+    for scenario in scenarios:
+        for selection in [None, [8, 9]]:
+            reference.assert_aggregates(
+                ap.select_bins(strata[scenario], adef.size, selection),
+                ap.select_bins(plain[scenario], adef.size, selection))